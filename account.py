@@ -3,19 +3,22 @@ import argparse
 import os
 
 import app_config
-from graph.auth import MSALAuth, OAuthSettings
-from helpers.account_helper import AccountHelper
 
 
 def create_msal_auth():
+    # 只在需要时导入MSAL，显示帮助信息时不需要
+    from graph.auth import MSALAuth, OAuthSettings
     return MSALAuth(
         OAuthSettings(app_id=os.getenv('APP_ID'),
                       app_secret=os.getenv('APP_SECRET'),
                       redirect=os.getenv('REDIRECT_URL')),
-        serialized_token_file=app_config.SERIALIZED_TOKEN)
+        serialized_token_file=app_config.SERIALIZED_TOKEN,
+        metadata_cache_file=app_config.AUTHORITY_METADATA_CACHE,
+        metadata_ttl=app_config.AUTHORITY_METADATA_TTL)
 
 
 def operations(args):
+    from helpers.account_helper import AccountHelper
     if args.list:
         AccountHelper(create_msal_auth()).list()
     elif args.add:
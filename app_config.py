@@ -20,5 +20,97 @@ elif not os.path.isdir(CACHE_DIR):
 
 # token保存路径
 SERIALIZED_TOKEN = os.path.join(CACHE_DIR, 'serialized_token.json')
-# 上传分片大小(MB): 5的正整数倍，最大60。根据自己的上传速度调节
+# MSAL的authority元数据（OpenID配置、实例发现）缓存，token有效时启动不需要访问网络
+AUTHORITY_METADATA_CACHE = os.path.join(CACHE_DIR, 'authority-metadata.json')
+# authority元数据缓存的有效时间(秒)，过期后请求失败时继续使用过期的缓存
+AUTHORITY_METADATA_TTL = 24 * 3600
+# access token在过期前多少秒由后台线程刷新，需大于MSAL视为过期的5分钟
+TOKEN_REFRESH_BEFORE = 600
+# 上传分片大小(MB): 5的正整数倍，最大60。开启自动调整时为初始分片大小
 UPLOAD_CHUNK_SIZE = 10
+# 是否根据上传速度自动调整分片大小
+UPLOAD_ADAPTIVE_CHUNK = True
+# 自动调整时，上传一个分片的目标时间(秒)
+UPLOAD_CHUNK_TARGET_TIME = 10
+# 上传大文件时后台线程提前读取并计算hash的缓冲区数量，至少为1。读取的缓冲区直接作为请求体发送，每个字节只从磁盘读取一次
+UPLOAD_READ_AHEAD = 2
+# 上传目录时提前为排队中的多少个大文件同时创建上传会话，0为不提前创建
+UPLOAD_SESSION_PREFETCH = 4
+# 上传会话在此时间(秒)内过期时，改为发送最小的分片，每个分片完成后会话随之延长
+UPLOAD_SESSION_EXPIRY_MARGIN = 120
+# 读取文件的缓冲区大小(KB)。发送请求体和计算hash时分块读取到缓冲区中
+UPLOAD_BUFFER_SIZE = 256
+# 所有上传共用的缓冲区数量，用完时等待。读取文件占用的内存上限为 缓冲区大小 * 数量，与分片大小和同时上传的文件数量无关。
+# 少于 同时上传的文件数量 * (UPLOAD_READ_AHEAD + 2) 时自动增加
+UPLOAD_BUFFER_COUNT = 64
+# 上传方式：blocking 每个文件使用一个线程；async 使用asyncio在一个线程中同时上传大量文件，需要安装aiohttp
+UPLOAD_ENGINE = 'blocking'
+# 上传目录时同时上传的文件数量
+UPLOAD_WORKERS = 4
+# 上传带宽限制(MB/s)，所有同时上传的文件共享，0或为空时不限制。
+# 可以按时间段设置，例如 "08:00-20:00=2,22:00-06:00=0,10" 表示白天2MB/s、夜间不限制、其余时间10MB/s
+BANDWIDTH_LIMIT = ''
+# 上传过程中修改带宽限制：写入与BANDWIDTH_LIMIT格式相同的内容，每秒检查一次，为空时不检查
+BANDWIDTH_CONTROL_FILE = os.path.join(CACHE_DIR, 'bandwidth-limit')
+# 每个账号同时进行的请求数上限。被限流(429/503)时自动减半，之后逐渐恢复
+THROTTLE_MAX_INFLIGHT = 16
+# 上传目录时是否使用$batch批量创建文件夹和上传小文件
+UPLOAD_BATCH = True
+# 使用$batch上传的文件大小上限(KB)
+UPLOAD_BATCH_FILE_SIZE = 512
+# 上传目录时内容相同的文件是否只上传一次，其余在服务器上复制
+UPLOAD_DEDUP = True
+# 查找内容相同的文件的大小下限(KB)，更小的文件直接上传
+UPLOAD_DEDUP_MIN_SIZE = 1024
+# 查询服务器复制进度的间隔(秒)
+UPLOAD_DEDUP_POLL_INTERVAL = 1
+# 等待服务器复制完成的最长时间(秒)
+UPLOAD_DEDUP_COPY_TIMEOUT = 600
+# 打包上传时打包的文件大小上限(KB)，更大的文件单独上传
+UPLOAD_PACK_FILE_SIZE = 64
+# 打包上传时每个tar分段未压缩的大小上限(MB)
+UPLOAD_PACK_SEGMENT_SIZE = 64
+# 打包上传时分段的压缩方式: none, gzip, zstd（需要安装zstandard）。不压缩时可以按索引中的偏移直接下载单个文件
+UPLOAD_PACK_COMPRESSION = 'none'
+# 打包上传时写入分段的临时目录，上传完成后删除
+UPLOAD_PACK_SPILL_DIR = os.path.join(CACHE_DIR, 'pack-spill')
+# 临时目录中同时存在的分段数量上限，至少为1。占用磁盘约为 数量 * 分段大小
+UPLOAD_PACK_SPILL_SEGMENTS = 4
+# 上传目录时同时遍历目录的线程数
+UPLOAD_SCAN_WALKERS = 8
+# 上传目录时计算文件hash的线程数，0为在遍历目录的线程中计算
+UPLOAD_SCAN_HASH_THREADS = 8
+# 已上传文件的索引，再次上传同一目录时跳过没有变化的文件
+UPLOAD_INDEX_DB = os.path.join(CACHE_DIR, 'upload-index.db')
+# 断点续传信息，所有上传共用，每个分片的进度合并后定期写入
+UPLOAD_CHECKPOINT_DB = os.path.join(CACHE_DIR, 'upload-checkpoints.db')
+# OneDrive上已存在同名文件时的处理方式: rename, replace, fail
+UPLOAD_CONFLICT_BEHAVIOR = 'rename'
+# OneDrive目录树缓存，上传目录前使用delta增量同步
+REMOTE_TREE_DB = os.path.join(CACHE_DIR, 'remote-tree.db')
+# 性能记录的JSON lines文件路径，每个分片、文件、请求和获取token的用时写为一行，为空时不记录
+TELEMETRY_JSONL = ''
+# 性能记录的Prometheus指标文件路径（textfile collector），为空时不写入
+TELEMETRY_PROM = ''
+# 写入Prometheus指标文件的间隔(秒)
+TELEMETRY_PROM_INTERVAL = 15
+# 上传进度的显示方式: auto（终端中显示仪表盘，否则定期输出一行汇总）, plain（总是输出汇总行）, none
+PROGRESS_MODE = 'auto'
+# 终端中仪表盘的刷新间隔(秒)
+PROGRESS_REFRESH_INTERVAL = 0.5
+# 标准输出不是终端时（例如nohup）输出汇总行的间隔(秒)
+PROGRESS_LOG_INTERVAL = 30
+# 仪表盘中显示最慢的上传数量
+PROGRESS_TOP = 5
+# 采样分析器的采样间隔(秒)
+PROFILE_INTERVAL = 0.005
+# 上传守护进程的任务队列，守护进程重启后继续执行未完成的任务
+DAEMON_JOB_DB = os.path.join(CACHE_DIR, 'daemon-jobs.db')
+# 上传守护进程的控制socket（Unix domain socket）
+DAEMON_SOCKET = os.path.join(CACHE_DIR, 'daemon.sock')
+# 不支持Unix domain socket时（Windows），控制socket监听的本机端口
+DAEMON_PORT = 47613
+# 上传守护进程同时执行的任务数量
+DAEMON_JOBS = 4
+# 扫描监视目录的间隔(秒)，文件在两次扫描之间没有变化时才上传
+DAEMON_WATCH_INTERVAL = 10
@@ -0,0 +1,630 @@
+# -*- coding: utf-8 -*-
+import base64
+import dataclasses
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from utils.quick_xor_hash import QuickXorHash
+
+
+@dataclasses.dataclass
+class Faults:
+    """
+    注入的故障和网络条件
+    """
+    # 每个请求增加的延迟(秒)
+    latency: float = 0
+    # 上传带宽上限(字节/秒)，0表示不限制
+    bandwidth: int = 0
+    # 返回500的概率
+    error_rate: float = 0
+    # 返回429的概率
+    throttle_rate: float = 0
+    # 429响应的Retry-After(秒)
+    retry_after: float = 1
+    # 读取请求体后直接断开连接的概率
+    drop_rate: float = 0
+    # 服务器复制文件需要的时间(秒)
+    copy_time: float = 0
+    # 服务器复制文件失败的概率
+    copy_fail_rate: float = 0
+
+
+@dataclasses.dataclass
+class Item:
+    id: str
+    name: str
+    parent_id: str
+    folder: bool = False
+    data: bytes = b''
+    e_tag: str = ''
+    deleted: bool = False
+    quick_xor_hash: str = ''
+
+
+@dataclasses.dataclass
+class CopyJob:
+    source_id: str
+    parent_id: str
+    name: str
+    conflict_behavior: str
+    done_at: float
+    failed: bool = False
+    # 完成后副本的id
+    resource_id: str = ''
+
+
+@dataclasses.dataclass
+class Session:
+    path: str
+    parent_id: str
+    name: str
+    conflict_behavior: str
+    size: int = 0
+    data: bytearray = dataclasses.field(default_factory=bytearray)
+    # 已收到的字节范围 [(start, end)]
+    ranges: List[tuple] = dataclasses.field(default_factory=list)
+    expiration: float = 0
+
+
+class MockDrive:
+    """
+    内存中的OneDrive驱动器，实现上传相关的Graph接口
+    """
+
+    def __init__(self, session_ttl: float = 3600, quota: int = 1024 ** 4):
+        """
+        :param session_ttl: 上传会话的有效期(秒)
+        :param quota: 驱动器的总空间(字节)
+        """
+        self.lock = threading.RLock()
+        self.items: Dict[str, Item] = {}
+        # 父目录id -> {名称: id}
+        self.tree: Dict[str, Dict[str, str]] = {}
+        self.sessions: Dict[str, Session] = {}
+        # 复制的监视id -> 复制任务
+        self.copies: Dict[str, CopyJob] = {}
+        # 变化日志，用于delta: [(序号, item_id)]
+        self.changes: List[tuple] = []
+        self.session_ttl = session_ttl
+        self.quota = quota
+        self.base_url = ''
+        self.root = self._new_item('root', '', folder=True)
+
+    def _new_item(self, name: str, parent_id: str, folder=False,
+                  data=b'') -> Item:
+        item = Item(uuid.uuid4().hex, name, parent_id, folder, data,
+                    quick_xor_hash=QuickXorHash(data).base64())
+        self._touch(item)
+        self.items[item.id] = item
+        self.tree.setdefault(parent_id, {})[name] = item.id
+        return item
+
+    def _touch(self, item: Item):
+        item.e_tag = uuid.uuid4().hex
+        self.changes.append((len(self.changes) + 1, item.id))
+
+    def children(self, item: Item) -> List[Item]:
+        return [self.items[i] for i in self.tree.get(item.id, {}).values()]
+
+    def child(self, item: Item, name: str) -> Optional[Item]:
+        item_id = self.tree.get(item.id, {}).get(name)
+        return self.items[item_id] if item_id else None
+
+    def path_of(self, item: Item) -> str:
+        names = []
+        while item.id != self.root.id:
+            names.append(item.name)
+            item = self.items[item.parent_id]
+        return '/' + '/'.join(reversed(names))
+
+    def resolve(self, path: str, create_parents=False) -> Optional[Item]:
+        item = self.root
+        for name in [n for n in path.split('/') if n]:
+            child = self.child(item, name)
+            if child is None:
+                if not create_parents:
+                    return None
+                child = self._new_item(name, item.id, folder=True)
+            item = child
+        return item
+
+    def item_json(self, item: Item) -> dict:
+        r = {
+            'id': item.id,
+            'name': item.name,
+            'eTag': item.e_tag,
+            'parentReference': {'id': item.parent_id, 'driveId': 'mock'},
+        }
+        if item.deleted:
+            r['deleted'] = {'state': 'deleted'}
+        elif item.folder:
+            r['folder'] = {'childCount': len(self.children(item))}
+            r['size'] = 0
+        else:
+            r['size'] = len(item.data)
+            r['file'] = {'hashes': {'quickXorHash': item.quick_xor_hash}}
+        return r
+
+    def put_file(self, parent: Item, name: str, data: bytes,
+                 conflict_behavior: str):
+        """
+        :return: (status, body)
+        """
+        existing = self.child(parent, name)
+        if existing is not None:
+            if conflict_behavior == 'fail':
+                return 409, error('nameAlreadyExists')
+            if conflict_behavior == 'rename':
+                base, dot, ext = name.rpartition('.')
+                if not dot:
+                    base, ext = name, ''
+                n = 1
+                while self.child(parent, name) is not None:
+                    name = '%s %d%s' % (base, n, '.' + ext if dot else '')
+                    n += 1
+                existing = None
+        replaced = len(existing.data) if existing is not None else 0
+        if self.used() - replaced + len(data) > self.quota:
+            return 507, error('quotaLimitReached', 'Insufficient Space')
+        if existing is not None:
+            existing.data = bytes(data)
+            existing.quick_xor_hash = QuickXorHash(existing.data).base64()
+            self._touch(existing)
+            return 200, self.item_json(existing)
+        item = self._new_item(name, parent.id, data=bytes(data))
+        return 201, self.item_json(item)
+
+    def copy_status(self, mid: str):
+        """
+        复制的进度，到完成时间后第一次查询时才实际复制
+        :return: (status, body)
+        """
+        job = self.copies.get(mid)
+        if job is None:
+            return 404, error('itemNotFound')
+        if job.failed:
+            return 200, {'status': 'failed',
+                         'error': error('generalException')['error']}
+        if time.time() < job.done_at:
+            return 202, {'status': 'inProgress', 'percentageComplete': 50}
+        if not job.resource_id:
+            source = self.items[job.source_id]
+            status, r = self.put_file(self.items[job.parent_id], job.name,
+                                      source.data, job.conflict_behavior)
+            if status >= 400:
+                job.failed = True
+                return 200, {'status': 'failed', 'error': r['error']}
+            job.resource_id = r['id']
+        return 200, {'status': 'completed', 'resourceId': job.resource_id}
+
+    def used(self) -> int:
+        return sum(len(i.data) for i in self.items.values() if not i.deleted)
+
+    def drive_json(self) -> dict:
+        used = self.used()
+        return {'id': 'mock', 'driveType': 'personal', 'quota': {
+            'total': self.quota, 'used': used,
+            'remaining': self.quota - used,
+            'state': 'normal' if used < self.quota else 'exceeded'}}
+
+
+def error(code: str, message: str = '') -> dict:
+    return {'error': {'code': code, 'message': message or code}}
+
+
+class Router:
+    """
+    解析请求并调用MockDrive，HTTP请求和$batch中的请求共用
+    """
+
+    def __init__(self, drive: MockDrive, faults: Optional[Faults] = None):
+        self.drive = drive
+        self.faults = faults or Faults()
+
+    def _address(self, addr: str):
+        """
+        解析 root, root:/a/b:, items/{id}, items/{id}:/name:
+        :return: (item或None, 父目录, 名称)
+        """
+        d = self.drive
+        m = re.match(r'^items/([^/:]+)(?::(.*?):?)?$', addr)
+        if m:
+            parent = d.items.get(m.group(1))
+            if m.group(2) is None:
+                return parent, None, None
+            if parent is None:
+                return None, None, None
+            path = unquote(m.group(2)).strip('/')
+            base = d.path_of(parent)
+            full = (base.rstrip('/') + '/' + path)
+        else:
+            m = re.match(r'^root(?::(.*?):?)?$', addr)
+            if not m:
+                return None, None, None
+            full = unquote(m.group(1) or '/')
+        full = '/' + full.strip('/')
+        parent_path, _, name = full.rpartition('/')
+        return d.resolve(full), parent_path, name
+
+    def handle(self, method: str, url: str, headers: dict, body: bytes):
+        """
+        :param url: /v1.0 之后的路径，例如 /me/drive/root:/a:/content?x=y
+        :return: (status, headers, json)
+        """
+        d = self.drive
+        parts = urlsplit(url)
+        path = parts.path
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        with d.lock:
+            if path == '/me/drive' and method == 'GET':
+                return 200, {}, d.drive_json()
+            m = re.match(r'^/me/drive/(.+?)(/(content|createUploadSession|'
+                         r'children|delta|copy))?$', path)
+            if not m:
+                return 404, {}, error('itemNotFound')
+            item, parent_path, name = self._address(m.group(1))
+            action = m.group(3)
+
+            if action is None and method == 'GET':
+                if item is None:
+                    return 404, {}, error('itemNotFound')
+                return 200, {}, d.item_json(item)
+
+            if action == 'content' and method == 'PUT':
+                parent = d.resolve(parent_path, create_parents=True)
+                status, r = d.put_file(parent, unquote(name), body, query.get(
+                    '@microsoft.graph.conflictBehavior', 'replace'))
+                return status, {}, r
+
+            if action == 'createUploadSession' and method == 'POST':
+                data = json.loads(body or b'{}')
+                parent = d.resolve(parent_path, create_parents=True)
+                sid = uuid.uuid4().hex
+                d.sessions[sid] = Session(
+                    parent_path, parent.id, unquote(name),
+                    data.get('@microsoft.graph.conflictBehavior', 'fail'),
+                    expiration=time.time() + d.session_ttl)
+                return 200, {}, {
+                    'uploadUrl': '%s/upload/%s' % (d.base_url, sid),
+                    'expirationDateTime': iso_time(
+                        d.sessions[sid].expiration),
+                    'nextExpectedRanges': ['0-']}
+
+            if action == 'children' and method == 'GET':
+                if item is None:
+                    return 404, {}, error('itemNotFound')
+                children = d.children(item)
+                top = int(query.get('$top', 200))
+                skip = int(query.get('$skiptoken', 0))
+                r = {'value': [d.item_json(i)
+                               for i in children[skip:skip + top]]}
+                if skip + top < len(children):
+                    r['@odata.nextLink'] = '%s/v1.0%s?$top=%d&$skiptoken=%d' \
+                                           % (d.base_url, path, top,
+                                              skip + top)
+                return 200, {}, r
+
+            if action == 'children' and method == 'POST':
+                if item is None:
+                    return 404, {}, error('itemNotFound')
+                data = json.loads(body)
+                existing = d.child(item, data['name'])
+                if existing is not None:
+                    if data.get('@microsoft.graph.conflictBehavior') == \
+                            'fail':
+                        return 409, {}, error('nameAlreadyExists')
+                    return 200, {}, d.item_json(existing)
+                return 201, {}, d.item_json(
+                    d._new_item(data['name'], item.id, folder=True))
+
+            if action == 'copy' and method == 'POST':
+                if item is None or item.folder:
+                    return 404, {}, error('itemNotFound')
+                data = json.loads(body)
+                ref = data['parentReference']
+                if 'id' in ref:
+                    parent = d.items.get(ref['id'])
+                else:
+                    parent = d.resolve(ref['path'].split(':', 1)[1] or '/')
+                if parent is None:
+                    return 400, {}, error('invalidRequest',
+                                          'parent not found')
+                mid = uuid.uuid4().hex
+                faults = self.faults
+                d.copies[mid] = CopyJob(
+                    item.id, parent.id, data.get('name', item.name),
+                    query.get('@microsoft.graph.conflictBehavior', 'fail'),
+                    time.time() + faults.copy_time,
+                    random.random() < faults.copy_fail_rate)
+                return 202, {'Location': '%s/monitor/%s' % (d.base_url,
+                                                            mid)}, None
+
+            if action == 'delta' and method == 'GET':
+                if item is None:
+                    return 404, {}, error('itemNotFound')
+                return 200, {}, self._delta(item, path, query)
+
+        return 405, {}, error('invalidRequest')
+
+    def _delta(self, item: Item, path: str, query: dict) -> dict:
+        d = self.drive
+        token = int(query.get('token', 0))
+        root_path = d.path_of(item)
+        ids = []
+        seen = set()
+        for seq, item_id in d.changes:
+            if seq <= token or item_id in seen:
+                continue
+            i = d.items[item_id]
+            p = d.path_of(i)
+            if i.id == item.id or p.startswith(root_path.rstrip('/') + '/'):
+                seen.add(item_id)
+                ids.append(item_id)
+        # 父目录在子项之前
+        ids.sort(key=lambda x: d.path_of(d.items[x]).count('/'))
+        return {
+            'value': [d.item_json(d.items[i]) for i in ids],
+            '@odata.deltaLink': '%s/v1.0%s?token=%d' % (
+                d.base_url, path, len(d.changes))
+        }
+
+
+def iso_time(t: float) -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(t))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分两次发送，不关闭Nagle算法时每个请求会多等待约40ms
+    disable_nagle_algorithm = True
+    server: 'MockGraphServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        n = int(self.headers.get('Content-Length', 0))
+        bandwidth = self.server.faults.bandwidth
+        if not bandwidth:
+            return self.rfile.read(n)
+        # 按带宽上限读取请求体
+        buf = bytearray()
+        start = time.time()
+        while len(buf) < n:
+            buf += self.rfile.read(min(64 * 1024, n - len(buf)))
+            ahead = len(buf) / bandwidth - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+        return bytes(buf)
+
+    def _send(self, status: int, headers: dict, body):
+        data = b'' if body is None else json.dumps(body).encode('utf8')
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, str(v))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        srv = self.server
+        if self.path == '/_mock/stats':
+            # 统计信息不计入请求数，也不注入故障
+            return self._send(200, {}, srv.stats())
+        body = self._read_body()
+        srv.count_request(len(body))
+        faults = srv.faults
+        if faults.latency:
+            time.sleep(faults.latency)
+        r = random.random()
+        if r < faults.drop_rate:
+            self.close_connection = True
+            self.connection.close()
+            return
+        r -= faults.drop_rate
+        if r < faults.throttle_rate:
+            return self._send(429, {'Retry-After': faults.retry_after},
+                              error('activityLimitReached'))
+        r -= faults.throttle_rate
+        if r < faults.error_rate:
+            return self._send(500, {}, error('generalException'))
+
+        path = self.path
+        # 每个access token对应一个驱动器，用于测试多个账号
+        drive = srv.drive_for(self.headers.get('Authorization', ''))
+        if path.startswith('/upload/'):
+            return self._send(*srv.upload(self.command, path, self.headers,
+                                          body))
+        if path.startswith('/monitor/'):
+            return self._send(*srv.monitor(path))
+        if not path.startswith('/v1.0'):
+            return self._send(404, {}, error('itemNotFound'))
+        path = path[len('/v1.0'):]
+        if path == '/$batch' and self.command == 'POST':
+            return self._send(*srv.batch(drive, json.loads(body)))
+        self._send(*Router(drive, faults).handle(self.command, path,
+                                                 self.headers, body))
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+
+class MockGraphServer(ThreadingHTTPServer):
+    """
+    本地的Graph和上传会话服务器，用于离线测试和基准测试
+    """
+    daemon_threads = True
+
+    def __init__(self, faults: Optional[Faults] = None,
+                 host: str = '127.0.0.1', port: int = 0,
+                 session_ttl: float = 3600, quota: int = 1024 ** 4):
+        super().__init__((host, port), Handler)
+        self.faults = faults or Faults()
+        self.session_ttl = session_ttl
+        self.quota = quota
+        self.base_url = 'http://%s:%d' % self.server_address
+        # Authorization请求头 -> 驱动器
+        self.drives: Dict[str, MockDrive] = {}
+        self.drives_lock = threading.Lock()
+        self.drive = self.drive_for('')
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.bytes_received = 0
+        self.bytes_resent = 0
+        self._thread = None
+
+    @property
+    def graph_url(self) -> str:
+        return self.base_url + '/v1.0'
+
+    def drive_for(self, authorization: str) -> MockDrive:
+        """
+        :return: access token对应的驱动器，没有token的请求使用同一个驱动器
+        """
+        with self.drives_lock:
+            drive = self.drives.get(authorization)
+            if drive is None:
+                drive = MockDrive(self.session_ttl, self.quota)
+                drive.base_url = self.base_url
+                self.drives[authorization] = drive
+            return drive
+
+    def count_request(self, n: int):
+        with self.stats_lock:
+            self.requests += 1
+            self.bytes_received += n
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def batch(self, drive: MockDrive, data: dict):
+        router = Router(drive, self.faults)
+        responses = []
+        for r in data['requests']:
+            body = r.get('body')
+            headers = r.get('headers', {})
+            if isinstance(body, str):
+                body = base64.b64decode(body)
+            elif body is not None:
+                body = json.dumps(body).encode('utf8')
+            status, h, resp = router.handle(r['method'], r['url'],
+                                                 headers, body or b'')
+            responses.append({'id': r['id'], 'status': status, 'headers': h,
+                              'body': resp})
+        return 200, {}, {'responses': responses}
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {'requests': self.requests,
+                    'bytes_received': self.bytes_received,
+                    'bytes_resent': self.bytes_resent}
+
+    def upload(self, method: str, path: str, headers, body: bytes):
+        sid = path.rsplit('/', 1)[-1]
+        # 上传地址不需要token，按会话查找驱动器
+        with self.drives_lock:
+            drives = list(self.drives.values())
+        d = next((d for d in drives if sid in d.sessions), self.drive)
+        with d.lock:
+            s = d.sessions.get(sid)
+            if s is None or s.expiration < time.time():
+                d.sessions.pop(sid, None)
+                return 404, {}, error('itemNotFound',
+                                      'The upload session was not found')
+            if method == 'DELETE':
+                del d.sessions[sid]
+                return 204, {}, None
+            if method == 'GET':
+                return 200, {}, self._session_json(s)
+            if method != 'PUT':
+                return 405, {}, error('invalidRequest')
+
+            m = re.match(r'bytes (\d+)-(\d+)/(\d+)',
+                         headers.get('Content-Range', ''))
+            if not m:
+                return 400, {}, error('invalidRange')
+            start, end, total = map(int, m.groups())
+            if end - start + 1 != len(body) or end >= total:
+                return 400, {}, error('invalidRange')
+            # 统计重复上传的字节数
+            for a, b in s.ranges:
+                overlap = min(b, end) - max(a, start) + 1
+                if overlap > 0:
+                    with self.stats_lock:
+                        self.bytes_resent += overlap
+            if s.size == 0:
+                s.size = total
+                s.data = bytearray(total)
+            s.data[start:end + 1] = body
+            s.ranges = merge_ranges(s.ranges + [(start, end)])
+            s.expiration = time.time() + d.session_ttl
+            if s.ranges == [(0, total - 1)]:
+                del d.sessions[sid]
+                parent = d.items[s.parent_id]
+                status, r = d.put_file(parent, s.name, bytes(s.data),
+                                       s.conflict_behavior)
+                return status, {}, r
+            return 202, {}, self._session_json(s)
+
+    def monitor(self, path: str):
+        mid = path.rsplit('/', 1)[-1]
+        # 监视地址不需要token，按复制任务查找驱动器
+        with self.drives_lock:
+            drives = list(self.drives.values())
+        d = next((d for d in drives if mid in d.copies), self.drive)
+        with d.lock:
+            status, body = d.copy_status(mid)
+        return status, {}, body
+
+    def _session_json(self, s: Session) -> dict:
+        missing = []
+        pos = 0
+        for a, b in s.ranges:
+            if a > pos:
+                missing.append('%d-%d' % (pos, a - 1))
+            pos = b + 1
+        if s.size == 0 or pos < s.size:
+            missing.append('%d-' % pos)
+        return {'expirationDateTime': iso_time(s.expiration),
+                'nextExpectedRanges': missing}
+
+
+def merge_ranges(ranges: List[tuple]) -> List[tuple]:
+    result = []
+    for a, b in sorted(ranges):
+        if result and a <= result[-1][1] + 1:
+            result[-1] = (result[-1][0], max(result[-1][1], b))
+        else:
+            result.append((a, b))
+    return result
+
+
+def serve(faults: Faults, conn, session_ttl: float = 3600,
+          quota: int = 1024 ** 4):
+    """
+    在子进程中运行服务器，避免服务器占用的CPU和内存计入上传进程
+    :param faults: 注入的故障
+    :param conn: multiprocessing.Pipe的一端，启动后发送graph_url，收到任意消息后停止
+    :param session_ttl: 上传会话的有效期(秒)
+    :param quota: 每个驱动器的总空间(字节)
+    """
+    srv = MockGraphServer(faults, session_ttl=session_ttl,
+                          quota=quota).start()
+    conn.send(srv.graph_url)
+    conn.recv()
+    srv.stop()
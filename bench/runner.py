@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import dataclasses
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # Windows没有resource模块，不统计内存峰值
+    resource = None
+
+import requests
+
+import app_config
+from bench.mock_graph import Faults, serve
+from utils import color_print
+
+MB = 1024 * 1024
+
+
+@dataclasses.dataclass
+class Scenario:
+    name: str
+    description: str
+    # 每个文件的大小
+    sizes: List[int]
+    faults: Faults = dataclasses.field(default_factory=Faults)
+    # 大于0时，上传这么多个分片后停止，再重新上传一次，测试断点续传
+    interrupt_after: int = 0
+    workers: int = app_config.UPLOAD_WORKERS
+
+
+def default_scenarios(huge_size: int = 256 * MB,
+                      small_count: int = 1000) -> List[Scenario]:
+    """
+    :param huge_size: 大文件的字节数
+    :param small_count: 小文件的数量
+    """
+    rnd = random.Random(0)
+    small = [rnd.randint(1024, 64 * 1024) for _ in range(small_count)]
+    return [
+        Scenario('huge_file', '单个大文件', [huge_size]),
+        Scenario('small_files', '大量小文件', small),
+        Scenario('parallel_large', '8个大文件同时上传', [huge_size // 4] * 8,
+                 workers=8),
+        Scenario('resume', '上传2个分片后停止，再断点续传', [huge_size // 2],
+                 interrupt_after=2),
+        Scenario('high_latency', '每个请求延迟100ms，单连接带宽20MB/s',
+                 [8 * MB] * 16 + small[:200],
+                 Faults(latency=0.1, bandwidth=20 * MB)),
+        Scenario('flaky', '随机返回500/429和断开连接',
+                 [16 * MB] * 8 + small[:200],
+                 Faults(error_rate=0.02, throttle_rate=0.02, drop_rate=0.01,
+                        retry_after=1)),
+    ]
+
+
+def make_files(root: str, sizes: List[int], seed: int = 0):
+    """
+    生成测试文件，每个目录最多100个文件。分块写入随机数据，避免占用大量内存
+    """
+    shutil.rmtree(root, ignore_errors=True)
+    rnd = random.Random(seed)
+    block = rnd.randbytes(MB)
+    for i, size in enumerate(sizes):
+        d = os.path.join(root, 'd%d' % (i // 100))
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, 'f%d.bin' % i), 'wb') as f:
+            # 每个文件的开头不同，其余部分循环写入同一块随机数据
+            f.write(i.to_bytes(8, 'little'))
+            left = size - 8
+            while left > 0:
+                n = min(left, len(block))
+                f.write(block[:n])
+                left -= n
+
+
+class StaticAuth:
+    """
+    固定返回一个账号和token，代替MSALAuth
+    """
+
+    class oauth_settings:
+        scopes = []
+
+    account = {'username': 'bench@localhost', 'home_account_id': 'bench'}
+
+    def get_accounts(self, username: Optional[str] = None):
+        return [self.account]
+
+    def acquire_token_silent_with_error(self, scopes, account,
+                                        force_refresh=False):
+        return {'access_token': 'bench', 'expires_in': 3600}
+
+    def locked(self):
+        return contextlib.nullcontext()
+
+    def reload_token(self):
+        pass
+
+    def save_token(self):
+        pass
+
+
+class RequestRecorder:
+    """
+    记录经过Transport的每个请求的用时，带Content-Range的PUT请求视为上传分片
+    """
+
+    def __init__(self, transport):
+        self._request = transport.request
+        self._lock = threading.Lock()
+        self.chunk_latency: List[float] = []
+        self.request_latency: List[float] = []
+        self.chunks = 0
+        # 每上传一个分片后调用，参数为已上传的分片数
+        self.on_chunk = None
+        transport.request = self.request
+
+    def request(self, method, url, **kwargs):
+        start = time.perf_counter()
+        resp = self._request(method, url, **kwargs)
+        spend = time.perf_counter() - start
+        is_chunk = 'Content-Range' in (kwargs.get('headers') or {})
+        with self._lock:
+            if is_chunk:
+                self.chunk_latency.append(spend)
+                self.chunks += 1
+                chunks = self.chunks
+            else:
+                self.request_latency.append(spend)
+        if is_chunk and self.on_chunk is not None:
+            self.on_chunk(chunks)
+        return resp
+
+
+def percentiles(values: List[float]) -> dict:
+    """
+    :return: 请求数和毫秒为单位的 p50, p90, p99, max
+    """
+    values = sorted(values)
+    result = {'count': len(values)}
+    for name, p in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)):
+        if values:
+            k = max(int(len(values) * p / 100 + 0.5) - 1, 0)
+            result[name] = round(values[min(k, len(values) - 1)] * 1000, 2)
+        else:
+            result[name] = None
+    return result
+
+
+def peak_rss() -> Optional[float]:
+    """
+    :return: 当前进程的内存峰值(MB)
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS单位为字节，Linux为KB
+    return round(rss / MB if sys.platform == 'darwin' else rss / 1024, 1)
+
+
+def run_client(scenario: Scenario, graph_url: str, work_dir: str,
+               verbose: bool, conn):
+    """
+    上传进程，使用真实的UploadHelper上传测试文件，结果通过conn发送
+    """
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    from graph import drive_api
+    from helpers.checkpoint_store import CheckpointStore
+    from helpers.remote_tree import RemoteTree
+    from helpers.upload_helper import UploadHelper
+    from helpers.upload_index import UploadIndex
+    from utils.buffer_pool import BUFFERS_PER_UPLOAD, buffer_pool
+
+    drive_api.GRAPH_URL = graph_url
+    drive_api.BASE_URL = graph_url + '/me/drive'
+    app_config.CACHE_DIR = os.path.join(work_dir, 'cache')
+    os.makedirs(app_config.CACHE_DIR, exist_ok=True)
+    buffer_pool.configure(app_config.UPLOAD_BUFFER_SIZE * 1024,
+                          app_config.UPLOAD_BUFFER_COUNT,
+                          scenario.workers * (BUFFERS_PER_UPLOAD
+                                              + app_config.UPLOAD_READ_AHEAD))
+    recorder = RequestRecorder(drive_api.transport)
+    upload_index = UploadIndex(os.path.join(work_dir, 'upload-index.db'))
+    remote_tree = RemoteTree(os.path.join(work_dir, 'remote-tree.db'))
+    checkpoints = CheckpointStore(os.path.join(work_dir, 'checkpoints.db'))
+
+    def helper():
+        return UploadHelper(StaticAuth(), upload_index, 'rename', remote_tree,
+                            checkpoints)
+
+    src = os.path.join(work_dir, 'src')
+    cpu_start = time.process_time()
+    start = time.time()
+    first = helper()
+    if scenario.interrupt_after > 0:
+        # 上传指定数量的分片后停止，之后的分片由第二次上传续传
+        recorder.on_chunk = lambda n: n >= scenario.interrupt_after \
+            and first.stop_event.set()
+        results = first.upload_dir(src, '/bench', workers=scenario.workers)
+        recorder.on_chunk = None
+        # 第一次已上传完成的文件在第二次上传时被跳过
+        results = [r for r in results if r.status == 'finished'] + \
+            helper().upload_dir(src, '/bench', workers=scenario.workers)
+    else:
+        results = first.upload_dir(src, '/bench', workers=scenario.workers)
+    wall_time = time.time() - start
+    cpu_time = time.process_time() - cpu_start
+
+    total = sum(scenario.sizes)
+    conn.send({
+        'files': len(scenario.sizes),
+        'bytes': total,
+        'finished': sum(1 for r in results if r.status == 'finished'),
+        'failed': sum(1 for r in results if r.status == 'error'),
+        'wall_time': round(wall_time, 3),
+        'throughput_mb_s': round(total / MB / wall_time, 2),
+        'files_per_s': round(len(scenario.sizes) / wall_time, 2),
+        'chunk_latency_ms': percentiles(recorder.chunk_latency),
+        'request_latency_ms': percentiles(recorder.request_latency),
+        'cpu_time': round(cpu_time, 3),
+        'cpu_s_per_gb': round(cpu_time / (total / 1024 ** 3), 3),
+        'peak_rss_mb': peak_rss(),
+    })
+
+
+def run_scenario(scenario: Scenario, work_dir: str,
+                 verbose: bool = False) -> dict:
+    """
+    在独立的进程中运行模拟服务器和上传，使CPU和内存统计只包含上传进程
+    :param scenario: 测试场景
+    :param work_dir: 测试文件、缓存和索引所在的目录，会被清空
+    :param verbose: 是否显示上传过程的输出
+    """
+    shutil.rmtree(work_dir, ignore_errors=True)
+    make_files(os.path.join(work_dir, 'src'), scenario.sizes)
+
+    ctx = multiprocessing.get_context('spawn')
+    server_conn, server_child = ctx.Pipe()
+    server = ctx.Process(target=serve, args=(scenario.faults, server_child),
+                         daemon=True)
+    server.start()
+    graph_url = server_conn.recv()
+    try:
+        client_conn, client_child = ctx.Pipe()
+        client = ctx.Process(target=run_client,
+                             args=(scenario, graph_url, work_dir, verbose,
+                                   client_child))
+        client.start()
+        client.join()
+        if not client_conn.poll():
+            raise Exception('scenario %s exited with code %s' % (
+                scenario.name, client.exitcode))
+        result = client_conn.recv()
+        result['server'] = server_stats(graph_url)
+    finally:
+        server_conn.send('stop')
+        server.join()
+    result['description'] = scenario.description
+    return result
+
+
+def server_stats(graph_url: str) -> dict:
+    return requests.get(graph_url.rsplit('/', 1)[0] + '/_mock/stats').json()
+
+
+def run(scenarios: List[Scenario], work_dir: str,
+        verbose: bool = False) -> dict:
+    """
+    :return: 可以保存为JSON的测试结果，包含版本和配置信息
+    """
+    results: Dict[str, dict] = {}
+    for scenario in scenarios:
+        print('运行 %s: %s' % (scenario.name, scenario.description))
+        results[scenario.name] = run_scenario(
+            scenario, os.path.join(work_dir, scenario.name), verbose)
+        r = results[scenario.name]
+        print('  %.2f MB/s, 完成 %d/%d, 分片p50 %sms, CPU %ss/GB, 内存峰值 %sMB'
+              % (r['throughput_mb_s'], r['finished'], r['files'],
+                 r['chunk_latency_ms']['p50'] or '-', r['cpu_s_per_gb'],
+                 r['peak_rss_mb'] or '-'))
+    return {
+        'version': git_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'UPLOAD_CHUNK_SIZE': app_config.UPLOAD_CHUNK_SIZE,
+            'UPLOAD_ADAPTIVE_CHUNK': app_config.UPLOAD_ADAPTIVE_CHUNK,
+            'UPLOAD_READ_AHEAD': app_config.UPLOAD_READ_AHEAD,
+            'UPLOAD_BUFFER_SIZE': app_config.UPLOAD_BUFFER_SIZE,
+            'UPLOAD_BUFFER_COUNT': app_config.UPLOAD_BUFFER_COUNT,
+            'UPLOAD_WORKERS': app_config.UPLOAD_WORKERS,
+            'UPLOAD_BATCH': app_config.UPLOAD_BATCH,
+            'THROTTLE_MAX_INFLIGHT': app_config.THROTTLE_MAX_INFLIGHT,
+        },
+        'scenarios': results,
+    }
+
+
+def git_version() -> str:
+    with contextlib.suppress(Exception):
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=app_config.WORK_DIR, capture_output=True, text=True,
+            check=True).stdout.strip()
+    return 'unknown'
+
+
+# 比较时关注的指标，True表示越大越好
+COMPARE_METRICS = [
+    ('throughput_mb_s', True),
+    ('files_per_s', True),
+    ('cpu_s_per_gb', False),
+    ('peak_rss_mb', False),
+]
+
+
+def compare(baseline: dict, current: dict) -> List[str]:
+    """
+    比较两次测试结果
+    :return: 每个场景每个指标一行，变化超过5%的行带颜色
+    """
+    lines = []
+    for name, cur in current['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        for metric, higher_better in COMPARE_METRICS:
+            old, new = base.get(metric), cur.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            line = '%-14s %-16s %10.2f -> %10.2f  %+.1f%%' % (
+                name, metric, old, new, change * 100)
+            if abs(change) > 0.05:
+                better = (change > 0) == higher_better
+                line = color_print.gs(line) if better else color_print.rs(line)
+            lines.append(line)
+    return lines
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import tempfile
+
+from bench import runner
+
+
+def operations(args):
+    scenarios = runner.default_scenarios(args.huge_size * runner.MB,
+                                         args.small_count)
+    if args.scenario:
+        scenarios = [s for s in scenarios if s.name in args.scenario]
+    work_dir = args.work_dir or os.path.join(tempfile.gettempdir(),
+                                             'onedrive-uploader-bench')
+    result = runner.run(scenarios, work_dir, args.verbose)
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(result, f, indent=2, sort_keys=True, ensure_ascii=False)
+    print('结果已保存到 %s' % args.output)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf8') as f:
+            baseline = json.load(f)
+        print('与 %s (%s) 比较:' % (args.compare, baseline.get('version')))
+        for line in runner.compare(baseline, result):
+            print(line)
+
+
+parser = argparse.ArgumentParser(
+    description='Offline upload benchmark against a local mock Graph server')
+
+parser.add_argument('-s', '--scenario', action='append',
+                    choices=[s.name for s in runner.default_scenarios(0, 0)],
+                    help='scenario to run, can be repeated, default all')
+parser.add_argument('-o', '--output', default='bench-result.json',
+                    help='write the results as JSON to this file, '
+                         'default bench-result.json')
+parser.add_argument('-c', '--compare',
+                    help='compare the results with a previous JSON file')
+parser.add_argument('--huge-size', type=int, default=256,
+                    help='size of the huge file in MB, default 256')
+parser.add_argument('--small-count', type=int, default=1000,
+                    help='number of small files, default 1000')
+parser.add_argument('--work-dir',
+                    help='directory for the generated files, default a '
+                         'directory in the system temp dir')
+parser.add_argument('-v', '--verbose', action='store_true',
+                    help='show the output of the uploads')
+parser.set_defaults(func=operations)
+
+# 场景在子进程中运行，子进程导入本模块时不能再次执行
+if __name__ == '__main__':
+    cmd_args = parser.parse_args()
+    cmd_args.func(cmd_args)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import os
+import signal
+
+import app_config
+from helpers.daemon_client import daemon_address, request
+from utils import color_print
+
+
+def start(args):
+    # 只有守护进程需要MSAL和上传相关的模块
+    from graph.auth import MSALAuth, OAuthSettings
+    from helpers.upload_daemon import UploadDaemon
+    from utils.bandwidth import limiter
+    from utils.buffer_pool import BUFFERS_PER_UPLOAD, buffer_pool
+
+    buffer_pool.configure(
+        app_config.UPLOAD_BUFFER_SIZE * 1024, app_config.UPLOAD_BUFFER_COUNT,
+        args.jobs * app_config.UPLOAD_WORKERS
+        * (BUFFERS_PER_UPLOAD + app_config.UPLOAD_READ_AHEAD))
+    try:
+        limiter.configure(args.limit_rate, app_config.BANDWIDTH_CONTROL_FILE)
+    except ValueError as e:
+        parser.error('invalid --limit-rate: %s' % e)
+    msal_auth = MSALAuth(
+        OAuthSettings(app_id=os.getenv('APP_ID'),
+                      app_secret=os.getenv('APP_SECRET'),
+                      redirect=os.getenv('REDIRECT_URL')),
+        serialized_token_file=app_config.SERIALIZED_TOKEN,
+        metadata_cache_file=app_config.AUTHORITY_METADATA_CACHE,
+        metadata_ttl=app_config.AUTHORITY_METADATA_TTL)
+    watches = [(os.path.abspath(local_dir), one_dir, {'user': args.user})
+               for local_dir, one_dir in args.watch or []]
+    daemon = UploadDaemon(msal_auth, daemon_address(), workers=args.jobs,
+                          watches=watches)
+
+    def stop_handler(signum, frame):
+        daemon.stop_event.set()
+
+    signal.signal(signal.SIGINT, stop_handler)
+    signal.signal(signal.SIGTERM, stop_handler)
+    daemon.run()
+
+
+def print_job(job: dict):
+    result = job['result']
+    line = '%5d  %-9s  %s  %s -> %s' % (
+        job['id'], job['status'],
+        datetime.datetime.fromtimestamp(job['submit_time']).strftime(
+            '%Y-%m-%d %H:%M:%S'),
+        job['local_path'], job['one_dir'])
+    if result:
+        line += '  完成: %d, 失败: %d, 停止: %d' % (
+            result['finished'], result['error'], result['stopped'])
+        if result.get('saved'):
+            line += ', 服务器复制 %.1fM' % (result['saved'] / 1024 / 1024)
+    if job['error']:
+        line += '  ' + job['error']
+    if job['status'] in ('error', 'cancelled'):
+        color_print.r(line)
+    elif job['status'] == 'finished':
+        color_print.g(line)
+    else:
+        print(line)
+
+
+def operations(args):
+    if args.start:
+        start(args)
+    elif args.stop:
+        request('stop')
+        color_print.b('上传守护进程正在停止')
+    elif args.list:
+        for job in reversed(request('list', status=args.status_filter,
+                                    limit=args.limit)['jobs']):
+            print_job(job)
+    elif args.status is not None:
+        print_job(request('status', id=args.status)['job'])
+    elif args.pause is not None:
+        print_job(request('pause', id=args.pause)['job'])
+    elif args.cancel is not None:
+        print_job(request('cancel', id=args.cancel)['job'])
+    elif args.resume is not None:
+        print_job(request('resume', id=args.resume)['job'])
+
+
+parser = argparse.ArgumentParser(description='Onedrive upload daemon')
+
+group = parser.add_mutually_exclusive_group(required=True)
+group.add_argument('--start', action='store_true',
+                   help='run the upload daemon in the foreground')
+group.add_argument('--stop', action='store_true',
+                   help='stop the running daemon, running jobs are resumed '
+                        'when it starts again')
+group.add_argument('-l', '--list', action='store_true', help='list jobs')
+group.add_argument('-s', '--status', type=int, metavar='ID',
+                   help='show a job')
+group.add_argument('-p', '--pause', type=int, metavar='ID',
+                   help='pause a queued or running job')
+group.add_argument('-c', '--cancel', type=int, metavar='ID',
+                   help='cancel a job and discard its unfinished uploads')
+group.add_argument('-r', '--resume', type=int, metavar='ID',
+                   help='queue a paused, failed or cancelled job again')
+
+parser.add_argument('--watch', nargs=2, action='append',
+                    metavar=('DIR', 'ONE_DIR'),
+                    help='with --start, upload new and changed files of DIR '
+                         'to ONE_DIR, can be given several times')
+parser.add_argument('-u', '--user',
+                    help='with --watch, the Onedrive user, default the first '
+                         'one')
+parser.add_argument('-j', '--jobs', type=int, default=app_config.DAEMON_JOBS,
+                    help='with --start, number of jobs run at the same time, '
+                         'default %d' % app_config.DAEMON_JOBS)
+parser.add_argument('--limit-rate', metavar='PROFILE',
+                    default=app_config.BANDWIDTH_LIMIT,
+                    help='with --start, upload bandwidth limit, see upload.py')
+parser.add_argument('--status-filter', metavar='STATUS',
+                    choices=['queued', 'running', 'paused', 'finished',
+                             'error', 'cancelled'],
+                    help='with --list, only list jobs in this status')
+parser.add_argument('--limit', type=int, default=50,
+                    help='with --list, number of recent jobs, default 50')
+
+parser.set_defaults(func=operations)
+
+# 导入本模块时（例如测试）不解析命令行参数
+if __name__ == '__main__':
+    cmd_args = parser.parse_args()
+    cmd_args.func(cmd_args)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import json as json_lib
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+from graph import drive_api
+from graph.drive_api import item_path
+from graph.throttle import THROTTLE_STATUS, ThrottleController, retry_after
+from utils import color_print
+from utils.telemetry import telemetry
+
+
+def import_aiohttp():
+    """
+    aiohttp只在使用asyncio上传时需要，不在requirements.txt中
+    """
+    try:
+        import aiohttp
+    except ImportError:
+        raise Exception('the async engine requires aiohttp, '
+                        'install it with: pip install aiohttp')
+    return aiohttp
+
+
+class Response:
+    """
+    已读取响应体的HTTP响应，接口与requests.Response相同的部分：status_code, headers, text, json()
+    """
+
+    def __init__(self, status_code: int, headers, content: bytes,
+                 elapsed: float):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        # 发送请求到读取完响应的时间（秒）
+        self.elapsed = elapsed
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf8', errors='replace')
+
+    def json(self):
+        return json_lib.loads(self.content or b'{}')
+
+
+class AsyncTransport:
+    """
+    asyncio上传使用的HTTP传输层，所有主机共用一个aiohttp.ClientSession，保持长连接。
+    只能在创建它的事件循环中使用
+    """
+
+    def __init__(self, limit: int = 100):
+        """
+        :param limit: 同时打开的连接数上限
+        """
+        self.limit = limit
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            aiohttp = import_aiohttp()
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                # 上传大分片可能需要较长时间，只限制连接和读取的超时
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=30,
+                                              sock_read=300))
+        return self._session
+
+    async def request(self, method: str, url: str, **kwargs) -> Response:
+        start = time.perf_counter()
+        async with self._get_session().request(method, url, **kwargs) as r:
+            content = await r.read()
+            return Response(r.status, r.headers, content,
+                            time.perf_counter() - start)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncThrottle:
+    """
+    在事件循环中使用账号的ThrottleController：限流暂停和同时进行的请求数都占用控制器本身的计数，
+    与阻塞上传共享，等待时不阻塞事件循环
+    """
+
+    def __init__(self, controller: ThrottleController):
+        self.controller = controller
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            woken = loop.create_future()
+            if self.controller.try_acquire(
+                    lambda: self._wake(loop, woken)):
+                break
+            # 等待其他请求释放并发数；账号被限流时最多等到暂停结束
+            await asyncio.wait([woken],
+                               timeout=self.controller.paused_for() or None)
+        try:
+            yield
+        finally:
+            self.controller.release()
+
+    @staticmethod
+    def _wake(loop: asyncio.AbstractEventLoop, woken: asyncio.Future):
+        def set_result():
+            if not woken.done():
+                woken.set_result(None)
+
+        with contextlib.suppress(RuntimeError):
+            # 事件循环已关闭时不需要唤醒
+            loop.call_soon_threadsafe(set_result)
+
+
+def network_errors() -> tuple:
+    return import_aiohttp().ClientError, asyncio.TimeoutError
+
+
+async def put_content(transport: AsyncTransport,
+                      access_token: str,
+                      onedrive_item_path: str,
+                      local_file_data,
+                      throttle: AsyncThrottle,
+                      conflict_behavior: str = 'rename',
+                      parent_id: str = '') -> Response:
+    url = '{}/{}/content?@microsoft.graph.conflictBehavior={}'.format(
+        drive_api.BASE_URL, item_path(onedrive_item_path, parent_id),
+        conflict_behavior)
+    headers = {
+        'Authorization': 'Bearer {0}'.format(access_token),
+        # 请求体可能是分块发送的异步迭代，指定长度以免使用chunked编码
+        'Content-Length': str(len(local_file_data)),
+    }
+    return await request_retry(transport, 'PUT', url, throttle,
+                               headers=headers, data=local_file_data)
+
+
+async def create_upload_session(transport: AsyncTransport,
+                                access_token: str,
+                                filename: str,
+                                onedrive_item_path: str,
+                                throttle: AsyncThrottle,
+                                conflict_behavior: str = 'rename',
+                                parent_id: str = '') -> Response:
+    url = '{}/{}/createUploadSession'.format(
+        drive_api.BASE_URL, item_path(onedrive_item_path, parent_id))
+    headers = {
+        'Authorization': 'Bearer {0}'.format(access_token),
+    }
+    data = {
+        '@microsoft.graph.conflictBehavior': conflict_behavior,
+        'name': filename
+    }
+    return await request_retry(transport, 'POST', url, throttle,
+                               headers=headers, json=data)
+
+
+async def get_upload_session(transport: AsyncTransport,
+                             upload_url: str,
+                             throttle: AsyncThrottle) -> Response:
+    return await request_retry(transport, 'GET', upload_url, throttle)
+
+
+async def put_upload_range(transport: AsyncTransport,
+                           upload_url: str,
+                           headers: dict,
+                           data) -> Response:
+    """
+    上传会话的分片请求。不重试，由调用者根据响应决定如何处理
+    """
+    return await transport.request('PUT', upload_url, headers=headers,
+                                   data=data)
+
+
+async def request_retry(transport: AsyncTransport,
+                        method: str,
+                        url: str,
+                        throttle: AsyncThrottle,
+                        **kwargs) -> Response:
+    """
+    与drive_api.request_retry相同，等待时不阻塞事件循环
+    """
+    retry_cnt = 1
+    throttled = 0
+    backoff_time = 0
+    start = time.perf_counter()
+    while True:
+        try:
+            async with throttle.slot():
+                resp = await transport.request(method, url, **kwargs)
+        except network_errors() as e:
+            color_print.y(str(e) or type(e).__name__)
+            delay = min(2 ** retry_cnt, 60)
+            color_print.y('第%d次重试，%ds后重试' % (retry_cnt, delay))
+            await asyncio.sleep(delay)
+            retry_cnt += 1
+            backoff_time += delay
+            continue
+
+        if resp.status_code in THROTTLE_STATUS:
+            delay = backoff_throttled(resp, retry_cnt, throttle)
+            color_print.y('请求被限流(%d)，%ds后重试' % (resp.status_code, delay))
+            retry_cnt += 1
+            throttled += 1
+            backoff_time += delay
+            continue
+
+        throttle.controller.on_success()
+        telemetry.record('request',
+                         method=method,
+                         host=urlsplit(url).netloc,
+                         status=resp.status_code,
+                         spend_time=time.perf_counter() - start,
+                         retries=retry_cnt - 1 - throttled,
+                         throttled=throttled,
+                         backoff_time=backoff_time)
+        return resp
+
+
+def backoff_throttled(resp: Response, retry_cnt: int,
+                      throttle: AsyncThrottle) -> float:
+    """
+    暂停该账号的所有请求，之后的请求在throttle.slot()中等待
+    :return: 等待的秒数
+    """
+    delay = retry_after(resp.headers, min(2 ** retry_cnt, 60))
+    throttle.controller.on_throttle(delay)
+    return delay
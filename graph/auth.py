@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
+import contextlib
 import json
 import os
+import threading
 from dataclasses import dataclass, field
 from typing import List
 
 import msal
 
+from graph.metadata_cache import MetadataCachingSession
 from utils import color_print
+from utils.file_lock import atomic_write, file_lock
 
 
 @dataclass
@@ -21,19 +25,38 @@ class OAuthSettings:
 
 class MSALAuth(msal.ConfidentialClientApplication):
     def __init__(self, oauth_settings: OAuthSettings,
-                 serialized_token_file=None):
+                 serialized_token_file=None,
+                 metadata_cache_file=None,
+                 metadata_ttl: float = 24 * 3600):
+        """
+        :param oauth_settings: 应用的设置
+        :param serialized_token_file: token保存路径
+        :param metadata_cache_file: authority元数据的缓存路径，为None时每次创建都请求
+        :param metadata_ttl: authority元数据缓存的有效时间（秒）
+        """
         self.oauth_settings = oauth_settings
         self.serialized_token_file = serialized_token_file
         self.token_cache = msal.SerializableTokenCache()
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        # 上次读取或写入时token文件的inode和修改时间，用于判断是否被其他进程修改。
+        # 文件每次写入时被替换，inode随之变化
+        self._token_stat = None
 
         serialized_token = self.load_token()
         if serialized_token:
             self.token_cache.deserialize(serialized_token)
 
+        http_client = None
+        if metadata_cache_file:
+            # 创建应用时MSAL会请求authority的OpenID配置，缓存后不需要访问网络
+            http_client = MetadataCachingSession(metadata_cache_file,
+                                                 metadata_ttl)
         super().__init__(client_id=oauth_settings.app_id,
                          client_credential=oauth_settings.app_secret,
                          authority=oauth_settings.authority,
-                         token_cache=self.token_cache)
+                         token_cache=self.token_cache,
+                         http_client=http_client)
 
     def initiate_auth_code_flow(
             self,
@@ -59,6 +82,7 @@ class MSALAuth(msal.ConfidentialClientApplication):
         # 文件是否存在
         if not os.path.isfile(self.serialized_token_file):
             return None
+        self._token_stat = self._stat_token()
         with open(self.serialized_token_file, 'r', encoding='utf8') as f:
             serialized_token = f.read()
 
@@ -70,11 +94,43 @@ class MSALAuth(msal.ConfidentialClientApplication):
             return None
         return serialized_token
 
+    def reload_token(self):
+        """
+        token文件被其他进程修改后重新读取，应在locked()内调用
+        """
+        if not self.serialized_token_file \
+                or not os.path.isfile(self.serialized_token_file) \
+                or self._stat_token() == self._token_stat:
+            return
+        serialized_token = self.load_token()
+        if serialized_token:
+            self.token_cache.deserialize(serialized_token)
+
     def save_token(self):
         if self.serialized_token_file and self.token_cache.has_state_changed:
             try:
-                with open(self.serialized_token_file, 'w',
-                          encoding='utf8') as f:
-                    f.write(self.token_cache.serialize())
+                with self.locked():
+                    atomic_write(self.serialized_token_file,
+                                 self.token_cache.serialize())
+                    self._token_stat = self._stat_token()
             except PermissionError as e:
                 color_print.r(str(e))
+
+    def _stat_token(self):
+        st = os.stat(self.serialized_token_file)
+        return st.st_ino, st.st_mtime_ns
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        同时只有一个线程或进程读写token文件和刷新token
+        """
+        with self._lock, contextlib.ExitStack() as stack:
+            # 可以嵌套调用，只在最外层锁定文件
+            if self.serialized_token_file and self._lock_depth == 0:
+                stack.enter_context(file_lock(self.serialized_token_file))
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
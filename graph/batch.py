@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import base64
+import dataclasses
+import json
+import time
+from typing import Any, Callable, List, Optional
+
+from graph import drive_api
+from graph.throttle import THROTTLE_STATUS, ThrottleController, retry_after
+from utils import color_print
+from utils.bandwidth import request_body
+from utils.buffer_pool import FileSlice, JoinedBody
+
+# 一个$batch请求最多包含20个请求
+MAX_BATCH_SIZE = 20
+# $batch请求体不能超过4MB，二进制内容经过base64编码后体积增大1/3
+MAX_BATCH_PAYLOAD = 3 * 1024 * 1024
+# 请求体中文件内容的占位符，发送时替换为文件内容的base64编码。路径中不会出现NUL
+BODY_PLACEHOLDER = '\0'
+
+
+@dataclasses.dataclass
+class BatchRequest:
+    method: str
+    # 相对于GRAPH_URL的路径，例如 /me/drive/root:/a.txt:/content
+    url: str
+    # dict以json格式发送，bytes和FileSlice以base64编码发送
+    body: Any = None
+    headers: Optional[dict] = None
+    # 以下为响应结果
+    status: int = 0
+    response: Any = None
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def error(self) -> str:
+        if isinstance(self.response, dict) and 'error' in self.response:
+            return str(self.response['error'])
+        return 'status %d' % self.status
+
+    def to_json(self, request_id: str) -> dict:
+        r = {'id': request_id, 'method': self.method, 'url': self.url}
+        headers = dict(self.headers or {})
+        if isinstance(self.body, bytes):
+            headers.setdefault('Content-Type', 'application/octet-stream')
+            r['body'] = base64.b64encode(self.body).decode('ascii')
+        elif isinstance(self.body, FileSlice):
+            headers.setdefault('Content-Type', 'application/octet-stream')
+            r['body'] = BODY_PLACEHOLDER
+        elif self.body is not None:
+            headers.setdefault('Content-Type', 'application/json')
+            r['body'] = self.body
+        if headers:
+            r['headers'] = headers
+        return r
+
+
+def send_batch(access_token: str,
+               batch: List[BatchRequest],
+               throttle: Optional[ThrottleController] = None,
+               max_retries: int = 5) -> List[BatchRequest]:
+    """
+    使用$batch发送一组请求。被限流或服务器错误的请求会单独重试，其余请求的结果直接保存
+    :param access_token: access token
+    :param batch: 最多MAX_BATCH_SIZE个请求
+    :param throttle: 账号的限流控制器
+    :param max_retries: 单个请求的最大重试次数
+    :return: batch本身，每个请求的status和response已设置
+    """
+    if len(batch) > MAX_BATCH_SIZE:
+        raise ValueError('at most %d requests in a batch' % MAX_BATCH_SIZE)
+
+    url = drive_api.GRAPH_URL + '/$batch'
+    headers = {
+        'Authorization': 'Bearer {0}'.format(access_token),
+        'Content-Type': 'application/json',
+    }
+    pending = list(batch)
+    retry_cnt = 1
+    while pending:
+        # 小文件的内容在请求体中，与分片一样受带宽限制
+        resp = drive_api.request_retry(
+            'POST', url, throttle, headers=headers,
+            data=request_body(batch_body(pending)))
+        resp_json = resp.json()
+        if 'responses' not in resp_json:
+            raise Exception(str(resp_json.get('error')))
+
+        retry = []
+        delay = 0
+        for item in resp_json['responses']:
+            r = pending[int(item['id'])]
+            r.status = int(item.get('status', 0))
+            r.response = item.get('body')
+            # 507: 存储空间不足，重试没有意义
+            if (r.status in THROTTLE_STATUS
+                or (r.status >= 500 and r.status != 507)) \
+                    and retry_cnt <= max_retries:
+                retry.append(r)
+                delay = max(delay, retry_after(item.get('headers') or {},
+                                               min(2 ** retry_cnt, 60)))
+
+        if retry:
+            color_print.y('批量请求中%d个请求失败，%ds后重试' % (len(retry), delay))
+            if throttle:
+                throttle.on_throttle(delay)
+            else:
+                time.sleep(delay)
+            retry_cnt += 1
+        pending = retry
+    return batch
+
+
+def batch_body(batch: List[BatchRequest]) -> JoinedBody:
+    """
+    $batch的请求体。文件内容（FileSlice）在发送时才分块读取并编码为base64，
+    不在内存中生成整个请求体
+    """
+    data = {'requests': [r.to_json(str(i)) for i, r in enumerate(batch)]}
+    pieces = json.dumps(data).split(json.dumps(BODY_PLACEHOLDER))
+    slices = [r.body for r in batch if isinstance(r.body, FileSlice)]
+    parts = [pieces[0].encode('utf8')]
+    for body, piece in zip(slices, pieces[1:]):
+        parts += [b'"', body, ('"' + piece).encode('utf8')]
+    return JoinedBody(parts, encode_base64=True)
+
+
+class BatchSplitter:
+    """
+    依次加入请求，按请求数量和请求体大小分组，不需要事先取得所有请求
+    """
+
+    def __init__(self, payload_size: Callable[[Any], int] = lambda x: 0):
+        """
+        :param payload_size: 计算单个请求的请求体大小
+        """
+        self.payload_size = payload_size
+        self._batch = []
+        self._payload = 0
+
+    def add(self, item) -> Optional[list]:
+        """
+        :return: 加入后已满的一组，没有时为None
+        """
+        size = self.payload_size(item)
+        full = None
+        if self._batch and (len(self._batch) >= MAX_BATCH_SIZE
+                            or self._payload + size > MAX_BATCH_PAYLOAD):
+            full = self.flush()
+        self._batch.append(item)
+        self._payload += size
+        return full
+
+    def flush(self) -> Optional[list]:
+        """
+        :return: 未满的最后一组，没有时为None
+        """
+        batch = self._batch or None
+        self._batch = []
+        self._payload = 0
+        return batch
+
+
+def split_batches(items: list,
+                  payload_size: Callable[[Any], int] = lambda x: 0) -> list:
+    """
+    按请求数量和请求体大小分组
+    :param items: 请求或对应的对象
+    :param payload_size: 计算单个请求的请求体大小
+    """
+    splitter = BatchSplitter(payload_size)
+    batches = [b for b in map(splitter.add, items) if b is not None]
+    last = splitter.flush()
+    if last is not None:
+        batches.append(last)
+    return batches
+
+
+def item_url(onedrive_item_path: str, parent_id: str = '') -> str:
+    return '/me/drive/' + drive_api.item_path(onedrive_item_path, parent_id)
+
+
+def put_content_request(onedrive_item_path: str,
+                        data,
+                        conflict_behavior: str = 'rename',
+                        parent_id: str = '') -> BatchRequest:
+    """
+    :param data: 文件内容，bytes或FileSlice
+    """
+    return BatchRequest(
+        'PUT',
+        item_url(onedrive_item_path, parent_id)
+        + '/content?@microsoft.graph.conflictBehavior=' + conflict_behavior,
+        body=data)
+
+
+def create_folder_request(onedrive_dir_path: str,
+                          parent_id: str = '') -> BatchRequest:
+    """
+    创建文件夹，文件夹已存在时返回409
+    :param parent_id: 父目录的id，指定时使用id寻址
+    """
+    parent, name = onedrive_dir_path.rstrip('/').rsplit('/', 1)
+    url = '/me/drive/items/{}'.format(parent_id) if parent_id \
+        else item_url(parent)
+    return BatchRequest('POST', url + '/children', body={
+        'name': name,
+        'folder': {},
+        '@microsoft.graph.conflictBehavior': 'fail'
+    })
+
@@ -1,42 +1,331 @@
 # -*- coding: utf-8 -*-
+import contextlib
+import threading
 import time
+from typing import Dict, Optional
+from urllib.parse import quote, urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from graph.throttle import THROTTLE_STATUS, ThrottleController, retry_after
 from utils import color_print
+from utils.telemetry import telemetry
 
-BASE_URL = 'https://graph.microsoft.com/v1.0/me/drive'
+GRAPH_URL = 'https://graph.microsoft.com/v1.0'
+BASE_URL = GRAPH_URL + '/me/drive'
+
+
+class Transport:
+    """
+    所有Graph请求共用的HTTP传输层。每个主机（graph.microsoft.com、上传会话的主机等）
+    使用一个Session，保持长连接，避免每次请求都重新建立TCP和TLS连接
+    """
+
+    def __init__(self, pool_size: int = 10):
+        """
+        :param pool_size: 每个主机保持的连接数，应不小于同时进行的请求数
+        """
+        self.pool_size = pool_size
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, pool_size: int):
+        """
+        增加每个主机的连接数，不会减少。守护进程中多个任务共用同一个Transport，
+        已有的Session可能正在被其他任务使用，因此不关闭，只换上新的连接池：
+        正在进行的请求在旧连接池上完成，旧连接池不再被引用后其空闲连接随之关闭
+        """
+        with self._lock:
+            if pool_size <= self.pool_size:
+                return
+            self.pool_size = pool_size
+            for session in self._sessions.values():
+                self._mount(session)
+
+    def _mount(self, session: requests.Session):
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def session(self, url: str) -> requests.Session:
+        host = urlsplit(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                self._mount(session)
+                self._sessions[host] = session
+            return session
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        return self.session(url).request(method, url, **kwargs)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        :return: 每个主机的请求数和新建连接数，两者之差即为复用连接的请求数
+        """
+        result = {}
+        with self._lock:
+            sessions = dict(self._sessions)
+        for host, session in sessions.items():
+            num_requests = num_connections = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+            result[host] = {
+                'requests': num_requests,
+                'connections': num_connections,
+                'reused': max(num_requests - num_connections, 0),
+            }
+        return result
+
+
+transport = Transport()
+
+
+class ResyncRequired(Exception):
+    """
+    delta令牌失效，需要重新完整同步
+    """
+    pass
+
+
+class SessionExpired(Exception):
+    """
+    上传会话已过期或不存在，需要新建会话
+    """
+    pass
+
+
+def item_path(onedrive_item_path: str, parent_id: str = '') -> str:
+    """
+    文件或目录相对于驱动器的地址
+    :param onedrive_item_path: OneDrive路径
+    :param parent_id: 父目录的id，指定时使用id寻址，不需要服务器解析完整路径
+    """
+    onedrive_item_path = onedrive_item_path.rstrip('/')
+    if parent_id:
+        name = onedrive_item_path.rsplit('/', 1)[-1]
+        return 'items/{}:/{}:'.format(parent_id, quote(name))
+    if not onedrive_item_path:
+        return 'root'
+    return 'root:{}:'.format(quote(onedrive_item_path))
 
 
 def put_content(access_token: str,
                 onedrive_item_path: str,
-                local_file_data: bytes, ):
-    url = '{}/root:{}:/content'.format(BASE_URL, onedrive_item_path)
+                local_file_data: bytes,
+                throttle: Optional[ThrottleController] = None,
+                conflict_behavior: str = 'rename',
+                parent_id: str = ''):
+    url = '{}/{}/content?@microsoft.graph.conflictBehavior={}'.format(
+        BASE_URL, item_path(onedrive_item_path, parent_id), conflict_behavior)
     headers = {
         'Authorization': 'Bearer {0}'.format(access_token),
     }
-    return request_retry('PUT', url, headers=headers, data=local_file_data)
+    return request_retry('PUT', url, throttle, headers=headers,
+                         data=local_file_data)
 
 
 def create_upload_session(access_token: str,
                           filename: str,
-                          onedrive_item_path: str):
-    url = '{}/root:{}:/createUploadSession'.format(BASE_URL, onedrive_item_path)
+                          onedrive_item_path: str,
+                          throttle: Optional[ThrottleController] = None,
+                          conflict_behavior: str = 'rename',
+                          parent_id: str = ''):
+    url = '{}/{}/createUploadSession'.format(
+        BASE_URL, item_path(onedrive_item_path, parent_id))
     headers = {
         'Authorization': 'Bearer {0}'.format(access_token),
     }
     data = {
-        '@microsoft.graph.conflictBehavior': 'rename',
+        '@microsoft.graph.conflictBehavior': conflict_behavior,
         'name': filename
     }
-    return request_retry('POST', url, headers=headers, json=data)
+    return request_retry('POST', url, throttle, headers=headers, json=data)
+
+
+def get_item(access_token: str,
+             onedrive_item_path: str,
+             throttle: Optional[ThrottleController] = None):
+    """
+    :return: 文件或目录的信息，不存在时返回None
+    """
+    url = '{}/{}'.format(BASE_URL, item_path(onedrive_item_path))
+    headers = {
+        'Authorization': 'Bearer {0}'.format(access_token),
+    }
+    resp = request_retry('GET', url, throttle, headers=headers)
+    if resp.status_code == 404:
+        return None
+    resp_json = resp.json()
+    if 'id' not in resp_json:
+        raise Exception(str(resp_json.get('error')))
+    return resp_json
 
 
-def request_retry(method, url, **kwargs):
+def list_children(access_token: str,
+                  onedrive_dir_path: str,
+                  throttle: Optional[ThrottleController] = None):
+    """
+    列出OneDrive目录下的所有子项，自动处理分页。目录不存在时没有子项
+    """
+    url = '{}/{}/children'.format(BASE_URL, item_path(onedrive_dir_path))
+    headers = {
+        'Authorization': 'Bearer {0}'.format(access_token),
+    }
+    params = {
+        '$top': 1000,
+        '$select': 'id,name,size,eTag,file,folder,parentReference'
+    }
+    while url:
+        resp = request_retry('GET', url, throttle, headers=headers,
+                             params=params)
+        if resp.status_code == 404:
+            return
+        resp_json = resp.json()
+        if 'value' not in resp_json:
+            raise Exception(str(resp_json.get('error')))
+        yield from resp_json['value']
+        # nextLink已包含查询参数
+        url = resp_json.get('@odata.nextLink')
+        params = None
+
+
+def delta(access_token: str,
+          onedrive_dir_path: str,
+          delta_link: str = '',
+          throttle: Optional[ThrottleController] = None):
+    """
+    获取目录及其所有子项的变化，自动处理分页。没有delta_link时返回所有子项
+    :param delta_link: 上次同步得到的deltaLink
+    :return: 生成器，每页返回 (子项列表, deltaLink)，deltaLink只在最后一页不为None
+    """
+    url = delta_link or '{}/{}/delta'.format(BASE_URL,
+                                             item_path(onedrive_dir_path))
+    headers = {
+        'Authorization': 'Bearer {0}'.format(access_token),
+    }
+    while url:
+        resp = request_retry('GET', url, throttle, headers=headers)
+        if resp.status_code == 410:
+            raise ResyncRequired(resp.text)
+        resp_json = resp.json()
+        if 'value' not in resp_json:
+            raise Exception(str(resp_json.get('error')))
+        yield resp_json['value'], resp_json.get('@odata.deltaLink')
+        url = resp_json.get('@odata.nextLink')
+
+
+def get_drive(access_token: str,
+              throttle: Optional[ThrottleController] = None) -> dict:
+    """
+    :return: 驱动器信息，quota中包含total, used, remaining, state
+    """
+    url = '{}?$select=id,driveType,quota'.format(BASE_URL)
+    headers = {
+        'Authorization': 'Bearer {0}'.format(access_token),
+    }
+    resp_json = request_retry('GET', url, throttle, headers=headers).json()
+    if 'quota' not in resp_json:
+        raise Exception(str(resp_json.get('error')))
+    return resp_json
+
+
+def copy_item(access_token: str,
+              item_id: str,
+              onedrive_item_path: str,
+              drive_id: str = '',
+              parent_id: str = '',
+              conflict_behavior: str = 'rename',
+              throttle: Optional[ThrottleController] = None) -> str:
+    """
+    在服务器上复制文件，复制是异步进行的
+    :param item_id: 被复制的文件的id
+    :param onedrive_item_path: 副本的OneDrive路径
+    :param drive_id: 副本所在驱动器的id
+    :param parent_id: 副本父目录的id，为空时使用路径寻址
+    :return: 查询复制进度的监视地址，见get_copy_status
+    """
+    url = '{}/items/{}/copy?@microsoft.graph.conflictBehavior={}'.format(
+        BASE_URL, item_id, conflict_behavior)
+    headers = {
+        'Authorization': 'Bearer {0}'.format(access_token),
+    }
+    dir_path, _, name = onedrive_item_path.rpartition('/')
+    if parent_id:
+        parent = {'id': parent_id}
+    else:
+        parent = {'path': '/drive/root:' + dir_path}
+    if drive_id:
+        parent['driveId'] = drive_id
+    resp = request_retry('POST', url, throttle, headers=headers,
+                         json={'parentReference': parent, 'name': name})
+    if resp.status_code != 202 or 'Location' not in resp.headers:
+        raise Exception(str(resp.json().get('error')))
+    return resp.headers['Location']
+
+
+def get_copy_status(monitor_url: str) -> dict:
+    """
+    查询复制进度。监视地址不需要token，也不计入账号的限流
+    :return: status为 notStarted, inProgress, completed, failed 等，完成时resourceId为副本的id
+    """
+    resp = request_retry('GET', monitor_url, allow_redirects=False)
+    if resp.status_code == 303:
+        # 完成后可能重定向到副本
+        location = resp.headers.get('Location', '')
+        return {'status': 'completed',
+                'resourceId': location.rstrip('/').rsplit('/', 1)[-1]}
+    resp_json = resp.json()
+    if 'status' not in resp_json:
+        raise Exception(str(resp_json.get('error')))
+    return resp_json
+
+
+def get_upload_session(upload_url: str,
+                       throttle: Optional[ThrottleController] = None):
+    return request_retry('GET', upload_url, throttle)
+
+
+def delete_upload_session(upload_url: str,
+                          throttle: Optional[ThrottleController] = None):
+    """
+    取消上传会话，服务器删除已上传的部分
+    """
+    return request_retry('DELETE', upload_url, throttle)
+
+
+def put_upload_range(upload_url: str, headers: dict, data):
+    """
+    上传会话的分片请求。不重试，由调用者根据响应决定如何处理
+    """
+    return transport.request('PUT', upload_url, headers=headers, data=data)
+
+
+def request_retry(method,
+                  url,
+                  throttle: Optional[ThrottleController] = None,
+                  **kwargs):
+    """
+    发送请求，网络错误时重试；被限流(429/503)时按Retry-After等待后重试
+    :param throttle: 账号的限流控制器，为None时只在本线程内等待
+    """
     retry_cnt = 1
+    throttled = 0
+    backoff_time = 0
+    start = time.perf_counter()
     while True:
         try:
-            return requests.request(method, url, **kwargs)
+            # 等待重试时不占用账号的并发数
+            with throttle.slot() if throttle else contextlib.nullcontext():
+                resp = transport.request(method, url, **kwargs)
         except requests.exceptions.RequestException as e:
             color_print.y(str(e))
             delay = 2 ** retry_cnt
@@ -44,3 +333,41 @@ def request_retry(method, url, **kwargs):
             color_print.y('第%d次重试，%ds后重试' % (retry_cnt, delay))
             time.sleep(delay)
             retry_cnt += 1
+            backoff_time += delay
+            continue
+
+        if resp.status_code in THROTTLE_STATUS:
+            delay = backoff_throttled(resp, retry_cnt, throttle)
+            color_print.y('请求被限流(%d)，%ds后重试' % (resp.status_code, delay))
+            retry_cnt += 1
+            throttled += 1
+            backoff_time += delay
+            continue
+
+        if throttle:
+            throttle.on_success()
+        # 上传会话的url包含临时凭据，只记录主机名
+        telemetry.record('request',
+                         method=method,
+                         host=urlsplit(url).netloc,
+                         status=resp.status_code,
+                         spend_time=time.perf_counter() - start,
+                         retries=retry_cnt - 1 - throttled,
+                         throttled=throttled,
+                         backoff_time=backoff_time)
+        return resp
+
+
+def backoff_throttled(resp: requests.Response,
+                      retry_cnt: int,
+                      throttle: Optional[ThrottleController] = None):
+    """
+    处理被限流的响应。有限流控制器时暂停该账号的所有请求，否则在本线程内等待
+    :return: 等待的秒数
+    """
+    delay = retry_after(resp.headers, min(2 ** retry_cnt, 60))
+    if throttle:
+        throttle.on_throttle(delay)
+    else:
+        time.sleep(delay)
+    return delay
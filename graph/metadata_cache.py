@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+import requests
+
+from utils import color_print
+from utils.file_lock import atomic_write
+
+# MSAL在创建应用和查找账号时请求的元数据，内容很少变化
+METADATA_PATHS = ('/.well-known/openid-configuration',
+                  '/common/discovery/instance')
+
+
+class CachedResponse:
+    """
+    缓存的响应，实现MSAL使用的部分：status_code, text, headers, raise_for_status()
+    """
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        pass
+
+
+class MetadataCachingSession(requests.Session):
+    """
+    传给MSAL的http_client。authority的OpenID配置和实例发现的结果保存在文件中，
+    ttl秒内不再请求，创建MSALAuth不需要访问网络；过期后请求失败时继续使用过期的缓存。
+    其他请求（例如获取token）与MSAL默认的http_client相同
+    """
+
+    def __init__(self, cache_file: str, ttl: float):
+        """
+        :param cache_file: 缓存文件路径
+        :param ttl: 缓存的有效时间（秒）
+        """
+        super().__init__()
+        # 与MSAL默认的http_client相同，失败时重试一次
+        adapter = requests.adapters.HTTPAdapter(max_retries=1)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def get(self, url, params=None, **kwargs):
+        if not urlsplit(url).path.endswith(METADATA_PATHS):
+            return super().get(url, params=params, **kwargs)
+        key = url + ('?' + urlencode(sorted(params.items())) if params else '')
+        entry = self._load().get(key)
+        if entry is not None and time.time() - entry['time'] < self.ttl:
+            return CachedResponse(entry['status'], entry['text'])
+        try:
+            resp = super().get(url, params=params, **kwargs)
+        except requests.RequestException as e:
+            if entry is None:
+                raise e
+            color_print.y('获取%s失败，使用缓存: %s' % (url, e))
+            return CachedResponse(entry['status'], entry['text'])
+        if resp.status_code == 200:
+            self._save(key, {'time': time.time(), 'status': 200,
+                             'text': resp.text})
+        elif entry is not None and resp.status_code >= 500:
+            return CachedResponse(entry['status'], entry['text'])
+        return resp
+
+    def _load(self) -> dict:
+        with self._lock:
+            if self._entries is None:
+                self._entries = {}
+                if os.path.isfile(self.cache_file):
+                    try:
+                        with open(self.cache_file, 'r',
+                                  encoding='utf8') as f:
+                            self._entries = json.load(f)
+                    except (OSError, ValueError) as e:
+                        color_print.y('忽略无效的缓存: %s, %s' % (
+                            self.cache_file, e))
+            return self._entries
+
+    def _save(self, key: str, entry: dict):
+        entries = self._load()
+        with self._lock:
+            entries[key] = entry
+            data = json.dumps(entries, ensure_ascii=False)
+        try:
+            atomic_write(self.cache_file, data)
+        except OSError as e:
+            color_print.y('保存缓存失败: %s, %s' % (self.cache_file, e))
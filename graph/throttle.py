@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import email.utils
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+# 表示被限流的状态码
+THROTTLE_STATUS = (429, 503)
+
+
+class ThrottleController:
+    """
+    同一账号的所有请求共享的限流控制器
+    收到429/503时，按Retry-After暂停该账号的所有请求，并将同时进行的请求数减半；
+    请求成功时逐渐增加同时进行的请求数（AIMD）
+    """
+
+    def __init__(self, max_inflight: int = 16):
+        """
+        :param max_inflight: 同时进行的请求数上限
+        """
+        self.max_inflight = max(max_inflight, 1)
+        self.limit = float(self.max_inflight)
+        self.inflight = 0
+        self.pause_until = 0.0
+        # 统计信息
+        self.throttle_events = 0
+        self.backoff_time = 0.0
+        self._cond = threading.Condition()
+        # 事件循环中等待并发数的请求登记的回调，见try_acquire
+        self._waiters = []
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                if now < self.pause_until:
+                    # 账号被限流，等待暂停结束
+                    self._cond.wait(self.pause_until - now)
+                    self.backoff_time += time.time() - now
+                    continue
+                if self.inflight < int(self.limit):
+                    self.inflight += 1
+                    return
+                self._cond.wait()
+
+    def try_acquire(self, waiter: Optional[Callable[[], None]] = None) -> bool:
+        """
+        不阻塞地占用一个并发数，供事件循环中的请求使用
+        :param waiter: 未能占用时登记的回调，下次释放并发数或限流状态变化时调用一次，
+                       调用发生在释放的线程中，不能阻塞
+        :return: 是否已占用
+        """
+        with self._cond:
+            if (time.time() >= self.pause_until
+                    and self.inflight < int(self.limit)):
+                self.inflight += 1
+                return True
+            if waiter is not None:
+                self._waiters.append(waiter)
+            return False
+
+    def release(self):
+        with self._cond:
+            self.inflight -= 1
+            self._notify()
+
+    def _notify(self):
+        self._cond.notify_all()
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter()
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def paused_for(self) -> float:
+        """
+        :return: 账号因被限流还需暂停的秒数，没有暂停时为0
+        """
+        with self._cond:
+            return max(self.pause_until - time.time(), 0)
+
+    def on_success(self):
+        with self._cond:
+            if self.limit < self.max_inflight:
+                self.limit = min(self.limit + 1 / self.limit,
+                                 self.max_inflight)
+                self._notify()
+
+    def on_throttle(self, retry_after: float):
+        """
+        :param retry_after: 暂停的秒数
+        """
+        with self._cond:
+            self.throttle_events += 1
+            self.limit = max(self.limit / 2, 1.0)
+            self.pause_until = max(self.pause_until, time.time() + retry_after)
+            self._notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'throttle_events': self.throttle_events,
+                'backoff_time': self.backoff_time,
+                'inflight_limit': int(self.limit),
+            }
+
+
+_controllers: Dict[str, ThrottleController] = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(key: str, max_inflight: int = 16) -> ThrottleController:
+    """
+    获取账号对应的限流控制器，同一账号只创建一个
+    :param key: 账号的唯一标识，例如home_account_id
+    :param max_inflight: 首次创建时同时进行的请求数上限
+    """
+    with _controllers_lock:
+        if key not in _controllers:
+            _controllers[key] = ThrottleController(max_inflight)
+        return _controllers[key]
+
+
+def all_controllers() -> Dict[str, ThrottleController]:
+    with _controllers_lock:
+        return dict(_controllers)
+
+
+def retry_after(headers, default: float) -> float:
+    """
+    解析Retry-After响应头，支持秒数和HTTP日期两种格式
+    :param headers: 响应头
+    :param default: 没有Retry-After或无法解析时使用的秒数
+    """
+    value: Optional[str] = headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        dt = email.utils.parsedate_to_datetime(value)
+        return max(dt.timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return default
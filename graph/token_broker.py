@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import app_config
+from graph.auth import MSALAuth
+from utils import color_print
+
+# 内存中的token剩余有效时间少于此秒数时，调用方同步刷新
+MIN_VALID_TIME = 60
+
+
+class TokenBroker:
+    """
+    在内存中按账号保存access token，获取token不需要访问MSAL的缓存和token文件。
+    后台线程在token过期前refresh_before秒刷新；多个线程同时需要刷新同一账号的token时，
+    只有一个线程刷新，其余线程等待结果。
+    刷新时锁定token文件，先读取其他进程保存的token，刷新后写回文件
+    """
+
+    def __init__(self,
+                 msal_auth: MSALAuth,
+                 refresh_before: float = app_config.TOKEN_REFRESH_BEFORE):
+        """
+        :param msal_auth: MSALAuth
+        :param refresh_before: 在过期前多少秒刷新
+        """
+        self.msal_auth = msal_auth
+        self.refresh_before = refresh_before
+        # home_account_id -> (access token, 过期时间, 账号)
+        self._tokens: Dict[str, Tuple[str, float, dict]] = {}
+        # home_account_id -> 正在进行的刷新完成时设置的Event
+        self._refreshing: Dict[str, threading.Event] = {}
+        self._errors: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def access_token(self, account: dict) -> str:
+        """
+        :return: 账号的access token，无法获取时抛出异常
+        """
+        entry = self._tokens.get(account['home_account_id'])
+        if entry is not None and entry[1] - time.time() > MIN_VALID_TIME:
+            return entry[0]
+        return self.refresh(account)
+
+    def refresh(self, account: dict, force: bool = False) -> str:
+        """
+        刷新账号的token。已有线程在刷新时等待它的结果
+        :param force: 是否忽略MSAL缓存中未过期的token
+        """
+        account_id = account['home_account_id']
+        with self._lock:
+            done = self._refreshing.get(account_id)
+            owner = done is None
+            if owner:
+                done = self._refreshing[account_id] = threading.Event()
+        if not owner:
+            done.wait()
+            entry = self._tokens.get(account_id)
+            if entry is None or entry[1] <= time.time():
+                raise Exception(self._errors.get(account_id, 'no token'))
+            return entry[0]
+
+        try:
+            token, expires_at = self._acquire(account, force)
+            self._tokens[account_id] = (token, expires_at, account)
+            self._errors.pop(account_id, None)
+            self._start()
+            return token
+        except Exception as e:
+            self._errors[account_id] = str(e)
+            raise e
+        finally:
+            with self._lock:
+                del self._refreshing[account_id]
+            done.set()
+
+    def _acquire(self, account: dict, force: bool) -> Tuple[str, float]:
+        auth = self.msal_auth
+        scopes = auth.oauth_settings.scopes
+        with auth.locked():
+            auth.reload_token()
+            result = auth.acquire_token_silent_with_error(scopes, account)
+            if force and result and 'access_token' in result \
+                    and result.get('expires_in', 0) <= self.refresh_before:
+                # 其他进程没有刷新过，使用refresh token获取新的token
+                result = auth.acquire_token_silent_with_error(
+                    scopes, account, force_refresh=True)
+            auth.save_token()
+        if not result or 'access_token' not in result:
+            error = result.get('error_description', result.get('error')) \
+                if result else 'no refresh token in cache'
+            raise Exception('failed to acquire token for %s: %s' % (
+                account.get('username'), error))
+        return result['access_token'], \
+            time.time() + int(result.get('expires_in', 0))
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        wait = 0
+        while not self._stop_event.wait(wait):
+            now = time.time()
+            for account_id, (_, expires_at, account) in \
+                    list(self._tokens.items()):
+                if expires_at - now > self.refresh_before:
+                    continue
+                try:
+                    self.refresh(account, force=True)
+                except Exception as e:
+                    # 保留旧的token直到过期，下次循环再试
+                    color_print.y('刷新token失败: %s' % e)
+            # 最多等待60秒，刷新失败时至少等待5秒
+            next_due = min((e[1] - self.refresh_before
+                            for e in self._tokens.values()),
+                           default=now + 60)
+            wait = min(max(next_due - time.time(), 5), 60)
+
+    def close(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
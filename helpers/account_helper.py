@@ -47,9 +47,12 @@ class AccountHelper:
         queries = parse_queries(callback_url)
 
         try:
-            token = self.msal_auth.acquire_token_by_auth_code_flow(auth_flow,
-                                                                   queries)
-            self.msal_auth.save_token()
+            with self.msal_auth.locked():
+                # 先读取其他进程刷新后保存的token，避免被覆盖
+                self.msal_auth.reload_token()
+                token = self.msal_auth.acquire_token_by_auth_code_flow(
+                    auth_flow, queries)
+                self.msal_auth.save_token()
             if 'error' in token:
                 color_print.r(token)
                 color_print.r(
@@ -91,8 +94,10 @@ class AccountHelper:
             flag = 'n'
 
         if flag.lower() == 'y':
-            for num in nums:
-                self.msal_auth.remove_account(accounts[num - 1])
+            with self.msal_auth.locked():
+                self.msal_auth.reload_token()
+                for num in nums:
+                    self.msal_auth.remove_account(accounts[num - 1])
                 self.msal_auth.save_token()
             color_print.g(
                 '用户删除成功. 当前用户数: %d' % len(self.msal_auth.get_accounts()))
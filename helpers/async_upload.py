@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import dataclasses
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List
+
+import app_config
+from graph import async_drive_api
+from graph.async_drive_api import AsyncThrottle, AsyncTransport
+from graph.drive_api import SessionExpired
+from graph.throttle import THROTTLE_STATUS, get_controller
+from helpers.upload_helper import (UploadHelper, UploadInfo,
+                                   check_quick_xor_hash, checkpoint_key,
+                                   complete_upload, discard_session,
+                                   record_chunk, record_file, reset_session,
+                                   restore_checkpoint, resume_session,
+                                   session_expires_in, utc_datetime_str)
+from utils import color_print
+from utils.bandwidth import LimitedBody, limiter
+from utils.buffer_pool import FileSlice
+from utils.chunk_reader import (CHUNK_UNIT, AdaptiveChunkSize,
+                                align_chunk_size, next_chunk)
+from utils.progress import progress
+from utils.quick_xor_hash import quick_xor_hash_file
+
+
+class AsyncUploadEngine:
+    """
+    基于asyncio的上传引擎，实现与阻塞上传相同的操作：小文件PUT、创建上传会话、分片PUT和查询上传会话。
+    所有上传在一个事件循环中进行，等待响应和重试不占用线程，同时上传的文件数由信号量限制；
+    读取文件和计算hash在线程池中进行。断点续传信息与阻塞上传相同，两种方式可以互相续传
+    """
+
+    def __init__(self, helper: UploadHelper, workers: int):
+        """
+        :param helper: 提供token、上传索引、断点续传信息和停止信号
+        :param workers: 同时上传的文件数量
+        """
+        self.helper = helper
+        self.workers = max(workers, 1)
+        self.transport = None
+        self._executor = None
+        # home_account_id -> AsyncThrottle
+        self._throttles: Dict[str, AsyncThrottle] = {}
+
+    def run(self, infos: Iterable[UploadInfo]) -> List[UploadInfo]:
+        """
+        上传所有文件，直到完成或helper.stop_event被设置
+        :param infos: 可以是扫描目录的迭代器，取得文件后立即开始上传
+        :return: 各个文件的上传信息
+        """
+        return asyncio.run(self._run(infos))
+
+    async def _run(self, infos: Iterable[UploadInfo]) -> List[UploadInfo]:
+        self.transport = AsyncTransport(self.workers)
+        # 磁盘读取和hash计算的线程数，与事件循环中同时进行的请求数无关
+        self._executor = ThreadPoolExecutor(
+            max_workers=min(self.workers, 8) + app_config.UPLOAD_READ_AHEAD)
+        semaphore = asyncio.Semaphore(self.workers)
+        loop = asyncio.get_running_loop()
+        it = iter(infos)
+        tasks = []
+
+        async def upload(info: UploadInfo):
+            try:
+                return await self._upload_one(info)
+            finally:
+                semaphore.release()
+
+        try:
+            while True:
+                # 有空闲的位置时才取得下一个文件，扫描目录可能阻塞，不在事件循环中进行
+                await semaphore.acquire()
+                info = await loop.run_in_executor(None, next, it, None)
+                if info is None:
+                    semaphore.release()
+                    break
+                tasks.append(asyncio.ensure_future(upload(info)))
+            return list(await asyncio.gather(*tasks))
+        finally:
+            await self.transport.close()
+            self._executor.shutdown()
+
+    def _throttle(self, account: dict) -> AsyncThrottle:
+        account_id = account['home_account_id']
+        if account_id not in self._throttles:
+            self._throttles[account_id] = AsyncThrottle(get_controller(
+                account_id, app_config.THROTTLE_MAX_INFLIGHT))
+        return self._throttles[account_id]
+
+    async def _in_executor(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _upload_one(self, info: UploadInfo) -> UploadInfo:
+        helper = self.helper
+        if helper.stop_event.is_set():
+            info.status = 'stopped'
+            return info
+
+        mode = 'small' if info.size <= 4 * 1024 * 1024 else 'session'
+        start = time.perf_counter()
+        try:
+            # token通常在内存中，需要刷新时不阻塞事件循环
+            access_token = await self._in_executor(
+                helper._access_token, info.onedrive_account)
+            throttle = self._throttle(info.onedrive_account)
+            if mode == 'small':
+                await self.upload_small_file(access_token, info, throttle)
+            else:
+                info = await self.upload_large_file(access_token, info,
+                                                    throttle)
+        except Exception as e:
+            info.status = 'error'
+            info.error = str(e)
+            record_file(info, mode, time.perf_counter() - start)
+            color_print.r('上传失败. 文件: %s, %s' % (
+                info.local_file_path, info.error))
+            return info
+        record_file(info, mode, time.perf_counter() - start)
+
+        if info.status == 'finished':
+            if helper.upload_index is not None:
+                helper.upload_index.record(info)
+            color_print.g('上传成功. 文件: %s' % info.local_file_path)
+        elif info.status == 'stopped':
+            color_print.y('上传停止. 文件: %s' % info.local_file_path)
+        return info
+
+    async def upload_small_file(self, access_token: str, info: UploadInfo,
+                                throttle: AsyncThrottle):
+        start = time.time()
+        data = FileSlice(info.local_file_path, 0, info.size)
+        info.quick_xor_hash = (await self._in_executor(
+            quick_xor_hash_file, info.local_file_path, info.size)).base64()
+        with progress.transfer(info.filename, info.size) as transfer:
+            resp_json = (await async_drive_api.put_content(
+                self.transport, access_token,
+                info.onedrive_dir_path + info.filename,
+                async_request_body(data), throttle, info.conflict_behavior,
+                info.parent_id)).json()
+            if 'id' in resp_json.keys():
+                transfer.update(info.size, info.size)
+        if 'id' not in resp_json.keys():
+            raise Exception(str(resp_json.get('error')))
+        error = check_quick_xor_hash(info, resp_json)
+        if error:
+            raise Exception(error)
+        info.spend_time = time.time() - start
+        info.speed = int(info.size / info.spend_time) \
+            if info.spend_time > 0 else 0
+        info.finish_time = utc_datetime_str()
+        info.status = 'finished'
+        info.finished = info.uploaded = info.size
+        info.item_id = resp_json['id']
+        info.e_tag = resp_json.get('eTag', '')
+        return info
+
+    async def upload_large_file(self, access_token: str, info: UploadInfo,
+                                throttle: AsyncThrottle):
+        """
+        与upload_helper.upload_large_file相同
+        """
+        checkpoints = self.helper.checkpoints
+        key = checkpoint_key(info)
+        info, hasher = await self._in_executor(restore_checkpoint, info,
+                                               checkpoints, key)
+
+        sizer = AdaptiveChunkSize(1024 * 1024 * app_config.UPLOAD_CHUNK_SIZE,
+                                  app_config.UPLOAD_CHUNK_TARGET_TIME,
+                                  app_config.UPLOAD_ADAPTIVE_CHUNK)
+        if sizer.adaptive and info.chunk_size > 0:
+            sizer.chunk_size = align_chunk_size(info.chunk_size)
+        chunk_size = info.chunk_size = sizer.chunk_size
+
+        resumed = bool(info.upload_url)
+        f = None
+        with progress.transfer(info.filename, info.size,
+                               info.finished) as transfer:
+            try:
+                resp_json = {}
+                if info.upload_url and session_expires_in(info) <= 0:
+                    color_print.y('上传会话已过期，重新上传. 文件: %s' %
+                                  info.local_file_path)
+                    await self._in_executor(discard_session, info)
+                    hasher = reset_session(info)
+                elif info.precreated:
+                    # 提前创建的会话还没有上传过，需要整个文件
+                    resp_json = {'nextExpectedRanges': ['0-']}
+                    info.precreated = False
+                    checkpoints.save(key, dataclasses.asdict(info), sync=True)
+                elif info.upload_url:
+                    resp_json = (await async_drive_api.get_upload_session(
+                        self.transport, info.upload_url, throttle)).json()
+                    if 'nextExpectedRanges' not in resp_json:
+                        color_print.y('上传会话已失效，重新上传. 文件: %s, %s' % (
+                            info.local_file_path, resp_json.get('error')))
+                        hasher = reset_session(info)
+
+                if not info.upload_url:
+                    resp_json = (await async_drive_api.create_upload_session(
+                        self.transport, access_token, info.filename,
+                        info.onedrive_dir_path + info.filename, throttle,
+                        info.conflict_behavior, info.parent_id)).json()
+                    upload_url = resp_json.get('uploadUrl')
+                    if not upload_url:
+                        raise Exception(str(resp_json.get('error')))
+                    info.upload_url = upload_url
+                    resp_json.setdefault('nextExpectedRanges', ['0-'])
+                    checkpoints.save(key, dataclasses.asdict(info), sync=True)
+
+                hasher, ranges = await self._in_executor(
+                    resume_session, info, resp_json, hasher)
+                checkpoints.save(key, dataclasses.asdict(info))
+                transfer.update(info.finished, info.uploaded)
+                if session_expires_in(info) \
+                        < app_config.UPLOAD_SESSION_EXPIRY_MARGIN:
+                    chunk_size = CHUNK_UNIT
+
+                f = await self._in_executor(open, info.local_file_path, 'rb')
+                f.seek(info.finished)
+                start = time.time()
+                while True:
+                    # 分片的内容在发送时读取并计算hash，只划分分片和计算跳过的部分的hash
+                    chunk = await self._in_executor(next_chunk, f, ranges,
+                                                    chunk_size, hasher)
+                    if chunk is None:
+                        # 所有分片都已发送，但服务器没有返回文件信息
+                        raise Exception(str(resp_json.get('error')))
+                    data = chunk.data
+                    resp, stats = await self._put_chunk(info, chunk, throttle)
+                    hasher = chunk.hasher
+                    resp_json = resp.json()
+                    info.expiration = resp_json.get('expirationDateTime',
+                                                    info.expiration)
+                    put_time = resp.elapsed
+                    chunk_size = info.chunk_size = sizer.update(
+                        len(data), put_time, stats['retries'])
+                    if session_expires_in(info) \
+                            < app_config.UPLOAD_SESSION_EXPIRY_MARGIN:
+                        # 会话即将过期，发送最小的分片使会话随进度尽快延长
+                        chunk_size = CHUNK_UNIT
+                    record_chunk(info, chunk, data, resp,
+                                 time.perf_counter() - put_time, put_time,
+                                 **stats)
+                    spend_time = time.time() - start
+                    info.finished = chunk.end + 1
+                    info.quick_xor_state = '%x' % hasher.state
+                    info.speed = int(len(data) / spend_time) \
+                        if spend_time > 0 else 0
+                    info.spend_time += spend_time
+                    info.uploaded += len(data)
+                    checkpoints.save(key, dataclasses.asdict(info))
+                    transfer.update(info.finished, info.uploaded)
+
+                    if 'id' in resp_json.keys():
+                        complete_upload(info, resp_json, hasher)
+                        checkpoints.delete(key)
+                        return info
+                    if self.helper.stop_event.is_set():
+                        info.status = 'stopped'
+                        checkpoints.save(key, dataclasses.asdict(info),
+                                         sync=True)
+                        return info
+                    start = time.time()
+            except SessionExpired as e:
+                if not resumed and info.uploaded == 0:
+                    checkpoints.delete(key)
+                    raise Exception(str(e))
+                # 保留断点续传信息，在新的会话中重新上传
+                reset_session(info)
+                checkpoints.save(key, dataclasses.asdict(info), sync=True)
+            except Exception as e:
+                checkpoints.delete(key)
+                raise e
+            finally:
+                if f is not None:
+                    f.close()
+
+        color_print.y('上传会话已过期，重新上传. 文件: %s' % info.local_file_path)
+        uploaded = info.uploaded
+        info = await self.upload_large_file(access_token, info, throttle)
+        info.uploaded += uploaded
+        return info
+
+    async def _put_chunk(self, info: UploadInfo, chunk,
+                         throttle: AsyncThrottle):
+        """
+        上传一个分片，网络错误和服务器错误时重试
+        :return: (响应, 请求次数和重试、限流、退避的统计)
+        """
+        headers = {
+            'Content-Length': str(len(chunk.data)),
+            'Content-Range': 'bytes {}-{}/{}'.format(chunk.start, chunk.end,
+                                                     info.size)
+        }
+        body = async_request_body(chunk.data)
+        retry_cnt = 1
+        throttled_cnt = 1
+        attempts = 0
+        backoff_time = 0
+        while True:
+            try:
+                async with throttle.slot():
+                    attempts += 1
+                    resp = await async_drive_api.put_upload_range(
+                        self.transport, info.upload_url, headers, body)
+            except async_drive_api.network_errors() as e:
+                resp = None
+                error = str(e) or type(e).__name__
+            else:
+                if resp.status_code in THROTTLE_STATUS:
+                    delay = async_drive_api.backoff_throttled(
+                        resp, throttled_cnt, throttle)
+                    color_print.y('请求被限流(%d)，%ds后重试' % (
+                        resp.status_code, delay))
+                    throttled_cnt += 1
+                    backoff_time += delay
+                    continue
+                if resp.status_code < 400:
+                    throttle.controller.on_success()
+                    return resp, {'attempts': attempts,
+                                  'retries': retry_cnt - 1,
+                                  'throttled': throttled_cnt - 1,
+                                  'backoff_time': backoff_time}
+                if resp.status_code == 404:
+                    # 上传会话已过期
+                    raise SessionExpired(
+                        str(resp.json().get('error')))
+                if resp.status_code < 500 or resp.status_code == 507:
+                    # 文件未找到或存储空间不足，重试没有意义
+                    raise Exception(str(resp.json().get('error')))
+                error = resp.text
+            # OneDrive服务器错误或网络错误，稍后继续尝试
+            color_print.y(error)
+            delay = min(2 ** retry_cnt, 60)
+            color_print.y('第%d次重试，%ds后重试' % (retry_cnt, delay))
+            await asyncio.sleep(delay)
+            retry_cnt += 1
+            backoff_time += delay
+
+
+def async_request_body(data: FileSlice):
+    """
+    有带宽限制时返回按限制分块发送的请求体（异步迭代），否则为data本身
+    """
+    if limiter.enabled:
+        return LimitedBody(data)
+    return data
+
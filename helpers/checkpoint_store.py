@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+import app_config
+
+
+class CheckpointStore:
+    """
+    所有上传会话共用的断点续传信息，保存在SQLite数据库中（WAL模式）。
+    每个分片完成后的进度先保存在内存中，同一上传的多次更新合并为一次，
+    由后台线程每隔flush_interval秒在一个事务中写入。
+    进程崩溃时最多丢失最后flush_interval秒的进度，续传时以服务器返回的nextExpectedRanges为准
+    """
+
+    def __init__(self,
+                 db_path: str = app_config.UPLOAD_CHECKPOINT_DB,
+                 flush_interval: float = 1.0):
+        """
+        :param db_path: 数据库路径
+        :param flush_interval: 写入数据库的间隔（秒）
+        """
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                key TEXT NOT NULL PRIMARY KEY,
+                local_path TEXT NOT NULL,
+                remote_path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                finished INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                info TEXT NOT NULL,
+                update_time REAL NOT NULL
+            ) WITHOUT ROWID''')
+        self._conn.execute('''
+            CREATE INDEX IF NOT EXISTS checkpoints_update_time
+            ON checkpoints (update_time)''')
+        self._conn.commit()
+
+        # key -> 待写入的行，None表示删除
+        self._pending: Dict[str, Optional[tuple]] = {}
+        self._lock = threading.Lock()
+        self._flushes = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+            self._flushes += 1
+            if self._flushes % 60 == 0:
+                # 定期将WAL合并回数据库文件，避免WAL文件持续增大
+                with self._db_lock:
+                    self._conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def save(self, key: str, info: dict, sync: bool = False):
+        """
+        :param key: 上传的唯一标识
+        :param info: 上传信息，可以序列化为JSON
+        :param sync: 是否立即写入数据库，例如创建上传会话或停止上传时
+        """
+        row = (key, info['local_file_path'],
+               info['onedrive_dir_path'] + info['filename'], info['size'],
+               info['finished'], info['status'],
+               json.dumps(info, ensure_ascii=False, separators=(',', ':')),
+               time.time())
+        with self._lock:
+            self._pending[key] = row
+        if sync:
+            self.flush()
+
+    def delete(self, key: str):
+        """
+        上传完成或失败后删除，立即写入数据库
+        """
+        with self._lock:
+            self._pending[key] = None
+        self.flush()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            if key in self._pending:
+                row = self._pending[key]
+                return json.loads(row[6]) if row is not None else None
+        with self._db_lock:
+            row = self._conn.execute(
+                'SELECT info FROM checkpoints WHERE key = ?',
+                (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def resumable(self) -> List[dict]:
+        """
+        :return: 所有未完成的上传，按更新时间排序
+        """
+        self.flush()
+        with self._db_lock:
+            rows = self._conn.execute(
+                'SELECT info FROM checkpoints ORDER BY update_time').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def flush(self):
+        # 取出和写入都在_db_lock内，保证多个线程同时flush时按顺序写入
+        with self._db_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            # 一个事务写入所有更新，崩溃时要么全部写入要么全部没有写入
+            with self._conn:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO checkpoints '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [row for row in pending.values() if row is not None])
+                self._conn.executemany(
+                    'DELETE FROM checkpoints WHERE key = ?',
+                    [(key,) for key, row in pending.items() if row is None])
+
+    def close(self):
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self.flush()
+        with self._db_lock:
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._conn.close()
+        atexit.unregister(self.close)
+
+
+_default_store: Optional[CheckpointStore] = None
+_default_lock = threading.Lock()
+
+
+def default_store() -> CheckpointStore:
+    """
+    使用app_config.UPLOAD_CHECKPOINT_DB的CheckpointStore，首次调用时创建
+    """
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = CheckpointStore()
+        return _default_store
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import time
+
+import app_config
+from utils.control_socket import control_address, send_request
+
+# 任务结束的状态
+DONE_STATUS = ('finished', 'error', 'cancelled', 'paused')
+
+
+def daemon_address():
+    return control_address(app_config.DAEMON_SOCKET, app_config.DAEMON_PORT)
+
+
+def request(op: str, **kwargs) -> dict:
+    """
+    向上传守护进程发送请求。只依赖标准库，客户端不需要导入MSAL和requests
+    :return: 响应
+    """
+    resp = send_request(daemon_address(), dict(op=op, **kwargs))
+    if not resp.get('ok'):
+        raise Exception(resp.get('error'))
+    return resp
+
+
+def wait_job(job_id: int, interval: float = 1) -> dict:
+    """
+    等待任务结束
+    :return: 任务
+    """
+    while True:
+        job = request('status', id=job_id)['job']
+        if job['status'] in DONE_STATUS:
+            return job
+        time.sleep(interval)
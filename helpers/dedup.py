@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import app_config
+from graph import drive_api
+from graph.throttle import get_controller
+from helpers.upload_helper import (UploadHelper, UploadInfo, record_file,
+                                   utc_datetime_str)
+from utils import color_print
+from utils.buffer_pool import buffer_pool
+
+
+def find_duplicates(infos: list, min_size: int, workers: int = 4) \
+        -> Tuple[list, List[tuple]]:
+    """
+    按内容查找重复的文件。先按大小和cid（只取样文件的三段）分组，
+    只对可能重复的文件计算完整内容的SHA-256
+    :param infos: 需要上传的UploadInfo
+    :param min_size: 小于此大小（字节）的文件不查找，直接上传
+    :param workers: 同时计算hash的文件数量
+    :return: (需要上传的文件, [(重复的文件, 内容相同的需要上传的文件)])
+    """
+    candidates: Dict[tuple, list] = {}
+    for info in infos:
+        if info.size >= min_size:
+            candidates.setdefault((info.size, info.cid_hash), []).append(info)
+    to_hash = [i for group in candidates.values() if len(group) > 1
+               for i in group]
+    if not to_hash:
+        return infos, []
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        digests = list(executor.map(
+            lambda i: sha256_file(i.local_file_path), to_hash))
+
+    # 内容hash -> 第一个文件
+    primaries = {}
+    duplicates = []
+    duplicate_ids = set()
+    for info, digest in zip(to_hash, digests):
+        primary = primaries.setdefault((info.size, digest), info)
+        if primary is not info:
+            duplicates.append((info, primary))
+            duplicate_ids.add(id(info))
+    if duplicates:
+        color_print.b('%d个文件与其他文件内容相同，上传一次后在服务器上复制' % len(duplicates))
+    return [i for i in infos if id(i) not in duplicate_ids], duplicates
+
+
+class DuplicateFilter:
+    """
+    扫描目录的同时查找重复的文件：大小和cid与之前的文件相同的文件暂不上传，
+    其他文件上传后再计算这些文件完整内容的SHA-256，确定重复的在服务器上复制
+    """
+
+    def __init__(self, min_size: int):
+        """
+        :param min_size: 小于此大小（字节）的文件不查找，直接上传
+        """
+        self.min_size = min_size
+        # (大小, cid) -> 第一个文件
+        self._first: Dict[tuple, object] = {}
+        self._held: list = []
+
+    def filter(self, infos: list) -> list:
+        """
+        :return: 可以直接上传的文件
+        """
+        result = []
+        for info in infos:
+            if info.size >= self.min_size and self._first.setdefault(
+                    (info.size, info.cid_hash), info) is not info:
+                self._held.append(info)
+            else:
+                result.append(info)
+        return result
+
+    def resolve(self, workers: int = 4) -> Tuple[list, List[tuple]]:
+        """
+        :param workers: 同时计算hash的文件数量
+        :return: (暂缓的文件中需要上传的文件, [(重复的文件, 内容相同的文件)])
+        """
+        if not self._held:
+            return [], []
+        firsts = {}
+        for info in self._held:
+            first = self._first[(info.size, info.cid_hash)]
+            firsts[id(first)] = first
+        # 第一个文件排在前面，内容相同时作为被复制的文件
+        infos, duplicates = find_duplicates(
+            list(firsts.values()) + self._held, 0, workers)
+        return [i for i in infos if id(i) not in firsts], duplicates
+
+
+def sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f, buffer_pool.buffer() as buf:
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def copy_duplicates(helper: UploadHelper, account: dict,
+                    duplicates: List[Tuple[UploadInfo, UploadInfo]],
+                    workers: int) -> List[UploadInfo]:
+    """
+    在服务器上复制已上传的文件，得到内容相同的其他文件。同时查询所有复制的进度，
+    复制失败或被复制的文件上传失败时，改为正常上传
+    :param duplicates: [(重复的文件, 内容相同的已上传的文件)]
+    :return: 重复的文件的上传信息
+    """
+    account_id = account['home_account_id']
+    throttle = get_controller(account_id, app_config.THROTTLE_MAX_INFLIGHT)
+    access_token = helper._access_token(account)
+    try:
+        drive_id = drive_api.get_drive(access_token, throttle).get('id', '')
+    except Exception as e:
+        color_print.y('获取驱动器id失败: %s' % e)
+        drive_id = ''
+
+    fallback = []
+
+    def start_copy(item: Tuple[UploadInfo, UploadInfo]):
+        info, source = item
+        if source.status != 'finished' or not source.item_id:
+            if source.status == 'error':
+                fallback.append(info)
+            else:
+                info.status = 'stopped'
+            return None
+        try:
+            return drive_api.copy_item(
+                access_token, source.item_id,
+                info.onedrive_dir_path + info.filename, drive_id,
+                info.parent_id, info.conflict_behavior, throttle)
+        except Exception as e:
+            color_print.y('复制失败，改为上传. 文件: %s, %s' % (
+                info.local_file_path, e))
+            fallback.append(info)
+            return None
+
+    # 监视地址 -> (重复的文件, 被复制的文件)
+    monitors = {}
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for item, monitor in zip(duplicates,
+                                 executor.map(start_copy, duplicates)):
+            if monitor:
+                monitors[monitor] = item
+
+        deadline = time.time() + app_config.UPLOAD_DEDUP_COPY_TIMEOUT
+        while monitors and not helper.stop_event.is_set():
+            time.sleep(app_config.UPLOAD_DEDUP_POLL_INTERVAL)
+            urls = list(monitors)
+            for url, status in zip(urls, executor.map(
+                    copy_status_or_error, urls)):
+                info, source = monitors[url]
+                if status.get('status') == 'completed':
+                    del monitors[url]
+                    info.status = 'finished'
+                    info.item_id = status.get('resourceId', '')
+                    info.copied_from = source.item_id
+                    info.finished = info.size
+                    info.quick_xor_hash = source.quick_xor_hash
+                    info.spend_time = time.time() - start
+                    info.finish_time = utc_datetime_str()
+                    record_file(info, 'copy', info.spend_time)
+                elif status.get('status') == 'failed' or 'error' in status:
+                    del monitors[url]
+                    color_print.y('复制失败，改为上传. 文件: %s, %s' % (
+                        info.local_file_path,
+                        status.get('error', status)))
+                    fallback.append(info)
+            if time.time() > deadline:
+                break
+
+        for info, _ in monitors.values():
+            # 复制可能仍在进行，不再上传以免产生重复的文件
+            info.status = 'stopped' if helper.stop_event.is_set() \
+                else 'error'
+            info.error = info.error or 'copy did not finish in time'
+
+        copied = [i for i, _ in duplicates if i.status == 'finished']
+        if copied:
+            if helper.upload_index is not None:
+                helper.upload_index.record_many(copied)
+            color_print.g('复制成功. %d个文件' % len(copied))
+        list(executor.map(helper._upload_one, fallback))
+    return [i for i, _ in duplicates]
+
+
+def copy_status_or_error(monitor_url: str) -> dict:
+    try:
+        return drive_api.get_copy_status(monitor_url)
+    except Exception as e:
+        return {'error': str(e)}
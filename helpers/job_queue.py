@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+import app_config
+
+# 任务状态：等待、上传中、暂停、完成、失败、取消
+JOB_STATUS = ('queued', 'running', 'paused', 'finished', 'error',
+              'cancelled')
+# 可以恢复为等待状态的任务
+RESUMABLE_STATUS = ('paused', 'error', 'cancelled')
+
+
+class JobQueue:
+    """
+    守护进程的上传任务队列，保存在SQLite数据库中，守护进程重启后继续执行未完成的任务。
+    同时记录监视目录中已提交的文件，重启后只提交新增或修改过的文件
+    """
+
+    def __init__(self, db_path: str = app_config.DAEMON_JOB_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                local_path TEXT NOT NULL,
+                one_dir TEXT NOT NULL,
+                options TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT NOT NULL,
+                error TEXT NOT NULL,
+                submit_time REAL NOT NULL,
+                update_time REAL NOT NULL
+            )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_status '
+                           'ON jobs (status, id)')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS watched_files (
+                path TEXT NOT NULL PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            ) WITHOUT ROWID''')
+        # 上次运行时正在上传的任务重新排队，通过断点续传信息继续上传
+        self._conn.execute("UPDATE jobs SET status = 'queued' "
+                           "WHERE status = 'running'")
+        self._conn.commit()
+
+    def submit(self,
+               kind: str,
+               local_path: str,
+               one_dir: str,
+               options: Optional[dict] = None) -> int:
+        """
+        :param kind: file 或 dir
+        :param local_path: 本地文件或目录路径
+        :param one_dir: 上传到的OneDrive目录
+        :param options: 上传选项，例如user, workers, conflict
+        :return: 任务id
+        """
+        with self._lock:
+            job_id = self._insert(kind, local_path, one_dir, options)
+            self._conn.commit()
+        return job_id
+
+    def submit_watched(self, local_path: str, one_dir: str, options: dict,
+                       size: int, mtime_ns: int) -> int:
+        """
+        提交监视目录中的文件，并记录提交时的大小和修改时间
+        """
+        with self._lock:
+            job_id = self._insert('file', local_path, one_dir, options)
+            self._conn.execute(
+                'INSERT OR REPLACE INTO watched_files VALUES (?, ?, ?)',
+                (local_path, size, mtime_ns))
+            self._conn.commit()
+        return job_id
+
+    def _insert(self, kind: str, local_path: str, one_dir: str,
+                options: Optional[dict]) -> int:
+        now = time.time()
+        cur = self._conn.execute(
+            'INSERT INTO jobs (kind, local_path, one_dir, options, status, '
+            'result, error, submit_time, update_time) '
+            "VALUES (?, ?, ?, ?, 'queued', '{}', '', ?, ?)",
+            (kind, local_path, one_dir, json.dumps(options or {}), now, now))
+        return cur.lastrowid
+
+    def watched(self, local_path: str) -> Optional[tuple]:
+        """
+        :return: 提交时的(大小, 修改时间)，未提交过时为None
+        """
+        with self._lock:
+            return self._conn.execute(
+                'SELECT size, mtime_ns FROM watched_files WHERE path = ?',
+                (local_path,)).fetchone()
+
+    def get(self, job_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE id = ?',
+                                     (job_id,)).fetchone()
+        return job_dict(row) if row else None
+
+    def list(self, status: Optional[str] = None,
+             limit: int = 100) -> List[dict]:
+        """
+        :param status: 只列出此状态的任务
+        :return: 最近提交的limit个任务，按id倒序
+        """
+        sql = 'SELECT * FROM jobs'
+        params = ()
+        if status:
+            sql += ' WHERE status = ?'
+            params = (status,)
+        with self._lock:
+            rows = self._conn.execute(sql + ' ORDER BY id DESC LIMIT ?',
+                                      params + (limit,)).fetchall()
+        return [job_dict(r) for r in rows]
+
+    def take(self) -> Optional[dict]:
+        """
+        取出最早提交的等待中的任务，并设置为上传中
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' "
+                'ORDER BY id LIMIT 1').fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', update_time = ? "
+                'WHERE id = ?', (time.time(), row[0]))
+            self._conn.commit()
+        job = job_dict(row)
+        job['status'] = 'running'
+        return job
+
+    def update(self, job_id: int, status: str,
+               result: Optional[dict] = None, error: str = '',
+               expect: Optional[tuple] = None) -> bool:
+        """
+        :param expect: 只在任务为这些状态时修改
+        :return: 是否修改成功
+        """
+        sql = 'UPDATE jobs SET status = ?, error = ?, update_time = ?'
+        params = [status, error, time.time()]
+        if result is not None:
+            sql += ', result = ?'
+            params.append(json.dumps(result))
+        sql += ' WHERE id = ?'
+        params.append(job_id)
+        if expect:
+            sql += ' AND status IN (%s)' % ','.join('?' * len(expect))
+            params += expect
+        with self._lock:
+            cur = self._conn.execute(sql, params)
+            self._conn.commit()
+        return cur.rowcount > 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def job_dict(row: tuple) -> dict:
+    job = dict(zip(('id', 'kind', 'local_path', 'one_dir', 'options',
+                    'status', 'result', 'error', 'submit_time',
+                    'update_time'), row))
+    job['options'] = json.loads(job['options'])
+    job['result'] = json.loads(job['result'])
+    return job
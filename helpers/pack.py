@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+import dataclasses
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import app_config
+from graph import drive_api
+from helpers.dedup import copy_duplicates, find_duplicates
+from helpers.scanner import DirectoryScanner
+from helpers.upload_helper import (UploadHelper, UploadInfo, checkpoint_key,
+                                   create_upload_info, print_summary,
+                                   remote_dir_path, sigint_stop)
+from utils import color_print
+from utils.progress import human_size, progress
+
+# 压缩方式 -> (分段文件扩展名, tarfile的流模式)
+COMPRESSIONS = {
+    'none': ('.tar', 'w|'),
+    'gzip': ('.tar.gz', 'w|gz'),
+    'zstd': ('.tar.zst', 'w|'),
+}
+
+
+def import_zstandard():
+    """
+    zstandard只在使用zstd压缩时需要，不在requirements.txt中
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('zstd compression requires zstandard, '
+                        'install it with: pip install zstandard')
+    return zstandard
+
+
+@dataclasses.dataclass
+class PackMember:
+    # 文件的上传信息
+    info: object
+    # 在tar中的路径
+    arcname: str
+    # 文件内容在（未压缩的）tar中的偏移和长度
+    offset: int
+    length: int
+    sha256: str
+
+
+@dataclasses.dataclass
+class PackSegment:
+    name: str
+    path: str
+    members: List[PackMember]
+    # 未压缩的tar大小
+    tar_size: int = 0
+
+
+class MemberReader:
+    """
+    tar按块读取的文件内容，读取的同时计算SHA-256，不将整个文件读入内存。
+    文件在读取过程中变短时以0补齐，保证tar的结构完整
+    """
+
+    def __init__(self, f, size: int):
+        self.f = f
+        self.left = size
+        self.sha256 = hashlib.sha256()
+        self.short = False
+
+    def read(self, n: int = -1) -> bytes:
+        n = self.left if n < 0 else min(n, self.left)
+        data = self.f.read(n)
+        if len(data) < n:
+            self.short = True
+            data += bytes(n - len(data))
+        self.left -= n
+        self.sha256.update(data)
+        return data
+
+
+class SegmentWriter:
+    """
+    将小文件依次以流的方式写入大小有上限的tar分段（可压缩）。分段写在spill目录中，
+    未释放的分段数量达到上限时，新建分段前等待，内存和磁盘占用与目录中的文件数量无关
+    """
+
+    def __init__(self,
+                 spill_dir: str,
+                 prefix: str,
+                 segment_size: int,
+                 compression: str = 'none',
+                 max_segments: int = 2):
+        """
+        :param spill_dir: 分段文件的临时目录
+        :param prefix: 分段文件名的前缀，分段依次命名为 prefix-00001.tar
+        :param segment_size: 每个分段未压缩的大小上限（字节），单个文件超过上限时单独成为一个分段
+        :param compression: none, gzip, zstd
+        :param max_segments: spill目录中同时存在的分段数量上限
+        """
+        if compression not in COMPRESSIONS:
+            raise ValueError('invalid compression: %s' % compression)
+        if compression == 'zstd':
+            import_zstandard()
+        os.makedirs(spill_dir, exist_ok=True)
+        self.spill_dir = spill_dir
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.compression = compression
+        self._slots = threading.BoundedSemaphore(max(max_segments, 1))
+        self._count = 0
+        self._segment: Optional[PackSegment] = None
+        self._raw = None
+        self._stream = None
+        self._tar: Optional[tarfile.TarFile] = None
+
+    def add(self, info, arcname: str) -> Optional[PackSegment]:
+        """
+        将文件写入当前分段
+        :param info: 文件的上传信息，需要local_file_path
+        :param arcname: 在tar中的路径
+        :return: 写入后当前分段已满时，返回写完的分段
+        """
+        if self._tar is None:
+            self._open()
+        with open(info.local_file_path, 'rb') as f:
+            # 使用打开的文件的信息，符号链接也作为普通文件写入。
+            # 读取时文件可能仍在写入，只写入打开时的大小
+            tarinfo = self._tar.gettarinfo(arcname=arcname, fileobj=f)
+            tarinfo.uname = tarinfo.gname = ''
+            reader = MemberReader(f, tarinfo.size)
+            self._tar.addfile(tarinfo, reader)
+        if reader.short:
+            # tar中已写入以0补齐的内容，不记录到索引中，文件下次重新打包
+            raise OSError('%s is shorter than expected' %
+                          info.local_file_path)
+        # 写入后tar.offset位于文件内容（按512字节补齐）之后
+        offset = self._tar.offset - tarfile.BLOCKSIZE * (
+            (tarinfo.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE)
+        self._segment.members.append(PackMember(
+            info, arcname, offset, tarinfo.size, reader.sha256.hexdigest()))
+        if self._tar.offset >= self.segment_size:
+            return self.close()
+        return None
+
+    def close(self) -> Optional[PackSegment]:
+        """
+        写完当前分段
+        :return: 写完的分段，没有写入任何文件时为None
+        """
+        segment = self._segment
+        if segment is None:
+            return None
+        segment.tar_size = self._tar.offset
+        self._tar.close()
+        if self._stream is not self._raw:
+            self._stream.close()
+        if not self._raw.closed:
+            self._raw.close()
+        self._segment = self._raw = self._stream = self._tar = None
+        return segment
+
+    def release(self, segment: PackSegment):
+        """
+        分段上传完成或放弃后，删除分段文件
+        """
+        try:
+            os.remove(segment.path)
+        except OSError:
+            pass
+        self._slots.release()
+
+    def _open(self):
+        self._slots.acquire()
+        self._count += 1
+        ext, mode = COMPRESSIONS[self.compression]
+        name = '%s-%05d%s' % (self.prefix, self._count, ext)
+        path = os.path.join(self.spill_dir, name)
+        self._raw = open(path, 'wb')
+        self._stream = self._raw
+        if self.compression == 'zstd':
+            self._stream = import_zstandard().ZstdCompressor() \
+                .stream_writer(self._raw)
+        self._tar = tarfile.open(fileobj=self._stream, mode=mode,
+                                 format=tarfile.PAX_FORMAT)
+        self._segment = PackSegment(name, path, [])
+
+
+class PackIndexWriter:
+    """
+    以gzip压缩的JSON lines逐行写入打包文件的索引：
+    {"path": 相对路径, "segment": 分段文件名, "offset": 偏移, "length": 长度, "sha256": hash}。
+    offset是文件内容在未压缩的tar中的偏移，未压缩的分段可以直接按范围下载单个文件
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'wt', encoding='utf8')
+        self.count = 0
+
+    def write(self, segment: PackSegment):
+        with self._lock:
+            for m in segment.members:
+                self._file.write(json.dumps({
+                    'path': m.arcname, 'segment': segment.name,
+                    'offset': m.offset, 'length': m.length,
+                    'sha256': m.sha256}, ensure_ascii=False) + '\n')
+            self.count += len(segment.members)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_member(segment_path: str, offset: int, length: int,
+                compression: str = 'none') -> bytes:
+    """
+    从下载的分段中读取索引中的一个文件
+    """
+    if compression == 'none':
+        with open(segment_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+    if compression == 'gzip':
+        f = gzip.open(segment_path, 'rb')
+    else:
+        f = import_zstandard().ZstdDecompressor().stream_reader(
+            open(segment_path, 'rb'), closefd=True)
+    with f:
+        # 压缩的流只能顺序读取
+        while offset > 0:
+            skipped = len(f.read(min(offset, 1024 * 1024)))
+            if skipped == 0:
+                break
+            offset -= skipped
+        return f.read(length)
+
+
+def upload_dir_packed(helper: UploadHelper,
+                      local_dir_path: str,
+                      onedrive_dir_path: str,
+                      onedrive_user: Optional[str] = None,
+                      workers: int = app_config.UPLOAD_WORKERS,
+                      batch: bool = app_config.UPLOAD_BATCH,
+                      dedup: bool = app_config.UPLOAD_DEDUP,
+                      compression: str =
+                      app_config.UPLOAD_PACK_COMPRESSION):
+    """
+    递归上传目录，小文件以流的方式打包为大小有上限的tar分段，分段使用上传会话上传，
+    并在同一目录中上传索引（路径 -> 分段、偏移、长度、hash），之后可以单独取回文件。
+    其余文件与upload_dir相同，单独上传
+    :param local_dir_path: 本地目录路径
+    :param onedrive_dir_path: 上传到的OneDrive目录的路径
+    :param onedrive_user: 上传至此用户的OneDrive，默认为token_cache中的首个用户
+    :param workers: 同时上传的文件（分段）数量
+    :param batch: 是否使用$batch批量创建文件夹和上传小文件
+    :param dedup: 内容相同的文件是否只上传一次，其余在服务器上复制
+    :param compression: 分段的压缩方式：none, gzip, zstd
+    :return: 各个文件的上传信息
+    """
+    local_dir_path, onedrive_dir_path = helper._resolve_dirs(
+        local_dir_path, onedrive_dir_path)
+    account = helper._get_account(onedrive_user)
+    helper._sync_remote_tree(account, onedrive_dir_path)
+
+    prefix = 'pack-' + datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    writer = SegmentWriter(
+        os.path.join(app_config.UPLOAD_PACK_SPILL_DIR, prefix), prefix,
+        app_config.UPLOAD_PACK_SEGMENT_SIZE * 1024 * 1024, compression,
+        app_config.UPLOAD_PACK_SPILL_SEGMENTS)
+    index = PackIndexWriter(
+        os.path.join(writer.spill_dir, prefix + '.index.jsonl.gz'))
+    max_size = app_config.UPLOAD_PACK_FILE_SIZE * 1024
+    drive_api.transport.configure(workers)
+    if batch:
+        helper._create_folders(account, {onedrive_dir_path})
+    parent_id = ''
+    if helper.remote_tree is not None:
+        folder = helper.remote_tree.get(account['home_account_id'],
+                                      onedrive_dir_path)
+        parent_id = folder['item_id'] if folder else ''
+
+    color_print.b('打包上传小于%s的文件, 每个分段%dM, 同时上传%d个文件，按CTRL-C可停止上传'
+                  % (human_size(max_size + 1),
+                     app_config.UPLOAD_PACK_SEGMENT_SIZE, workers))
+    results = []
+    segments = []
+    lock = threading.Lock()
+
+    def upload_segment(segment: PackSegment):
+        info = create_upload_info(segment.path, onedrive_dir_path, account,
+                                  'fail')
+        info.parent_id = parent_id
+        try:
+            # 上传索引中只记录分段中的文件，不记录临时的分段文件
+            info = helper._upload_one(info, record=False)
+        finally:
+            writer.release(segment)
+        members = [m.info for m in segment.members]
+        total = sum(i.size for i in members)
+        for m in members:
+            m.status = info.status
+            m.error = info.error
+            if info.status == 'finished':
+                m.finished = m.size
+                # 按文件大小分摊分段实际上传的字节数
+                m.uploaded = info.uploaded * m.size // max(total, 1)
+                m.item_id = info.item_id
+                m.e_tag = info.e_tag
+                m.finish_time = info.finish_time
+        if info.status == 'finished':
+            index.write(segment)
+            if helper.upload_index is not None:
+                # 以文件本来的OneDrive路径记录，再次上传时跳过没有变化的文件
+                helper.upload_index.record_many(members)
+        elif info.status == 'stopped':
+            # 分段文件已删除，不能续传，下次重新打包
+            helper.checkpoints.delete(checkpoint_key(info))
+        with lock:
+            results.extend(members)
+            segments.append(info)
+
+    def add_result(info: UploadInfo):
+        with lock:
+            results.append(info)
+
+    # 打包的文件不在OneDrive目录树中，只根据上传索引判断
+    scanner = DirectoryScanner(
+        local_dir_path, helper.scan_options,
+        lambda path, rel_dir, stat: not helper._index_record(
+            path, remote_dir_path(onedrive_dir_path, rel_dir), account,
+            stat.st_size > max_size, stat)[0],
+        helper.stop_event)
+    large = []
+    skipped = 0
+    start = time.time()
+    with sigint_stop(helper.stop_event), \
+            ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = []
+        for infos, n in helper._scan(
+                scanner, onedrive_dir_path,
+                lambda entry, one_dir: helper._plan(
+                    entry.path, one_dir, account,
+                    entry.stat.st_size > max_size, entry.stat,
+                    entry.cid_hash)):
+            skipped += n
+            for info in infos:
+                if info.size > max_size:
+                    large.append(info)
+                    continue
+                try:
+                    segment = writer.add(
+                        info, os.path.relpath(info.local_file_path,
+                                              local_dir_path)
+                        .replace('\\', '/'))
+                except OSError as e:
+                    info.status = 'error'
+                    info.error = str(e)
+                    add_result(info)
+                    continue
+                if segment is not None:
+                    progress.plan(1)
+                    futures.append(
+                        executor.submit(upload_segment, segment))
+        segment = writer.close()
+        if segment is not None:
+            progress.plan(1)
+            if helper.stop_event.is_set():
+                writer.release(segment)
+                for m in segment.members:
+                    m.info.status = 'stopped'
+                    add_result(m.info)
+            else:
+                futures.append(executor.submit(upload_segment, segment))
+        for f in futures:
+            f.result()
+        index.close()
+        if upload_pack_index(helper, index, onedrive_dir_path, account,
+                             parent_id, segments):
+            shutil.rmtree(writer.spill_dir, ignore_errors=True)
+
+        if large and not helper.stop_event.is_set():
+            color_print.b('单独上传%d个文件, %s' % (
+                len(large), human_size(sum(i.size for i in large))))
+            duplicates = []
+            if dedup:
+                large, duplicates = find_duplicates(
+                    large, app_config.UPLOAD_DEDUP_MIN_SIZE * 1024,
+                    workers)
+            helper._prepare_folders(
+                account, large + [d for d, _ in duplicates], batch)
+            results += helper._run_engine(large, workers, batch)
+            if duplicates:
+                results += copy_duplicates(helper, account, duplicates,
+                                           workers)
+        else:
+            for info in large:
+                info.status = 'stopped'
+            results += large
+    spend_time = time.time() - start
+
+    print_summary(results, skipped + scanner.skipped, spend_time)
+    scanner.print_stats()
+    packed = [i for i in segments if i.status == 'finished'
+              and i.local_file_path != index.path]
+    if packed:
+        color_print.b('  打包: %d个文件, %d个分段, 共%s' % (
+            index.count, len(packed),
+            human_size(sum(i.size for i in packed))))
+    return results
+
+
+def upload_pack_index(helper: UploadHelper, index: PackIndexWriter,
+                      onedrive_dir_path: str, account: dict,
+                      parent_id: str, segments: List[UploadInfo]):
+    """
+    上传打包文件的索引。停止上传时也上传已完成的分段的索引
+    :return: 是否不再需要本地的索引
+    """
+    if index.count == 0:
+        return True
+    info = create_upload_info(index.path, onedrive_dir_path, account,
+                              'fail')
+    info.parent_id = parent_id
+    try:
+        info = helper._upload(info, threading.Event(), record=False)
+    except Exception as e:
+        info.status = 'error'
+        info.error = str(e)
+    segments.append(info)
+    if info.status != 'finished':
+        color_print.r('上传索引失败，索引保存在: %s, %s' % (index.path,
+                                                 info.error))
+        return False
+    return True
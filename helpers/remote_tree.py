@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import threading
+from typing import Optional
+
+import app_config
+from graph import drive_api
+from graph.throttle import ThrottleController
+from utils import color_print
+
+
+class RemoteTree:
+    """
+    OneDrive目录树的本地缓存，保存在SQLite数据库中。
+    首次使用delta接口（不支持时逐层列出子项）获取目录下的所有子项，之后使用deltaLink增量同步。
+    上传前据此判断文件是否已存在、需要创建哪些文件夹，并得到父目录的id
+    """
+
+    def __init__(self, db_path: str = app_config.REMOTE_TREE_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        # 目录的路径不以/结尾，驱动器根目录的路径为空字符串
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS items (
+                account TEXT NOT NULL,
+                path TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                is_folder INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                quick_xor_hash TEXT NOT NULL,
+                e_tag TEXT NOT NULL,
+                PRIMARY KEY (account, path)
+            ) WITHOUT ROWID''')
+        self._conn.execute('''
+            CREATE INDEX IF NOT EXISTS items_id ON items (account, item_id)''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                account TEXT NOT NULL,
+                root_path TEXT NOT NULL,
+                delta_link TEXT NOT NULL,
+                PRIMARY KEY (account, root_path)
+            )''')
+        self._conn.commit()
+
+    def sync(self,
+             access_token: str,
+             account: str,
+             root_path: str,
+             throttle: Optional[ThrottleController] = None):
+        """
+        同步OneDrive目录root_path下的所有子项
+        :param access_token: access token
+        :param account: 账号的唯一标识
+        :param root_path: OneDrive目录路径
+        :param throttle: 账号的限流控制器
+        """
+        root_path = root_path.rstrip('/')
+        root = drive_api.get_item(access_token, root_path, throttle)
+        if root is None:
+            # 目录不存在，删除缓存
+            self._delete_tree(account, root_path)
+            self._set_delta_link(account, root_path, '')
+            return
+
+        delta_link = self._get_delta_link(account, root_path)
+        try:
+            changed = self._sync_delta(access_token, account, root_path, root,
+                                       delta_link, throttle)
+        except drive_api.ResyncRequired:
+            changed = self._sync_delta(access_token, account, root_path, root,
+                                       '', throttle)
+        except Exception as e:
+            # 部分账号类型只支持在根目录使用delta，逐层列出子项
+            color_print.y('delta同步失败，逐层列出子项: %s' % e)
+            changed = self._sync_children(access_token, account, root_path,
+                                          root, throttle)
+        color_print.b('OneDrive目录同步完成: %s, 变化: %d' % (root_path or '/',
+                                                      changed))
+
+    def _sync_delta(self, access_token, account, root_path, root, delta_link,
+                    throttle) -> int:
+        if not delta_link:
+            self._delete_tree(account, root_path)
+        # 父目录id -> 路径，用于计算子项的路径（delta不返回parentReference.path）
+        with self._lock:
+            folders = dict(self._conn.execute(
+                'SELECT item_id, path FROM items '
+                'WHERE account = ? AND is_folder = 1', (account,)).fetchall())
+        folders[root['id']] = root_path
+        self.add(account, root_path, root)
+
+        changed = 0
+        for items, new_delta_link in drive_api.delta(
+                access_token, root_path, delta_link, throttle):
+            rows = []
+            for item in items:
+                changed += 1
+                if item['id'] == root['id']:
+                    continue
+                if 'deleted' in item:
+                    path = self._path_of(account, item['id'])
+                    if path is not None:
+                        self._delete_tree(account, path)
+                    continue
+                parent_path = folders.get(
+                    item.get('parentReference', {}).get('id'))
+                if parent_path is None:
+                    continue
+                path = parent_path + '/' + item['name']
+                old_path = self._path_of(account, item['id'])
+                if old_path is not None and old_path != path:
+                    # 被移动或重命名，其下子文件夹的路径随之改变
+                    self._move_tree(account, old_path, path)
+                    prefix = old_path + '/'
+                    for folder_id, folder_path in folders.items():
+                        if folder_path.startswith(prefix):
+                            folders[folder_id] = \
+                                path + folder_path[len(old_path):]
+                if 'folder' in item:
+                    folders[item['id']] = path
+                rows.append(item_row(account, path, item))
+            with self._lock:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    rows)
+                self._conn.commit()
+            if new_delta_link:
+                self._set_delta_link(account, root_path, new_delta_link)
+        return changed
+
+    def _sync_children(self, access_token, account, root_path, root,
+                       throttle) -> int:
+        self._delete_tree(account, root_path)
+        rows = [item_row(account, root_path, root)]
+        dirs = [root_path]
+        while dirs:
+            d = dirs.pop()
+            for item in drive_api.list_children(access_token, d, throttle):
+                path = d + '/' + item['name']
+                if 'folder' in item:
+                    dirs.append(path)
+                rows.append(item_row(account, path, item))
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows)
+            self._conn.commit()
+        self._set_delta_link(account, root_path, '')
+        return len(rows)
+
+    def get(self, account: str, path: str) -> Optional[dict]:
+        """
+        :param account: 账号的唯一标识
+        :param path: OneDrive路径
+        :return: 子项信息，不存在时返回None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT item_id, is_folder, size, quick_xor_hash, e_tag '
+                'FROM items WHERE account = ? AND path = ?',
+                (account, path.rstrip('/'))).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('item_id', 'is_folder', 'size', 'quick_xor_hash',
+                         'e_tag'), row))
+
+    def add(self, account: str, path: str, item: dict):
+        """
+        上传文件或创建文件夹后更新缓存
+        :param item: 接口返回的driveItem
+        """
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?)',
+                item_row(account, path.rstrip('/'), item))
+            self._conn.commit()
+
+    def _path_of(self, account: str, item_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT path FROM items WHERE account = ? AND item_id = ?',
+                (account, item_id)).fetchone()
+        return row[0] if row else None
+
+    def _delete_tree(self, account: str, path: str):
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM items WHERE account = ? AND (path = ? '
+                'OR (path >= ? AND path < ?))',
+                (account, path, path + '/', path + chr(ord('/') + 1)))
+            self._conn.commit()
+
+    def _move_tree(self, account: str, old_path: str, new_path: str):
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM items WHERE account = ? AND path = ?',
+                (account, old_path))
+            self._conn.execute(
+                'UPDATE items SET path = ? || substr(path, ?) '
+                'WHERE account = ? AND path >= ? AND path < ?',
+                (new_path, len(old_path) + 1, account, old_path + '/',
+                 old_path + chr(ord('/') + 1)))
+            self._conn.commit()
+
+    def _get_delta_link(self, account: str, root_path: str) -> str:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT delta_link FROM sync_state '
+                'WHERE account = ? AND root_path = ?',
+                (account, root_path)).fetchone()
+        return row[0] if row else ''
+
+    def _set_delta_link(self, account: str, root_path: str, delta_link: str):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                (account, root_path, delta_link))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def item_row(account: str, path: str, item: dict) -> tuple:
+    hashes = item.get('file', {}).get('hashes', {})
+    return (account, path, item['id'], int('folder' in item),
+            item.get('size', 0), hashes.get('quickXorHash', ''),
+            item.get('eTag', ''))
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import dataclasses
+import fnmatch
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+import app_config
+from utils import color_print
+from utils.telemetry import telemetry
+
+# 每个hash任务的文件数量，减少提交任务的次数
+HASH_TASK_SIZE = 64
+
+
+@dataclasses.dataclass
+class ScanOptions:
+    # 只上传匹配其中一个模式的文件，为空时不限制
+    include: List[str] = dataclasses.field(default_factory=list)
+    # 不上传匹配的文件，匹配的目录不再遍历
+    exclude: List[str] = dataclasses.field(default_factory=list)
+    # 遍历的最大深度，0为只上传目录下的文件，-1为不限制
+    max_depth: int = -1
+    # 同时遍历目录的线程数
+    walkers: int = app_config.UPLOAD_SCAN_WALKERS
+    # 计算cid的线程数，0为在遍历线程中计算
+    hash_threads: int = app_config.UPLOAD_SCAN_HASH_THREADS
+
+
+class ScanEntry(NamedTuple):
+    path: str
+    # 相对于扫描目录的目录路径，以/分隔，根目录为空字符串
+    rel_dir: str
+    stat: os.stat_result
+    # 没有选中或没有计算时为空字符串
+    cid_hash: str
+
+
+class DirectoryScanner:
+    """
+    使用多个线程同时遍历目录（os.scandir），由select根据大小和修改时间选出可能需要上传的文件，
+    在线程池中计算这些文件的cid（每个文件只读取约60KB，主要是等待磁盘，计算sha1时不占用GIL）。迭代时按目录依次得到扫描结果，不等待整个目录扫描完成，
+    扫描、计算hash与上传同时进行
+    """
+
+    def __init__(self,
+                 root: str,
+                 options: Optional[ScanOptions] = None,
+                 select: Optional[Callable[[str, str, os.stat_result],
+                                           bool]] = None,
+                 stop_event: Optional[threading.Event] = None):
+        """
+        :param root: 扫描的目录
+        :param options: 过滤条件和并发数
+        :param select: 参数为文件路径、相对目录和stat，返回False时跳过该文件，不计算cid。
+            为None时选中所有文件，但不计算cid
+        :param stop_event: 设置后停止扫描
+        """
+        self.root = root
+        self.options = options or ScanOptions()
+        self.select = select
+        self.stop_event = stop_event or threading.Event()
+        self.dirs = 0
+        self.files = 0
+        self.skipped = 0
+        self.hashed = 0
+        self.scan_time = 0.0
+        # 至少有一个hash任务在进行的时间
+        self.hash_time = 0.0
+        self._lock = threading.Lock()
+        self._hashing = 0
+        self._hash_start = 0.0
+        self._dirs: queue.Queue = queue.Queue()
+        # 扫描结果 (相对目录, [ScanEntry])，上传跟不上时扫描暂停
+        self._results: queue.Queue = queue.Queue(maxsize=1024)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._closed = threading.Event()
+        self._start = 0.0
+
+    def __iter__(self) -> Iterator[Tuple[str, List[ScanEntry]]]:
+        self._start = time.time()
+        if self.select is not None and self.options.hash_threads > 0:
+            self._executor = ThreadPoolExecutor(self.options.hash_threads)
+        walkers = [threading.Thread(target=self._walk, daemon=True)
+                   for _ in range(max(self.options.walkers, 1))]
+        self._dirs.put((self.root, '', 0))
+        for t in walkers:
+            t.start()
+        threading.Thread(target=self._finish, args=(walkers,),
+                         daemon=True).start()
+        try:
+            while True:
+                item = self._results.get()
+                if item is None:
+                    break
+                yield item
+        finally:
+            # 没有迭代完时（例如上传出错）停止遍历
+            self._closed.set()
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+        telemetry.record('scan', dirs=self.dirs, files=self.files,
+                         skipped=self.skipped, hashed=self.hashed,
+                         scan_time=self.scan_time, hash_time=self.hash_time)
+
+    def _stopped(self) -> bool:
+        return self.stop_event.is_set() or self._closed.is_set()
+
+    def _put(self, item):
+        # 迭代已结束时不再等待队列中的空位
+        while not self._closed.is_set():
+            try:
+                self._results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _finish(self, walkers: List[threading.Thread]):
+        self._dirs.join()
+        for _ in walkers:
+            self._dirs.put(None)
+        for t in walkers:
+            t.join()
+        # 扫描用时不包括等待上传取走结果的时间
+        self.scan_time = time.time() - self._start
+        self._put(None)
+
+    def _walk(self):
+        while True:
+            item = self._dirs.get()
+            if item is None:
+                return
+            try:
+                if not self._stopped():
+                    self._scan_dir(*item)
+            except Exception as e:
+                if not self._stopped():
+                    color_print.r('扫描目录失败: %s, %s' % (item[0], e))
+            finally:
+                self._dirs.task_done()
+
+    def _scan_dir(self, path: str, rel_dir: str, depth: int):
+        options = self.options
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            color_print.y('无法读取目录: %s, %s' % (path, e))
+            return
+        files = []
+        skipped = 0
+        for entry in entries:
+            rel = rel_dir + '/' + entry.name if rel_dir else entry.name
+            try:
+                # 与os.walk相同，不进入指向目录的符号链接
+                if entry.is_dir(follow_symlinks=False):
+                    if (options.max_depth < 0 or depth < options.max_depth) \
+                            and not matches(options.exclude, rel, entry.name):
+                        self._dirs.put((entry.path.replace('\\', '/'), rel,
+                                        depth + 1))
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                skipped += 1
+                continue
+            if matches(options.exclude, rel, entry.name) or (
+                    options.include
+                    and not matches(options.include, rel, entry.name)):
+                continue
+            file_path = entry.path.replace('\\', '/')
+            if stat.st_size <= 0 or (
+                    self.select is not None
+                    and not self.select(file_path, rel_dir, stat)):
+                skipped += 1
+                continue
+            files.append((file_path, stat))
+
+        hashes = [''] * len(files)
+        if self.select is not None and files:
+            hashes = self._hash([(p, s.st_size) for p, s in files])
+        result = []
+        for (file_path, stat), cid in zip(files, hashes):
+            if cid is None:
+                skipped += 1
+            else:
+                result.append(ScanEntry(file_path, rel_dir, stat, cid))
+        with self._lock:
+            self.dirs += 1
+            self.files += len(result) + skipped
+            self.skipped += skipped
+        if result:
+            self._put((rel_dir, result))
+
+    def _hash(self, files: List[Tuple[str, int]]) -> List[Optional[str]]:
+        with self._lock:
+            if self._hashing == 0:
+                self._hash_start = time.perf_counter()
+            self._hashing += 1
+        try:
+            if self._executor is None:
+                return hash_files(files)
+            futures = [self._executor.submit(
+                hash_files, files[i:i + HASH_TASK_SIZE])
+                for i in range(0, len(files), HASH_TASK_SIZE)]
+            return [h for f in futures for h in f.result()]
+        finally:
+            with self._lock:
+                self._hashing -= 1
+                self.hashed += len(files)
+                if self._hashing == 0:
+                    self.hash_time += time.perf_counter() - self._hash_start
+
+    def print_stats(self):
+        """
+        输出扫描和计算hash的速度，与上传速度分开统计
+        """
+        color_print.b('扫描: %d个目录, %d个文件, 用时 %.1fs, %d个文件/s; '
+                      '计算hash: %d个文件, 用时 %.1fs, %d个文件/s' % (
+                          self.dirs, self.files, self.scan_time,
+                          self.files / self.scan_time
+                          if self.scan_time > 0 else 0,
+                          self.hashed, self.hash_time,
+                          self.hashed / self.hash_time
+                          if self.hash_time > 0 else 0))
+
+
+def hash_files(files: List[Tuple[str, int]]) -> List[Optional[str]]:
+    """
+    :param files: [(文件路径, 大小)]
+    :return: 每个文件的cid，无法读取时为None
+    """
+    hashes = []
+    for path, size in files:
+        try:
+            hashes.append(cid_hash_file(path, size))
+        except OSError:
+            hashes.append(None)
+    return hashes
+
+
+def cid_hash_file(path: str, size: int = -1):
+    """
+    计算文件名为cid的hash值，算法来源：https://github.com/iambus/xunlei-lixian
+    :param path: 需要计算的本地文件路径
+    :param size: 文件大小，-1时读取
+    :return: 所给路径对应文件的cid值
+    """
+    h = hashlib.sha1()
+    if size < 0:
+        size = os.path.getsize(path)
+    with open(path, 'rb') as stream:
+        if size < 0xF000:
+            h.update(stream.read())
+        else:
+            h.update(stream.read(0x5000))
+            stream.seek(size // 3)
+            h.update(stream.read(0x5000))
+            stream.seek(size - 0x5000)
+            h.update(stream.read(0x5000))
+    return h.hexdigest()
+
+
+def matches(patterns: List[str], rel_path: str, name: str) -> bool:
+    """
+    :return: 相对路径或文件名是否匹配其中一个glob模式
+    """
+    return any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(name, p)
+               for p in patterns)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import collections
+import dataclasses
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Iterable, Iterator, List, Optional, Tuple
+
+import app_config
+from graph import drive_api
+from graph.throttle import get_controller
+from helpers.upload_helper import (UploadHelper, UploadInfo, checkpoint_key,
+                                   discard_session)
+
+# 预读上传队列的文件数上限，队列中大部分是小文件时不会一直读下去
+MAX_LOOKAHEAD = 256
+
+
+class SessionPrefetcher:
+    """
+    迭代上传队列时预读后面的文件，在线程池中同时为其中最多depth个大文件创建上传会话，
+    上传到这些文件时直接使用已创建的会话，创建会话的请求与前面文件的上传同时进行。
+    上传结束后（包括停止和出错）取消没有使用的会话
+    """
+
+    def __init__(self,
+                 depth: int,
+                 min_size: int,
+                 create: Callable[[object], bool],
+                 cancel: Callable[[object], None],
+                 stop_event: Optional[threading.Event] = None):
+        """
+        :param depth: 同时提前创建会话的文件数量
+        :param min_size: 大于此大小（字节）的文件使用上传会话上传
+        :param create: 为文件创建上传会话并保存到断点续传信息中，返回是否创建了会话
+        :param cancel: 会话还没有被使用时删除会话和断点续传信息
+        :param stop_event: 设置后不再创建会话
+        """
+        self.depth = max(depth, 1)
+        self.min_size = min_size
+        self.create = create
+        self.cancel = cancel
+        self.stop_event = stop_event or threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.depth)
+        self._lock = threading.Lock()
+        # 创建了会话的文件，结束时检查是否都已使用
+        self._prefetched: List[object] = []
+
+    def prefetch(self, infos: Iterable) -> Iterator:
+        """
+        按原来的顺序迭代上传队列，取出大文件前等待它的会话创建完成
+        """
+        # (上传信息, 创建会话的Future，不需要创建时为None)
+        pending: Deque[Tuple[object, Optional[Future]]] = collections.deque()
+        creating = 0
+        it = iter(infos)
+        exhausted = False
+        while True:
+            while not exhausted and creating < self.depth \
+                    and len(pending) < MAX_LOOKAHEAD:
+                info = next(it, None)
+                if info is None:
+                    exhausted = True
+                    break
+                future = None
+                if info.size > self.min_size and not self.stop_event.is_set():
+                    future = self._executor.submit(self._create, info)
+                    creating += 1
+                pending.append((info, future))
+            if not pending:
+                return
+            info, future = pending.popleft()
+            if future is not None:
+                creating -= 1
+                wait([future])
+            yield info
+
+    def _create(self, info):
+        if self.stop_event.is_set():
+            return
+        try:
+            created = self.create(info)
+        except Exception:
+            # 创建失败时由上传时再创建并报告错误
+            return
+        if created:
+            with self._lock:
+                self._prefetched.append(info)
+
+    def close(self):
+        """
+        所有文件上传结束后调用，取消没有使用的会话
+        """
+        self._executor.shutdown(cancel_futures=True)
+        for info in self._prefetched:
+            try:
+                self.cancel(info)
+            except Exception:
+                pass
+        self._prefetched = []
+
+
+def precreate_session(helper: UploadHelper, info: UploadInfo) -> bool:
+    """
+    为排队的大文件创建上传会话，保存到断点续传信息中，开始上传时直接使用
+    :return: 是否创建了会话
+    """
+    key = checkpoint_key(info)
+    if helper.checkpoints.get(key) is not None:
+        # 已有未完成的上传，开始上传时续传
+        return False
+    account = info.onedrive_account
+    resp_json = drive_api.create_upload_session(
+        helper._access_token(account), info.filename,
+        info.onedrive_dir_path + info.filename,
+        get_controller(account['home_account_id'],
+                       app_config.THROTTLE_MAX_INFLIGHT),
+        info.conflict_behavior, info.parent_id).json()
+    if 'uploadUrl' not in resp_json:
+        # 开始上传时重新创建，由上传报告错误
+        return False
+    # 不修改排队中的上传信息，上传时从断点续传信息中读取会话
+    session = dataclasses.replace(
+        info, upload_url=resp_json['uploadUrl'],
+        expiration=resp_json.get('expirationDateTime', ''),
+        precreated=True)
+    helper.checkpoints.save(key, dataclasses.asdict(session), sync=True)
+    return True
+
+
+def cancel_precreated(helper: UploadHelper, info: UploadInfo):
+    """
+    删除提前创建但没有使用的上传会话，例如上传被停止
+    """
+    key = checkpoint_key(info)
+    cached = helper.checkpoints.get(key)
+    if cached is None or not cached.get('precreated'):
+        return
+    helper.checkpoints.delete(key)
+    discard_session(UploadInfo(**cached))
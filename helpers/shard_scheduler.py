@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import app_config
+from graph import drive_api
+from graph.throttle import get_controller
+from helpers.scanner import DirectoryScanner, ScanEntry
+from helpers.upload_helper import (UploadHelper, UploadInfo, checkpoint_key,
+                                   create_upload_info, print_summary,
+                                   sigint_stop)
+from utils import color_print
+from utils.progress import human_size, progress
+
+# 账号被限流的剩余时间超过此秒数时，空闲账号接管它排队中的任务
+STEAL_AFTER = 5
+
+
+def is_quota_error(error: str) -> bool:
+    """
+    :param error: 上传失败的错误信息
+    :return: 是否因为账号的存储空间不足而失败
+    """
+    return 'quotaLimitReached' in error or 'insufficientStorage' in error \
+        or 'status 507' in error
+
+
+class ShardScheduler:
+    """
+    将上传任务分配到多个账号。
+    开始时按任务大小从大到小，依次分配给已分配字节数最少、且剩余空间足够的账号；
+    上传过程中，所有有任务的账号都被限流时，空闲账号接管被限流账号排队中的任务；
+    某个账号的空间不足时，它排队中的任务转移到其他账号。
+    任务是一组文件，每个文件有size属性
+    """
+
+    def __init__(self,
+                 accounts: List[dict],
+                 remaining: Dict[str, int],
+                 paused_for: Callable[[str], float],
+                 retarget: Callable[[list, dict], None],
+                 steal_after: float = STEAL_AFTER):
+        """
+        :param accounts: 参与上传的账号
+        :param remaining: home_account_id -> 账号剩余的字节数
+        :param paused_for: 参数为home_account_id，返回账号因被限流还需暂停的秒数
+        :param retarget: 任务转移到其他账号时调用，参数为任务和新的账号
+        :param steal_after: 被限流的剩余时间超过此秒数时才转移任务
+        """
+        self.accounts = {a['home_account_id']: a for a in accounts}
+        self.remaining = dict(remaining)
+        self.paused_for = paused_for
+        self.retarget = retarget
+        self.steal_after = steal_after
+        # home_account_id -> 已分配的字节数
+        self.load: Dict[str, int] = {a: 0 for a in self.accounts}
+        # home_account_id -> 排队中的(任务, 是否可以转移到其他账号)
+        self.queues: Dict[str, Deque[Tuple[list, bool]]] = {
+            a: collections.deque() for a in self.accounts}
+        self.queued: Dict[str, int] = {a: 0 for a in self.accounts}
+        # 空间不足的账号
+        self.full = set()
+        # 转移到其他账号的任务数
+        self.moved = 0
+        self._running = 0
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def task_size(task: list) -> int:
+        return sum(i.size for i in task)
+
+    def _choose(self, size: int, exclude: Sequence[str] = ()) -> Optional[str]:
+        candidates = [a for a in self.accounts
+                      if a not in self.full and a not in exclude
+                      and self.remaining[a] >= size]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda a: self.load[a])
+
+    def _push(self, account_id: str, task: list, movable: bool):
+        size = self.task_size(task)
+        self.queues[account_id].append((task, movable))
+        self.queued[account_id] += size
+        self.load[account_id] += size
+        self.remaining[account_id] -= size
+
+    def _pop(self, account_id: str, index: int = 0) -> Tuple[list, bool]:
+        queue = self.queues[account_id]
+        task, movable = queue[index]
+        del queue[index]
+        size = self.task_size(task)
+        self.queued[account_id] -= size
+        return task, movable
+
+    def _unassign(self, account_id: str, task: list):
+        size = self.task_size(task)
+        self.load[account_id] -= size
+        self.remaining[account_id] += size
+
+    def assign(self, tasks: List[list],
+               exclude: Sequence[str] = ()) -> List[list]:
+        """
+        按大小均衡地分配任务，任务可以在上传过程中转移到其他账号
+        :param exclude: 不分配给这些账号
+        :return: 没有账号的剩余空间足够的任务
+        """
+        rejected = []
+        with self._cond:
+            for task in sorted(tasks, key=self.task_size, reverse=True):
+                account_id = self._choose(self.task_size(task), exclude)
+                if account_id is None:
+                    rejected.append(task)
+                    continue
+                if task[0].onedrive_account.get('home_account_id') \
+                        != account_id:
+                    self.retarget(task, self.accounts[account_id])
+                self._push(account_id, task, True)
+            self._cond.notify_all()
+        return rejected
+
+    def add(self, account_id: str, task: list):
+        """
+        添加只能上传到指定账号的任务，例如覆盖该账号上已上传的文件
+        """
+        with self._cond:
+            self._push(account_id, task, False)
+            self._cond.notify_all()
+
+    def next(self, stop_event: Optional[threading.Event] = None
+             ) -> Optional[Tuple[str, list]]:
+        """
+        取出下一个任务，完成后需要调用done。
+        优先从没有被限流的账号中排队字节数最多的账号取出
+        :return: (home_account_id, 任务)，没有任务或stop_event被设置时返回None
+        """
+        with self._cond:
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    return None
+                busy = [a for a in self.accounts if self.queues[a]]
+                if busy:
+                    break
+                if self._running == 0:
+                    return None
+                # 正在上传的任务可能因空间不足转移回队列
+                self._cond.wait(1)
+
+            paused = {a: self.paused_for(a) for a in self.accounts}
+            ready = [a for a in busy if paused[a] <= 0]
+            if ready:
+                account_id = max(ready, key=lambda a: self.queued[a])
+                task, _ = self._pop(account_id)
+            else:
+                item = self._steal(busy, paused)
+                if item is None:
+                    # 没有可以接管的账号，等待最先恢复的账号
+                    account_id = min(busy, key=lambda a: paused[a])
+                    task, _ = self._pop(account_id)
+                else:
+                    account_id, task = item
+            self._running += 1
+            return account_id, task
+
+    def _steal(self, busy: List[str],
+               paused: Dict[str, float]) -> Optional[Tuple[str, list]]:
+        idle = [a for a in self.accounts
+                if a not in busy and paused[a] <= 0]
+        if not idle:
+            return None
+        exclude = [a for a in self.accounts if a not in idle]
+        for account_id in sorted(busy, key=lambda a: paused[a], reverse=True):
+            if paused[account_id] < self.steal_after:
+                continue
+            # 从队尾开始，队首的任务可能很快就会被原账号取出
+            queue = self.queues[account_id]
+            for index in range(len(queue) - 1, -1, -1):
+                task, movable = queue[index]
+                if not movable:
+                    continue
+                target = self._choose(self.task_size(task), exclude)
+                if target is None:
+                    continue
+                self._pop(account_id, index)
+                self._unassign(account_id, task)
+                self.retarget(task, self.accounts[target])
+                self.load[target] += self.task_size(task)
+                self.remaining[target] -= self.task_size(task)
+                self.moved += 1
+                return target, task
+        return None
+
+    def done(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    def quota_exceeded(self, account_id: str,
+                       failed: List[list]) -> List[list]:
+        """
+        账号的空间不足时调用，该账号排队中可以转移的任务和因空间不足失败的任务转移到其他账号
+        :param failed: 因空间不足失败的任务
+        :return: 没有其他账号可以接收的任务
+        """
+        with self._cond:
+            self.full.add(account_id)
+            self.remaining[account_id] = 0
+            queue = self.queues[account_id]
+            tasks = list(failed)
+            for index in range(len(queue) - 1, -1, -1):
+                if queue[index][1]:
+                    task, _ = self._pop(account_id, index)
+                    tasks.append(task)
+            self.moved += len(tasks)
+        return self.assign(tasks, [account_id])
+
+    def drain(self) -> List[list]:
+        """
+        停止上传时取出所有排队中的任务
+        """
+        with self._cond:
+            tasks = []
+            for account_id in self.accounts:
+                while self.queues[account_id]:
+                    tasks.append(self._pop(account_id)[0])
+            return tasks
+
+
+def upload_dir_sharded(helper: UploadHelper,
+                       local_dir_path: str,
+                       onedrive_dir_path: str,
+                       onedrive_users: List[str],
+                       workers: int = app_config.UPLOAD_WORKERS,
+                       batch: bool = app_config.UPLOAD_BATCH):
+    """
+    递归上传目录，文件分散上传到多个账号的OneDrive，每个账号单独限流。
+    按文件大小均衡分配，已上传到某个账号的文件仍上传到该账号；
+    上传过程中某个账号被限流或空间不足时，排队中的文件转移到其他账号
+    :param local_dir_path: 本地目录路径
+    :param onedrive_dir_path: 上传到的OneDrive目录的路径，每个账号相同
+    :param onedrive_users: 参与上传的用户，为空时使用token_cache中的所有用户
+    :param workers: 同时上传的文件数量
+    :param batch: 是否使用$batch批量创建文件夹和上传小文件
+    :return: 各个文件的上传信息
+    """
+    local_dir_path, onedrive_dir_path = helper._resolve_dirs(
+        local_dir_path, onedrive_dir_path)
+    accounts = []
+    for user in onedrive_users:
+        account = helper._get_account(user)
+        if account not in accounts:
+            accounts.append(account)
+    if not onedrive_users:
+        accounts = helper.msal_auth.get_accounts()
+    if not accounts:
+        raise Exception('no account in token cache')
+
+    # 上传前检查每个账号的剩余空间
+    remaining = {}
+    for account in accounts:
+        account_id = account['home_account_id']
+        quota = drive_api.get_drive(
+            helper._access_token(account),
+            get_controller(account_id,
+                           app_config.THROTTLE_MAX_INFLIGHT))['quota']
+        remaining[account_id] = 0 if quota.get('state') == 'exceeded' \
+            else quota.get('remaining',
+                           quota.get('total', 0) - quota.get('used', 0))
+        color_print.b('账号 %s: 剩余空间 %s' % (
+            account.get('username'), human_size(remaining[account_id])))
+        helper._sync_remote_tree(account, onedrive_dir_path)
+
+    # 本地文件路径 -> 只能上传到的账号
+    pinned = {}
+
+    def plan(entry: ScanEntry, one_dir: str) -> Optional[UploadInfo]:
+        path = entry.path
+        remote_path = one_dir + os.path.basename(path)
+        for a in accounts:
+            a_id = a['home_account_id']
+            if (helper.upload_index is not None
+                and helper.upload_index.get(a_id, path, remote_path)) \
+                    or (helper.remote_tree is not None
+                        and helper.remote_tree.get(a_id, remote_path)):
+                # 已上传到该账号，检查是否变化
+                info = helper._plan(path, one_dir, a, stat=entry.stat,
+                                  cid_hash=entry.cid_hash)
+                if info is not None:
+                    pinned[path] = a_id
+                return info
+        info = create_upload_info(path, one_dir, accounts[0],
+                                  helper.conflict_behavior, entry.stat,
+                                  entry.cid_hash)
+        cached = helper.checkpoints.get(checkpoint_key(info))
+        if cached is not None:
+            # 未完成的上传在原账号上续传
+            a_id = cached['onedrive_account'].get('home_account_id')
+            for a in accounts:
+                if a['home_account_id'] == a_id:
+                    info.onedrive_account = a
+                    pinned[path] = a_id
+        return info
+
+    # 文件可能已上传到任意一个账号，扫描时不跳过，在进程池中计算所有文件的cid
+    scanner = DirectoryScanner(local_dir_path, helper.scan_options,
+                               lambda path, rel_dir, stat: True,
+                               helper.stop_event)
+    infos = []
+    skipped = 0
+    for planned, n in helper._scan(scanner, onedrive_dir_path, plan):
+        infos += planned
+        skipped += n
+    skipped += scanner.skipped
+
+    color_print.b('共%d个文件, %s, 分散上传到%d个账号, 同时上传%d个文件，按CTRL-C可停止上传'
+                  % (len(infos), human_size(sum(i.size for i in infos)),
+                     len(accounts), workers))
+    progress.plan(len(infos))
+    drive_api.transport.configure(workers)
+
+    def retarget(task: List[UploadInfo], account: dict):
+        for info in task:
+            info.onedrive_account = account
+            # 父目录的id和上传会话属于原账号，改为按路径重新上传
+            info.parent_id = ''
+            info.upload_url = ''
+            info.finished = 0
+            info.quick_xor_state = ''
+
+    scheduler = ShardScheduler(
+        accounts, remaining,
+        lambda a_id: get_controller(
+            a_id, app_config.THROTTLE_MAX_INFLIGHT).paused_for(),
+        retarget)
+    for account in accounts:
+        account_id = account['home_account_id']
+        for task in helper._split_tasks(
+                [i for i in infos if pinned.get(i.local_file_path)
+                 == account_id], batch):
+            scheduler.add(account_id, task)
+
+    results = []
+    lock = threading.Lock()
+
+    def reject(tasks: List[List[UploadInfo]]):
+        with lock:
+            for task in tasks:
+                for info in task:
+                    info.status = 'error'
+                    info.error = '所有账号的剩余空间都不足'
+                    color_print.r('上传失败. 文件: %s, %s' % (
+                        info.local_file_path, info.error))
+                results.extend(task)
+
+    reject(scheduler.assign(list(helper._split_tasks(
+        [i for i in infos if i.local_file_path not in pinned], batch))))
+    # home_account_id -> 已创建的文件夹
+    created = {a['home_account_id']: set() for a in accounts}
+    created_lock = threading.Lock()
+    for account in accounts:
+        helper._prepare_folders(
+            account, [i for i in infos if i.onedrive_account is account],
+            batch, created[account['home_account_id']])
+
+    def prepare_moved(account_id: str, task: List[UploadInfo]):
+        # 转移到此账号的任务（retarget清除了parent_id）开始时没有在此账号上准备文件夹。
+        # 创建文件夹并记录到此账号的目录树缓存中，改回使用父目录的id上传；
+        # 创建失败时按路径上传，服务器会自动创建缺少的父文件夹。
+        # 上传完成后按新的账号记录到上传索引中
+        moved = [i for i in task if not i.parent_id]
+        if not moved:
+            return
+        try:
+            with created_lock:
+                helper._prepare_folders(scheduler.accounts[account_id],
+                                      moved, batch, created[account_id])
+        except Exception as e:
+            color_print.y('创建文件夹失败，按路径上传: %s' % e)
+
+    def worker():
+        while True:
+            item = scheduler.next(helper.stop_event)
+            if item is None:
+                return
+            account_id, task = item
+            try:
+                prepare_moved(account_id, task)
+                r = helper._run_task(task, batch)
+                failed = [i for i in r if i.status == 'error'
+                          and is_quota_error(i.error)]
+                if failed:
+                    color_print.y('账号 %s 的剩余空间不足，其余文件上传到其他账号' %
+                                  scheduler.accounts[account_id].get(
+                                      'username'))
+                    for info in failed:
+                        info.status = 'pending'
+                        info.error = ''
+                    reject(scheduler.quota_exceeded(
+                        account_id, [[i] for i in failed]))
+                    failed_ids = set(id(i) for i in failed)
+                    r = [i for i in r if id(i) not in failed_ids]
+                with lock:
+                    results.extend(r)
+            finally:
+                scheduler.done()
+
+    start = time.time()
+    with sigint_stop(helper.stop_event):
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for f in [executor.submit(worker)
+                      for _ in range(max(workers, 1))]:
+                f.result()
+    for task in scheduler.drain():
+        for info in task:
+            info.status = 'stopped'
+        results.extend(task)
+    spend_time = time.time() - start
+
+    print_summary(results, skipped, spend_time)
+    scanner.print_stats()
+    for account in accounts:
+        done = [i for i in results if i.status == 'finished'
+                and i.onedrive_account is account]
+        color_print.b('  %s: 完成 %d 个文件, %s' % (
+            account.get('username'), len(done),
+            human_size(sum(i.size for i in done))))
+    if scheduler.moved > 0:
+        color_print.b('  转移到其他账号的任务: %d' % scheduler.moved)
+    return results
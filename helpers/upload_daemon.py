@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import app_config
+from graph.auth import MSALAuth
+from graph.token_broker import TokenBroker
+from helpers.checkpoint_store import CheckpointStore, default_store
+from helpers.job_queue import RESUMABLE_STATUS, JobQueue
+from helpers.remote_tree import RemoteTree
+from helpers.scanner import ScanOptions
+from helpers.upload_helper import (UploadHelper, UploadInfo, checkpoint_key,
+                                   discard_session, format_onedrive_dir_path)
+from helpers.upload_index import UploadIndex
+from utils import color_print
+from utils.control_socket import Address, ControlServer
+
+
+class UploadDaemon:
+    """
+    常驻进程，保持MSALAuth、token和HTTP连接池，从任务队列中取出任务上传。
+    任务通过控制socket提交，也可以由监视目录中新出现的文件自动提交。
+    每个任务使用单独的UploadHelper（单独的停止信号），共用token、索引、目录树缓存和断点续传信息
+    """
+
+    def __init__(self,
+                 msal_auth: MSALAuth,
+                 address: Address,
+                 jobs: Optional[JobQueue] = None,
+                 workers: int = app_config.DAEMON_JOBS,
+                 watches: Optional[List[Tuple[str, str, dict]]] = None,
+                 watch_interval: float = app_config.DAEMON_WATCH_INTERVAL,
+                 checkpoints: Optional[CheckpointStore] = None):
+        """
+        :param msal_auth: MSALAuth
+        :param address: 控制socket的地址
+        :param jobs: 任务队列，默认为app_config.DAEMON_JOB_DB
+        :param workers: 同时执行的任务数量
+        :param watches: 监视的目录 [(本地目录, OneDrive目录, 上传选项)]
+        :param watch_interval: 扫描监视目录的间隔（秒）。文件在两次扫描之间没有变化时才提交
+        :param checkpoints: 断点续传信息的存储，默认为default_store()
+        """
+        self.msal_auth = msal_auth
+        self.address = address
+        self.jobs = jobs or JobQueue()
+        self.workers = max(workers, 1)
+        self.watches = watches or []
+        self.watch_interval = watch_interval
+        self.tokens = TokenBroker(msal_auth)
+        self.upload_index = UploadIndex()
+        self.remote_tree = RemoteTree()
+        self.checkpoints = checkpoints or default_store()
+        # 任务id -> 正在执行该任务的UploadHelper
+        self._running: Dict[int, UploadHelper] = {}
+        # 任务id -> 上传停止后的状态：paused, cancelled
+        self._stopping: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self.stop_event = threading.Event()
+
+    def run(self):
+        """
+        运行直到收到stop请求或stop_event被设置。正在执行的任务停止后重新排队，下次启动时续传
+        """
+        server = ControlServer(self.address, self.handle).start()
+        threads = [threading.Thread(target=self._work, daemon=True)
+                   for _ in range(self.workers)]
+        if self.watches:
+            threads.append(threading.Thread(target=self._watch, daemon=True))
+        for t in threads:
+            t.start()
+        color_print.b('上传守护进程已启动: %s, 同时执行%d个任务' % (
+            self.address, self.workers))
+        try:
+            while not self.stop_event.wait(1):
+                pass
+        finally:
+            color_print.y('正在停止上传并保存信息')
+            self.stop_event.set()
+            self._wakeup.set()
+            with self._lock:
+                for helper in self._running.values():
+                    helper.stop_event.set()
+            for t in threads:
+                t.join()
+            server.close()
+            self.tokens.close()
+            self.checkpoints.flush()
+
+    def handle(self, request: dict) -> dict:
+        """
+        处理控制请求：ping, submit, status, list, pause, cancel, resume, stop
+        """
+        op = request.get('op')
+        if op == 'ping':
+            return {'ok': True}
+        if op == 'submit':
+            kind = request['kind']
+            if kind not in ('file', 'dir'):
+                raise ValueError('invalid job kind: %s' % kind)
+            local_path = os.path.abspath(request['local_path'])
+            if kind == 'file' and not os.path.isfile(local_path) \
+                    or kind == 'dir' and not os.path.isdir(local_path):
+                raise FileNotFoundError('%s is not a %s' % (local_path, kind))
+            job_id = self.jobs.submit(kind, local_path, request['one_dir'],
+                                      request.get('options'))
+            self._wakeup.set()
+            return {'ok': True, 'job': self.jobs.get(job_id)}
+        if op == 'status':
+            job = self.jobs.get(int(request['id']))
+            if job is None:
+                raise KeyError('no job %s' % request['id'])
+            return {'ok': True, 'job': job}
+        if op == 'list':
+            return {'ok': True, 'jobs': self.jobs.list(
+                request.get('status'), int(request.get('limit', 100)))}
+        if op in ('pause', 'cancel'):
+            return self._stop_job(int(request['id']),
+                                  'paused' if op == 'pause' else 'cancelled')
+        if op == 'resume':
+            job_id = int(request['id'])
+            if not self.jobs.update(job_id, 'queued',
+                                    expect=RESUMABLE_STATUS):
+                raise ValueError('job %d can not be resumed' % job_id)
+            self._wakeup.set()
+            return {'ok': True, 'job': self.jobs.get(job_id)}
+        if op == 'stop':
+            self.stop_event.set()
+            return {'ok': True}
+        raise ValueError('unknown op: %s' % op)
+
+    def _stop_job(self, job_id: int, status: str) -> dict:
+        with self._lock:
+            helper = self._running.get(job_id)
+            if helper is not None:
+                # 当前分片完成后停止，由执行任务的线程设置状态
+                self._stopping[job_id] = status
+                helper.stop_event.set()
+            elif self.jobs.update(job_id, status,
+                                  expect=('queued', 'paused')):
+                pass
+            elif (self.jobs.get(job_id) or {}).get('status') == 'running':
+                # 刚从队列中取出，还没有开始上传
+                self._stopping[job_id] = status
+            else:
+                raise ValueError('job %d is not queued, running or paused'
+                                 % job_id)
+        return {'ok': True, 'job': self.jobs.get(job_id)}
+
+    def _work(self):
+        while not self.stop_event.is_set():
+            job = self.jobs.take()
+            if job is None:
+                self._wakeup.wait(1)
+                self._wakeup.clear()
+                continue
+            self._run_job(job)
+
+    def _run_job(self, job: dict):
+        options = job['options']
+        helper = UploadHelper(
+            self.msal_auth,
+            None if options.get('no_index') else self.upload_index,
+            options.get('conflict', app_config.UPLOAD_CONFLICT_BEHAVIOR),
+            None if options.get('no_remote_tree') else self.remote_tree,
+            self.checkpoints,
+            options.get('engine', app_config.UPLOAD_ENGINE),
+            self.tokens,
+            scan_options=ScanOptions(options.get('include', []),
+                                     options.get('exclude', []),
+                                     options.get('max_depth', -1)))
+        with self._lock:
+            stopping = self._stopping.pop(job['id'], None)
+            if stopping is None:
+                self._running[job['id']] = helper
+        if stopping is not None:
+            self.jobs.update(job['id'], stopping)
+            return
+        color_print.b('开始任务%d: %s -> %s' % (job['id'], job['local_path'],
+                                           job['one_dir']))
+        results = []
+        error = ''
+        try:
+            # 其他进程（例如account.py）可能修改了token文件
+            with self.msal_auth.locked():
+                self.msal_auth.reload_token()
+            results = self._upload(helper, job)
+        except Exception as e:
+            error = str(e)
+        with self._lock:
+            del self._running[job['id']]
+            stopping = self._stopping.pop(job['id'], None)
+
+        result = {s: sum(1 for i in results if i.status == s)
+                  for s in ('finished', 'error', 'stopped')}
+        result['bytes'] = sum(i.size for i in results
+                              if i.status == 'finished')
+        # 在服务器上复制、不需要上传的字节数
+        result['saved'] = sum(i.size for i in results
+                              if i.status == 'finished' and i.copied_from)
+        if result['stopped']:
+            # 暂停、取消或守护进程停止（下次启动时继续）
+            status = stopping or 'queued'
+            if status == 'cancelled':
+                # 放弃未完成的上传会话，同时删除服务器上的会话释放已上传的部分
+                for info in results:
+                    if info.status == 'finished':
+                        continue
+                    key = checkpoint_key(info)
+                    cached = self.checkpoints.get(key)
+                    self.checkpoints.delete(key)
+                    if cached is not None:
+                        discard_session(UploadInfo(**cached))
+        elif error or result['error']:
+            status = 'error'
+            error = error or next(i.error for i in results
+                                  if i.status == 'error')
+        else:
+            status = 'finished'
+        self.jobs.update(job['id'], status, result, error)
+        color_print.b('任务%d: %s %s' % (job['id'], status, error))
+
+    def _upload(self, helper: UploadHelper, job: dict) -> List[UploadInfo]:
+        options = job['options']
+        workers = options.get('workers', app_config.UPLOAD_WORKERS)
+        batch = options.get('batch', app_config.UPLOAD_BATCH)
+        if job['kind'] == 'file':
+            info = helper.upload_file(job['local_path'], job['one_dir'],
+                                      options.get('user'))
+            return [info] if info is not None else []
+        if options.get('shard') is not None:
+            return helper.upload_dir_sharded(
+                job['local_path'], job['one_dir'], options['shard'], workers,
+                batch)
+        dedup = options.get('dedup', app_config.UPLOAD_DEDUP)
+        if options.get('pack'):
+            return helper.upload_dir_packed(
+                job['local_path'], job['one_dir'], options.get('user'),
+                workers, batch, dedup, options['pack'])
+        return helper.upload_dir(
+            job['local_path'], job['one_dir'], options.get('user'), workers,
+            batch, dedup)
+
+    def _watch(self):
+        """
+        定期扫描监视的目录，提交新增或修改过的文件。
+        文件在两次扫描之间大小和修改时间都没有变化时才提交，避免上传正在写入的文件
+        """
+        # 本地文件路径 -> 上次扫描时的(大小, 修改时间)
+        pending: Dict[str, Tuple[int, int]] = {}
+        while not self.stop_event.is_set():
+            for local_dir, one_dir, options in self.watches:
+                try:
+                    self._scan_watched(local_dir, one_dir, options, pending)
+                except OSError as e:
+                    color_print.r('扫描监视目录失败: %s, %s' % (local_dir, e))
+            self.stop_event.wait(self.watch_interval)
+
+    def _scan_watched(self, local_dir: str, one_dir: str, options: dict,
+                      pending: Dict[str, Tuple[int, int]]):
+        # 与upload_dir相同，上传到OneDrive目录下的同名目录
+        remote_root = format_onedrive_dir_path(one_dir) \
+            + os.path.basename(local_dir.rstrip('/'))
+        submitted = 0
+        for dir_path, _, filenames in os.walk(local_dir):
+            rel = os.path.relpath(dir_path, local_dir)
+            remote_dir = remote_root if rel == '.' \
+                else remote_root + '/' + rel.replace(os.sep, '/')
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                state = (stat.st_size, stat.st_mtime_ns)
+                if stat.st_size == 0 or self.jobs.watched(path) == state:
+                    continue
+                if pending.get(path) != state:
+                    pending[path] = state
+                    continue
+                del pending[path]
+                self.jobs.submit_watched(path, remote_dir, options, *state)
+                submitted += 1
+        if submitted:
+            color_print.b('监视目录%s: 提交%d个文件' % (local_dir, submitted))
+            self._wakeup.set()
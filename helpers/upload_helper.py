@@ -1,23 +1,42 @@
 # -*- coding: utf-8 -*-
+import calendar
+import contextlib
 import dataclasses
 import datetime
+import functools
+import glob
 import hashlib
 import json
 import math
 import os
 import signal
+import threading
 import time
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
 import requests
-from reprint import output
 
 import app_config
+from graph import batch as batch_api
 from graph import drive_api
 from graph.auth import MSALAuth
+from graph.throttle import (THROTTLE_STATUS, ThrottleController,
+                            all_controllers, get_controller)
+from graph.token_broker import TokenBroker
+from helpers.checkpoint_store import CheckpointStore, default_store
+from helpers.remote_tree import RemoteTree
+from helpers.scanner import (DirectoryScanner, ScanEntry, ScanOptions,
+                             cid_hash_file)
+from helpers.upload_index import UploadIndex
 from utils import color_print
-
-MAX_TITLE_LEN = 78
+from utils.bandwidth import request_body
+from utils.buffer_pool import FileSlice
+from utils.chunk_reader import (CHUNK_UNIT, AdaptiveChunkSize, ChunkReader,
+                                align_chunk_size, parse_ranges)
+from utils.progress import human_sec, human_size, progress
+from utils.quick_xor_hash import QuickXorHash, quick_xor_hash_file
+from utils.telemetry import TimedBody, telemetry
 
 
 @dataclasses.dataclass
@@ -36,12 +55,54 @@ class UploadInfo:
     finish_time: str = '---'
     status: str = 'pending'
     error: str = ''
+    uploaded: int = 0
+    chunk_size: int = 0
+    mtime_ns: int = 0
+    conflict_behavior: str = 'rename'
+    item_id: str = ''
+    e_tag: str = ''
+    parent_id: str = ''
+    # 已上传部分（finished个字节）的QuickXorHash状态，续传时用于校验本地文件
+    quick_xor_state: str = ''
+    quick_xor_hash: str = ''
+    # 在服务器上复制得到时，被复制的文件的id
+    copied_from: str = ''
+    # 上传会话的过期时间（UTC），每个分片完成后延长
+    expiration: str = ''
+    # 上传会话是提前创建的，还没有上传过任何分片，开始上传时不需要查询会话
+    precreated: bool = False
 
 
 class UploadHelper:
-    def __init__(self, msal_auth: MSALAuth):
+    def __init__(self,
+                 msal_auth: MSALAuth,
+                 upload_index: Optional[UploadIndex] = None,
+                 conflict_behavior: str = app_config.UPLOAD_CONFLICT_BEHAVIOR,
+                 remote_tree: Optional[RemoteTree] = None,
+                 checkpoints: Optional[CheckpointStore] = None,
+                 engine: str = app_config.UPLOAD_ENGINE,
+                 tokens: Optional[TokenBroker] = None,
+                 scan_options: Optional[ScanOptions] = None):
+        """
+        :param msal_auth: MSALAuth
+        :param upload_index: 已上传文件的索引，为None时不跳过任何文件
+        :param conflict_behavior: OneDrive上已存在同名文件时的处理方式：rename, replace, fail
+        :param remote_tree: OneDrive目录树缓存，上传目录时用于离线判断文件是否存在
+        :param checkpoints: 断点续传信息的存储，默认为default_store()
+        :param engine: 上传方式：blocking（每个文件一个线程）, async（asyncio，需要aiohttp）
+        :param tokens: 多个UploadHelper共用的TokenBroker，默认新建
+        :param scan_options: 上传目录时的过滤条件和扫描的并发数
+        """
         self.msal_auth = msal_auth
-        self.stop_flag = False
+        self.tokens = tokens or TokenBroker(msal_auth)
+        self.upload_index = upload_index
+        self.remote_tree = remote_tree
+        self.conflict_behavior = conflict_behavior
+        self.engine = engine
+        self.checkpoints = checkpoints or default_store()
+        import_upload_info_files(self.checkpoints)
+        self.scan_options = scan_options or ScanOptions()
+        self.stop_event = threading.Event()
 
     def upload_file(self,
                     local_file_path: str,
@@ -52,7 +113,7 @@ class UploadHelper:
         :param local_file_path: 本地文件路径
         :param onedrive_dir_path: 上传到的OneDrive目录的路径
         :param onedrive_user: 上传至此用户的OneDrive，默认为token_cache中的首个用户
-        :return:
+        :return: 上传信息，文件为空或已上传时为None
         """
         # 处理local_file_path
         local_file_path = strip_and_replace(local_file_path)
@@ -65,176 +126,802 @@ class UploadHelper:
             color_print.y('File size is 0, nothing to be uploaded.')
             return
 
-        # 处理onedrive_dir_path
-        onedrive_dir_path = strip_and_replace(onedrive_dir_path, True)
+        onedrive_dir_path = format_onedrive_dir_path(onedrive_dir_path)
+        account = self._get_account(onedrive_user)
 
-        if not onedrive_dir_path.startswith('/'):
-            onedrive_dir_path = '/' + onedrive_dir_path
+        # 上传单个文件时不同步目录树
+        info = self._plan(local_file_path, onedrive_dir_path, account, False)
+        if info is None:
+            color_print.g('文件已上传且没有变化，跳过. 文件: %s' % local_file_path)
+            return
+        progress.plan(1)
+        with sigint_stop(self.stop_event):
+            if self.engine == 'async':
+                return self._async_engine(1).run([info])[0]
+            info = self._upload(info, self.stop_event)
+        if info.status == 'finished':
+            color_print.g('上传成功. 文件: %s' % info.local_file_path)
+        elif info.status == 'stopped':
+            color_print.y('上传停止. 文件: %s' % info.local_file_path)
+        return info
+
+    def upload_dir(self,
+                   local_dir_path: str,
+                   onedrive_dir_path: str,
+                   onedrive_user: Optional[str] = None,
+                   workers: int = app_config.UPLOAD_WORKERS,
+                   batch: bool = app_config.UPLOAD_BATCH,
+                   dedup: bool = app_config.UPLOAD_DEDUP):
+        """
+        递归上传目录至OneDrive目录下，多个文件同时上传。
+        扫描目录、计算hash和上传同时进行，扫描到的文件立即开始上传
+        :param local_dir_path: 本地目录路径
+        :param onedrive_dir_path: 上传到的OneDrive目录的路径
+        :param onedrive_user: 上传至此用户的OneDrive，默认为token_cache中的首个用户
+        :param workers: 同时上传的文件数量
+        :param batch: 是否使用$batch批量创建文件夹和上传小文件
+        :param dedup: 内容相同的文件是否只上传一次，其余在服务器上复制
+        :return: 各个文件的上传信息
+        """
+        local_dir_path, onedrive_dir_path = self._resolve_dirs(
+            local_dir_path, onedrive_dir_path)
+        account = self._get_account(onedrive_user)
+        self._sync_remote_tree(account, onedrive_dir_path)
+
+        # 每个上传线程同时只有一个请求，连接池至少保持workers个连接
+        drive_api.transport.configure(workers)
+
+        # 在遍历目录的线程中根据上传索引跳过没有变化的文件，只计算其余文件的cid
+        scanner = DirectoryScanner(
+            local_dir_path, self.scan_options,
+            lambda path, rel_dir, stat: not self._index_record(
+                path, remote_dir_path(onedrive_dir_path, rel_dir), account,
+                True, stat)[0],
+            self.stop_event)
+        # 编排上传的模块依赖本模块，在使用时导入
+        from helpers.dedup import DuplicateFilter, copy_duplicates
+        duplicates = DuplicateFilter(
+            app_config.UPLOAD_DEDUP_MIN_SIZE * 1024) if dedup else None
+        skipped = 0
+        # 已创建的文件夹
+        created = set()
+
+        def planned():
+            nonlocal skipped
+            for infos, n in self._scan(
+                    scanner, onedrive_dir_path,
+                    lambda entry, one_dir: self._plan(
+                        entry.path, one_dir, account, stat=entry.stat,
+                        cid_hash=entry.cid_hash)):
+                skipped += n
+                self._prepare_folders(account, infos, batch, created)
+                if duplicates is not None:
+                    infos = duplicates.filter(infos)
+                yield from infos
+
+        color_print.b('正在扫描并上传, 同时上传%d个文件，按CTRL-C可停止上传' % workers)
+        start = time.time()
+        results = []
+        with sigint_stop(self.stop_event):
+            results = self._run_engine(planned(), workers, batch)
+            if duplicates is not None:
+                held, copies = duplicates.resolve(workers)
+                results += self._run_engine(held, workers, batch)
+                if copies:
+                    results += copy_duplicates(self, account, copies,
+                                               workers)
+        spend_time = time.time() - start
+
+        print_summary(results, skipped + scanner.skipped, spend_time)
+        scanner.print_stats()
+        return results
+
+    def upload_dir_packed(self,
+                          local_dir_path: str,
+                          onedrive_dir_path: str,
+                          onedrive_user: Optional[str] = None,
+                          workers: int = app_config.UPLOAD_WORKERS,
+                          batch: bool = app_config.UPLOAD_BATCH,
+                          dedup: bool = app_config.UPLOAD_DEDUP,
+                          compression: str =
+                          app_config.UPLOAD_PACK_COMPRESSION):
+        """
+        递归上传目录，小文件打包为tar分段上传，见pack.upload_dir_packed
+        """
+        # 编排上传的模块依赖本模块，在使用时导入
+        from helpers.pack import upload_dir_packed
+        return upload_dir_packed(self, local_dir_path, onedrive_dir_path,
+                                 onedrive_user, workers, batch, dedup,
+                                 compression)
+
+    def upload_dir_sharded(self,
+                           local_dir_path: str,
+                           onedrive_dir_path: str,
+                           onedrive_users: List[str],
+                           workers: int = app_config.UPLOAD_WORKERS,
+                           batch: bool = app_config.UPLOAD_BATCH):
+        """
+        递归上传目录，文件分散上传到多个账号的OneDrive，见shard_scheduler.upload_dir_sharded
+        """
+        # 编排上传的模块依赖本模块，在使用时导入
+        from helpers.shard_scheduler import upload_dir_sharded
+        return upload_dir_sharded(self, local_dir_path, onedrive_dir_path,
+                                  onedrive_users, workers, batch)
 
-        # 处理onedrive_user
+    def _run_engine(self, infos: Iterable[UploadInfo], workers: int,
+                    batch: bool) -> List[UploadInfo]:
+        """
+        同时上传多个文件
+        :param infos: 可以是扫描目录的迭代器，取得文件后立即开始上传
+        """
+        infos = progress.planned(infos)
+        prefetcher = None
+        if app_config.UPLOAD_SESSION_PREFETCH > 0:
+            # 为排队的大文件提前创建上传会话。编排上传的模块依赖本模块，在使用时导入
+            from helpers.session_prefetch import (SessionPrefetcher,
+                                                  cancel_precreated,
+                                                  precreate_session)
+            prefetcher = SessionPrefetcher(
+                app_config.UPLOAD_SESSION_PREFETCH, 4 * 1024 * 1024,
+                functools.partial(precreate_session, self),
+                functools.partial(cancel_precreated, self), self.stop_event)
+            infos = prefetcher.prefetch(infos)
+        try:
+            if self.engine == 'async':
+                # 所有文件单独上传，$batch只用于创建文件夹
+                return self._async_engine(workers).run(infos)
+            results = []
+            # 排队的任务数有上限，上传跟不上时暂停从迭代器取得文件
+            slots = threading.BoundedSemaphore(max(workers, 1) * 2)
+            futures = []
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                for task in self._split_tasks(infos, batch):
+                    slots.acquire()
+                    future = executor.submit(self._run_task, task, batch)
+                    future.add_done_callback(lambda _: slots.release())
+                    futures.append(future)
+                for future in futures:
+                    results += future.result()
+            return results
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+    def _async_engine(self, workers: int):
+        # asyncio引擎依赖aiohttp，只在使用时导入
+        from helpers.async_upload import AsyncUploadEngine
+        return AsyncUploadEngine(self, workers)
+
+    def _resolve_dirs(self, local_dir_path: str, onedrive_dir_path: str):
+        """
+        :return: (本地目录路径, 上传到的OneDrive目录路径)。本地目录上传到OneDrive目录下的同名目录
+        """
+        local_dir_path = strip_and_replace(local_dir_path)
+        if len(local_dir_path) > 1:
+            local_dir_path = local_dir_path.rstrip('/')
+
+        if not os.path.isdir(local_dir_path):
+            raise NotADirectoryError('%s is not a directory' % local_dir_path)
+
+        onedrive_dir_path = format_onedrive_dir_path(onedrive_dir_path)
+        dir_name = os.path.basename(local_dir_path)
+        if dir_name:
+            onedrive_dir_path += dir_name + '/'
+        return local_dir_path, onedrive_dir_path
+
+    def _sync_remote_tree(self, account: dict, onedrive_dir_path: str):
+        if self.remote_tree is not None:
+            self.remote_tree.sync(
+                self._access_token(account), account['home_account_id'],
+                onedrive_dir_path,
+                get_controller(account['home_account_id'],
+                               app_config.THROTTLE_MAX_INFLIGHT))
+
+    def _scan(self, scanner: DirectoryScanner, onedrive_dir_path: str,
+              plan: Callable[[ScanEntry, str], Optional[UploadInfo]]) \
+            -> Iterator[Tuple[List[UploadInfo], int]]:
+        """
+        按目录取得扫描结果
+        :param plan: 参数为扫描结果和OneDrive目录路径，返回None时跳过该文件
+        :return: 依次得到每个目录的 (需要上传的文件, 跳过的文件数)，
+            扫描时跳过的文件数为scanner.skipped
+        """
+        for rel_dir, entries in scanner:
+            one_dir = remote_dir_path(onedrive_dir_path, rel_dir)
+            infos = []
+            for entry in entries:
+                info = plan(entry, one_dir)
+                if info is not None:
+                    infos.append(info)
+            yield infos, len(entries) - len(infos)
+
+    def _prepare_folders(self, account: dict, infos: List[UploadInfo],
+                         batch: bool, created: Optional[set] = None):
+        """
+        批量创建文件夹，并设置父目录的id
+        :param created: 已创建的文件夹，分多次创建时不重复创建
+        """
+        if batch and infos:
+            self._create_folders(account,
+                                 set(i.onedrive_dir_path for i in infos),
+                                 created)
+        if self.remote_tree is not None:
+            # 使用父目录的id寻址，服务器不需要解析完整路径
+            for info in infos:
+                folder = self.remote_tree.get(account['home_account_id'],
+                                              info.onedrive_dir_path)
+                if folder is not None and folder['is_folder']:
+                    info.parent_id = folder['item_id']
+
+    def _split_tasks(self, infos: Iterable[UploadInfo],
+                     batch: bool) -> Iterator[List[UploadInfo]]:
+        """
+        小文件合并为$batch请求上传，其余文件单独上传
+        :return: 依次得到每个任务的文件
+        """
+        max_size = app_config.UPLOAD_BATCH_FILE_SIZE * 1024
+        splitter = batch_api.BatchSplitter(lambda i: i.size)
+        for info in infos:
+            if not batch or info.size > max_size:
+                yield [info]
+                continue
+            task = splitter.add(info)
+            if task is not None:
+                yield task
+        task = splitter.flush()
+        if task is not None:
+            yield task
+
+    def _run_task(self, task: List[UploadInfo],
+                  batch: bool) -> List[UploadInfo]:
+        if batch and all(i.size <= app_config.UPLOAD_BATCH_FILE_SIZE * 1024
+                         for i in task):
+            return self._upload_batch(task)
+        return [self._upload_one(i) for i in task]
+
+    def _upload_one(self, info: UploadInfo,
+                    record: bool = True) -> UploadInfo:
+        if self.stop_event.is_set():
+            info.status = 'stopped'
+            return info
+        try:
+            info = self._upload(info, self.stop_event, record)
+        except Exception as e:
+            info.status = 'error'
+            info.error = str(e)
+            color_print.r('上传失败. 文件: %s, %s' % (
+                info.local_file_path, info.error))
+            return info
+
+        if info.status == 'finished':
+            color_print.g('上传成功. 文件: %s' % info.local_file_path)
+        return info
+
+    def rebuild_index(self,
+                      local_dir_path: str,
+                      onedrive_dir_path: str,
+                      onedrive_user: Optional[str] = None):
+        """
+        根据OneDrive上已存在的文件重建本地目录的上传索引。
+        OneDrive上存在同一路径、大小和QuickXorHash都相同的文件视为已上传
+        :param local_dir_path: 本地目录路径
+        :param onedrive_dir_path: 上传到的OneDrive目录的路径，与upload_dir相同
+        :param onedrive_user: OneDrive用户，默认为token_cache中的首个用户
+        """
+        if self.upload_index is None:
+            raise Exception('upload index is disabled')
+
+        local_dir_path, onedrive_dir_path = self._resolve_dirs(
+            local_dir_path, onedrive_dir_path)
+        account = self._get_account(onedrive_user)
+
+        access_token = self._access_token(account)
+        throttle = get_controller(account['home_account_id'],
+                                  app_config.THROTTLE_MAX_INFLIGHT)
+        # OneDrive路径 -> 文件信息
+        remote_files = {}
+        if self.remote_tree is not None:
+            self.remote_tree.sync(access_token, account['home_account_id'],
+                                  onedrive_dir_path, throttle)
+        else:
+            dirs = [onedrive_dir_path]
+            while dirs:
+                d = dirs.pop()
+                for item in drive_api.list_children(access_token, d, throttle):
+                    if 'folder' in item:
+                        dirs.append(d + item['name'] + '/')
+                    elif 'file' in item:
+                        remote_files[d + item['name']] = {
+                            'item_id': item['id'],
+                            'size': item.get('size'),
+                            'quick_xor_hash': item.get('file', {}).get(
+                                'hashes', {}).get('quickXorHash', ''),
+                            'e_tag': item.get('eTag', '')
+                        }
+
+        def remote_file(remote_path: str):
+            if self.remote_tree is None:
+                return remote_files.get(remote_path)
+            item = self.remote_tree.get(account['home_account_id'],
+                                        remote_path)
+            return item if item and not item['is_folder'] else None
+
+        self.upload_index.clear(account['home_account_id'], local_dir_path)
+        infos = []
+        for root, _, files in os.walk(local_dir_path):
+            rel = os.path.relpath(root, local_dir_path).replace('\\', '/')
+            one_dir = onedrive_dir_path if rel == '.' else \
+                onedrive_dir_path + rel + '/'
+            for name in files:
+                item = remote_file(one_dir + name)
+                path = os.path.join(root, name).replace('\\', '/')
+                size = os.path.getsize(path)
+                if item is None or item['size'] != size \
+                        or not item['quick_xor_hash']:
+                    continue
+                # 大小相同时比较内容，OneDrive没有返回hash的文件不记录
+                if quick_xor_hash_file(path, size).base64() != \
+                        item['quick_xor_hash']:
+                    continue
+                info = create_upload_info(path, one_dir, account)
+                info.quick_xor_hash = item['quick_xor_hash']
+                info.item_id = item['item_id']
+                info.e_tag = item['e_tag']
+                info.status = 'finished'
+                info.finish_time = utc_datetime_str()
+                infos.append(info)
+        self.upload_index.record_many(infos)
+        color_print.g('索引重建完成. 已上传的本地文件: %d' % len(infos))
+
+    def _plan(self, local_file_path: str, onedrive_dir_path: str,
+              account: dict, synced: bool = True,
+              stat: Optional[os.stat_result] = None,
+              cid_hash: str = '') -> Optional[UploadInfo]:
+        """
+        根据上传索引判断文件是否需要上传
+        :param synced: 目录树缓存是否已同步了目标目录，未同步时不据此判断文件是否存在
+        :param stat: 扫描目录时得到的文件信息，为None时读取
+        :param cid_hash: 扫描目录时计算的cid，为空时计算
+        :return: 需要上传时返回上传信息，否则返回None
+        """
+        stat = stat or os.stat(local_file_path)
+        skip, record = self._index_record(local_file_path, onedrive_dir_path,
+                                          account, synced, stat)
+        if skip:
+            return None
+
+        info = create_upload_info(local_file_path, onedrive_dir_path, account,
+                                  self.conflict_behavior, stat, cid_hash)
+        if record is None:
+            return info
+        if record['size'] == info.size and record['content_hash'] \
+                and record['content_hash'] == quick_xor_hash_file(
+                    local_file_path, info.size).base64():
+            # 只有修改时间变化，整个文件的内容没有变化
+            self.upload_index.update_mtime(
+                account['home_account_id'], local_file_path,
+                onedrive_dir_path + info.filename, info.mtime_ns)
+            return None
+        # 文件已变化，覆盖上次上传的文件
+        info.conflict_behavior = 'replace'
+        return info
+
+    def _index_record(self, local_file_path: str, onedrive_dir_path: str,
+                      account: dict, synced: bool,
+                      stat: os.stat_result) -> Tuple[bool, Optional[dict]]:
+        """
+        不计算hash，只根据目录树缓存、文件大小和修改时间判断文件是否需要上传
+        :return: (是否跳过, 上传索引中的记录)
+        """
+        account_id = account['home_account_id']
+        remote_path = onedrive_dir_path + os.path.basename(local_file_path)
+        remote = None
+        remote_tree = self.remote_tree if synced else None
+        if remote_tree is not None:
+            remote = remote_tree.get(account_id, remote_path)
+            if remote is not None and self.conflict_behavior == 'fail':
+                # 已存在同名文件，上传必定失败
+                return True, None
+
+        if self.upload_index is None:
+            return False, None
+
+        record = self.upload_index.get(account_id, local_file_path,
+                                       remote_path)
+        if record and remote_tree is not None and remote is None:
+            # 上次上传的文件已在OneDrive上被删除，重新上传
+            record = None
+        if record and record['size'] == stat.st_size \
+                and record['mtime_ns'] == stat.st_mtime_ns:
+            return True, record
+        return False, record
+
+    def _get_account(self, onedrive_user: Optional[str] = None):
         users = self.msal_auth.get_accounts(onedrive_user)
         account = users[0] if len(users) > 0 else None
         if account is None:
             raise Exception('%s is a invalid user.' % onedrive_user)
+        return account
+
+    def _access_token(self, account: dict) -> str:
+        start = time.perf_counter()
+        token = self.tokens.access_token(account)
+        telemetry.record('token', account=account.get('username'),
+                         acquire_time=time.perf_counter() - start)
+        return token
+
+    def _create_folders(self, account: dict, dir_paths: set,
+                        created: Optional[set] = None):
+        """
+        使用$batch按层级创建文件夹，避免多个文件同时上传时重复创建同一个文件夹
+        :param dir_paths: OneDrive目录路径，以/结尾
+        :param created: 已创建的文件夹，不再创建，并加入本次创建的文件夹
+        """
+        folders = set()
+        for p in dir_paths:
+            parts = p.strip('/').split('/')
+            for i in range(1, len(parts) + 1):
+                if parts[i - 1]:
+                    folders.add('/' + '/'.join(parts[:i]))
+
+        account_id = account['home_account_id']
+        tree = self.remote_tree
+        if tree is not None:
+            # 只创建缓存中不存在的文件夹
+            folders = set(f for f in folders if tree.get(account_id, f) is None)
+        if created is not None:
+            folders -= created
+            created |= folders
+        if not folders:
+            return
 
-        info = UploadInfo(
-            filename=os.path.split(local_file_path)[1],
-            size=file_size,
-            local_file_path=local_file_path,
-            cid_hash=cid_hash_file(local_file_path),
-            onedrive_dir_path=onedrive_dir_path,
-            onedrive_account=account,
-            create_time=utc_datetime_str()
-        )
-        self._upload(info)
-
-    def upload_dir(self):
-        pass
-
-    def _upload(self, info: UploadInfo):
+        access_token = self._access_token(account)
+        throttle = get_controller(account_id, app_config.THROTTLE_MAX_INFLIGHT)
+        for depth in sorted(set(f.count('/') for f in folders)):
+            level = sorted(f for f in folders if f.count('/') == depth)
+            for b in batch_api.split_batches(level):
+                reqs = []
+                for f in b:
+                    parent = tree.get(account_id, f.rsplit('/', 1)[0]) \
+                        if tree is not None else None
+                    reqs.append(batch_api.create_folder_request(
+                        f, parent['item_id'] if parent else ''))
+                batch_api.send_batch(access_token, reqs, throttle)
+                for f, r in zip(b, reqs):
+                    if r.ok and tree is not None:
+                        tree.add(account_id, f, r.response)
+                    # 409: 文件夹已存在
+                    elif not r.ok and r.status != 409:
+                        color_print.y('创建文件夹失败: %s, %s' % (f, r.error()))
+
+    def _upload_batch(self, infos: List[UploadInfo]):
+        """
+        使用一个$batch请求上传多个小文件
+        """
+        if self.stop_event.is_set():
+            for info in infos:
+                info.status = 'stopped'
+            return infos
+
+        account = infos[0].onedrive_account
+        throttle = get_controller(account['home_account_id'],
+                                  app_config.THROTTLE_MAX_INFLIGHT)
+        size = sum(info.size for info in infos)
+        try:
+            with progress.transfer('$batch (%d个文件)' % len(infos), size,
+                                   files=len(infos)) as transfer:
+                access_token = self._access_token(account)
+                reqs = []
+                for info in infos:
+                    # 与upload_small_file相同，发送时再分块读取
+                    info.quick_xor_hash = quick_xor_hash_file(
+                        info.local_file_path, info.size).base64()
+                    reqs.append(batch_api.put_content_request(
+                        info.onedrive_dir_path + info.filename,
+                        FileSlice(info.local_file_path, 0, info.size),
+                        info.conflict_behavior, info.parent_id))
+                start = time.time()
+                batch_api.send_batch(access_token, reqs, throttle)
+                transfer.update(size, size)
+                transfer.completed = sum(1 for r in reqs if r.ok)
+        except Exception as e:
+            for info in infos:
+                info.status = 'error'
+                info.error = str(e)
+            color_print.r('批量上传失败. %d个文件, %s' % (len(infos), e))
+            return infos
+
+        spend_time = time.time() - start
+        for info, r in zip(infos, reqs):
+            error = r.error() if not r.ok else \
+                check_quick_xor_hash(info, r.response)
+            if not error:
+                info.spend_time = spend_time
+                info.speed = int(info.size / spend_time) \
+                    if spend_time > 0 else 0
+                info.finish_time = utc_datetime_str()
+                info.status = 'finished'
+                info.finished = info.uploaded = info.size
+                info.item_id = r.response.get('id', '')
+                info.e_tag = r.response.get('eTag', '')
+            else:
+                info.status = 'error'
+                info.error = error
+                color_print.r('上传失败. 文件: %s, %s' % (
+                    info.local_file_path, info.error))
+            record_file(info, 'batch', spend_time, info.status, info.error)
+
+        finished = [info for info in infos if info.status == 'finished']
+        if finished:
+            if self.upload_index is not None:
+                self.upload_index.record_many(finished)
+            color_print.g('批量上传成功. %d个文件' % len(finished))
+        return infos
+
+    def _upload(self,
+                info: UploadInfo,
+                stop_event: Optional[threading.Event] = None,
+                record: bool = True):
+        """
+        :param record: 上传完成后是否记录到上传索引
+        """
         # print('Local    file: ' + info.local_file_path)
         # print('Onedrive  dir: ' + info.onedrive_dir_path)
         # print('Onedrive user: ' + info.onedrive_account.get('username'))
-        token = self.msal_auth.acquire_token_silent(
-            self.msal_auth.oauth_settings.scopes, info.onedrive_account)
+        access_token = self._access_token(info.onedrive_account)
+        # 同一账号的所有上传共享限流状态
+        throttle = get_controller(info.onedrive_account['home_account_id'],
+                                  app_config.THROTTLE_MAX_INFLIGHT)
+
+        mode = 'small' if info.size <= 4 * 1024 * 1024 else 'session'
+        start = time.perf_counter()
+        try:
+            if mode == 'small':
+                info = upload_small_file(access_token, info, throttle)
+            else:
+                info = upload_large_file(access_token, info, stop_event,
+                                         throttle, self.checkpoints)
+        except Exception as e:
+            record_file(info, mode, time.perf_counter() - start, 'error',
+                        str(e))
+            raise e
+        record_file(info, mode, time.perf_counter() - start)
 
-        if info.size <= 4 * 1024 * 1024:
-            return upload_small_file(token['access_token'], info)
+        if record and self.upload_index is not None \
+                and info.status == 'finished':
+            self.upload_index.record(info)
+        return info
 
-        return upload_large_file(token['access_token'], info)
 
+def print_summary(results: List[UploadInfo], skipped: int, spend_time: float):
+    """
+    输出多个文件上传的汇总信息
+    """
+    finished = [i for i in results if i.status == 'finished']
+    failed = [i for i in results if i.status == 'error']
+    stopped = [i for i in results
+               if i.status not in ('finished', 'error')]
+    # 只计算本次运行上传的字节数
+    uploaded = sum(i.uploaded for i in results)
+
+    summary = '完成: %d, 失败: %d, 停止: %d, 跳过: %d. ' % (
+        len(finished), len(failed), len(stopped), skipped)
+    summary += '上传 %s, 用时 %s, 平均速度 %s/s' % (
+        human_size(uploaded), human_sec(int(spend_time)),
+        human_size(int(uploaded / spend_time) if spend_time > 0 else 0))
+    throttle_stats = [c.stats() for c in all_controllers().values()]
+    throttle_events = sum(t['throttle_events'] for t in throttle_stats)
+    saved = sum(i.size for i in results
+                if i.status == 'finished' and i.copied_from)
+    if saved > 0:
+        summary += '. 服务器复制节省 %s' % human_size(saved)
+    if throttle_events > 0:
+        summary += '. 被限流 %d 次, 等待 %s' % (
+            throttle_events,
+            human_sec(int(sum(t['backoff_time'] for t in throttle_stats))))
+    conn_stats = drive_api.transport.stats().values()
+    num_requests = sum(c['requests'] for c in conn_stats)
+    if num_requests > 0:
+        summary += '. 请求 %d 次, 新建连接 %d 个' % (
+            num_requests, sum(c['connections'] for c in conn_stats))
+    if failed:
+        color_print.r(summary)
+    else:
+        color_print.g(summary)
 
-def upload_small_file(access_token: str, info: UploadInfo):
+
+def print_resumable(checkpoints: CheckpointStore):
+    """
+    输出所有未完成、可以续传的上传
+    """
+    infos = [UploadInfo(**i) for i in checkpoints.resumable()]
+    if not infos:
+        color_print.g('没有未完成的上传')
+        return
+    for info in infos:
+        # 会话过期的上传续传时重新上传
+        status = 'expired' if session_expires_in(info) <= 0 else info.status
+        print('%-8s %6.1f%% %8s  %s -> %s' % (
+            status, info.finished / info.size * 100,
+            human_size(info.size), info.local_file_path,
+            info.onedrive_dir_path + info.filename))
+
+
+def upload_small_file(access_token: str,
+                      info: UploadInfo,
+                      throttle: Optional[ThrottleController] = None):
     # 小于或等于4MB的文件直接上传
-    with output(initial_len=4) as out_lines:
-        out_lines[0] = color_print.bs('上传小文件中，请勿强行停止')
-        out_lines[1], out_lines[2] = table_header_and_divider(info.filename)
-        out_lines[3] = table_data(info)
+    with progress.transfer(info.filename, info.size) as transfer:
         start = time.time()
-        with open(info.local_file_path, 'rb') as f:
-            resp_json = drive_api.put_content(
-                access_token,
-                info.onedrive_dir_path + info.filename,
-                f.read()
-            ).json()
+        # 发送时再分块读取；文件在两次读取之间变化时，上传后的hash检查会报错
+        data = FileSlice(info.local_file_path, 0, info.size)
+        info.quick_xor_hash = quick_xor_hash_file(info.local_file_path,
+                                                  info.size).base64()
+        resp_json = drive_api.put_content(
+            access_token,
+            info.onedrive_dir_path + info.filename,
+            request_body(data),
+            throttle,
+            info.conflict_behavior,
+            info.parent_id
+        ).json()
 
         if 'id' in resp_json.keys():
             # 上传成功
+            error = check_quick_xor_hash(info, resp_json)
+            if error:
+                raise Exception(error)
             info.spend_time = time.time() - start
             info.speed = int(info.size / info.spend_time)
             info.finish_time = utc_datetime_str()
             info.status = 'finished'
             info.finished = info.size
-            out_lines[3] = table_data(info)
-            out_lines.append(
-                color_print.gs('上传成功. 文件: %s' % info.filename))
+            info.uploaded = info.size
+            info.item_id = resp_json['id']
+            info.e_tag = resp_json.get('eTag', '')
+            transfer.update(info.size, info.size)
         else:
             raise Exception(str(resp_json.get('error')))
-        return
-
-
-def upload_large_file(access_token: str, info: UploadInfo):
-    stop_flag = False
+        return info
 
-    info_cache = 'upload-info-{}.json'.format(info.cid_hash)
-    info_cache_path = os.path.join(app_config.CACHE_DIR, info_cache)
 
-    if os.path.isfile(info_cache_path):
-        # 已存在上传缓存信息，说明上次上传未完成
-        info = read_upload_info(info_cache_path)
+def upload_large_file(access_token: str,
+                      info: UploadInfo,
+                      stop_event: Optional[threading.Event] = None,
+                      throttle: Optional[ThrottleController] = None,
+                      checkpoints: Optional[CheckpointStore] = None):
+    """
+    使用上传会话分片上传大文件，支持断点续传
+    :param access_token: access token
+    :param info: 上传信息
+    :param stop_event: 设置后在当前分片完成时停止上传。为None时由本函数处理CTRL-C信号
+    :param throttle: 账号的限流控制器
+    :param checkpoints: 断点续传信息的存储，默认为default_store()
+    :return: 上传信息
+    """
+    if throttle is None:
+        throttle = ThrottleController(app_config.THROTTLE_MAX_INFLIGHT)
+    if checkpoints is None:
+        checkpoints = default_store()
+    key = checkpoint_key(info)
+    info, hasher = restore_checkpoint(info, checkpoints, key)
+    info.uploaded = 0
+
+    handle_sigint = stop_event is None
+    if handle_sigint:
+        # CTRL-C信号处理
+        stop_event = threading.Event()
+        sigint = sigint_stop(stop_event)
     else:
-        # 首次保存上传信息
-        write_upload_info(info_cache_path, info)
-
-    # CTRL-C信号处理
-    original_sigint_handler = signal.getsignal(signal.SIGINT)
-
-    def sigint_handler(signum, frame):
-        signal.signal(signal.SIGINT, original_sigint_handler)
-
-        info.status = 'stopped'
-        write_upload_info(info_cache_path, info)
-
-        nonlocal stop_flag
-        stop_flag = True
-        out_lines.append(
-            color_print.ys('接收到CTRL-C信号，正在停止上传并保存信息。再次输入CTRL-C强制停止'))
-
-    with output(initial_len=4) as out_lines:
-        signal.signal(signal.SIGINT, sigint_handler)
-
-        out_lines[0] = color_print.bs('上传大文件中，按CTRL-C可停止上传')
-        out_lines[1], out_lines[2] = table_header_and_divider(info.filename)
-        out_lines[3] = table_data(info)
-
-        size_mb = app_config.UPLOAD_CHUNK_SIZE
-        chunk_size = 1024 * 1024 * size_mb
+        sigint = contextlib.nullcontext()
+
+    # 使用上次的上传会话，上传过程中会话过期时可以新建会话重新上传
+    resumed = bool(info.upload_url)
+    expired = False
+    with sigint, progress.transfer(info.filename, info.size,
+                                   info.finished) as transfer:
+        sizer = AdaptiveChunkSize(1024 * 1024 * app_config.UPLOAD_CHUNK_SIZE,
+                                  app_config.UPLOAD_CHUNK_TARGET_TIME,
+                                  app_config.UPLOAD_ADAPTIVE_CHUNK)
+        if sizer.adaptive and info.chunk_size > 0:
+            # 续传时从上次调整后的分片大小开始
+            sizer.chunk_size = align_chunk_size(info.chunk_size)
+        chunk_size = info.chunk_size = sizer.chunk_size
 
         try:
+            resp_json = {}
+            if info.upload_url and session_expires_in(info) <= 0:
+                color_print.y('上传会话已过期，重新上传. 文件: %s' %
+                              info.local_file_path)
+                # 例如提前创建后排队太久的会话，本地时间有误差时服务器上可能仍然存在
+                discard_session(info)
+                hasher = reset_session(info)
+            elif info.precreated:
+                # 提前创建的会话还没有上传过，需要整个文件
+                resp_json = {'nextExpectedRanges': ['0-']}
+                info.precreated = False
+                # 开始上传前保存，中断后续传时查询会话
+                checkpoints.save(key, dataclasses.asdict(info), sync=True)
+            elif info.upload_url:
+                resp_json = drive_api.get_upload_session(
+                    info.upload_url, throttle).json()
+                if 'nextExpectedRanges' not in resp_json:
+                    color_print.y('上传会话已失效，重新上传. 文件: %s, %s' % (
+                        info.local_file_path, resp_json.get('error')))
+                    hasher = reset_session(info)
+
             if not info.upload_url:
                 # 创建上传会话
                 resp_json = drive_api.create_upload_session(
                     access_token,
                     info.filename,
-                    info.onedrive_dir_path + info.filename
+                    info.onedrive_dir_path + info.filename,
+                    throttle,
+                    info.conflict_behavior,
+                    info.parent_id
                 ).json()
                 upload_url = resp_json.get('uploadUrl')
                 if upload_url:
                     info.upload_url = upload_url
-                    write_upload_info(info_cache_path, info)
+                    # 新建的会话需要整个文件
+                    resp_json.setdefault('nextExpectedRanges', ['0-'])
+                    checkpoints.save(key, dataclasses.asdict(info), sync=True)
                 else:
                     # 创建上传会话失败
                     raise Exception(str(resp_json.get('error')))
-            else:
-                resp_json = requests.get(info.upload_url).json()
-
-            if 'nextExpectedRanges' not in resp_json.keys():
-                # upload_url失效
-                raise Exception(str(resp_json.get('error')))
-
-            info.status = 'running'
-            info.finished = int(
-                resp_json['nextExpectedRanges'][0].split('-')[0])
-            write_upload_info(info_cache_path, info)
-
-            # 文件大小小于 chunk_size
-            if info.size < chunk_size:
-                chunk_size = math.floor(info.size / (1024 * 10)) * 1024 * 10
-
-            with open(info.local_file_path, 'rb') as f:
-                f.seek(info.finished, 0)
-                upload_session = requests.Session()
-
-                while True:
-                    start = time.time()
-
-                    chunk_start = f.tell()
-                    chunk_end = chunk_start + chunk_size - 1
-
-                    if chunk_end >= info.size:
-                        left = info.size - chunk_start
-                        # 将10KB作为上传最小单位（官方API最小是320bytes）
-                        # 找一个大于left的值，使它为10KB的正整数倍，且最小
-                        chunk_size = math.ceil(left / (1024 * 10)) * 1024 * 10
-                        # 从文件末尾往前 chunk_size 个字节
-                        chunk_start = f.seek(-chunk_size, 2)
-                        chunk_end = info.size - 1
 
+            hasher, ranges = resume_session(info, resp_json, hasher)
+            checkpoints.save(key, dataclasses.asdict(info))
+            transfer.update(info.finished, info.uploaded)
+            if session_expires_in(info) \
+                    < app_config.UPLOAD_SESSION_EXPIRY_MARGIN:
+                # 会话即将过期，发送最小的分片使会话随进度尽快延长
+                chunk_size = CHUNK_UNIT
+
+            with ChunkReader(info.local_file_path, ranges, chunk_size,
+                             app_config.UPLOAD_READ_AHEAD, hasher) as reader:
+                start = time.time()
+                for chunk in reader:
+                    data = chunk.data
                     headers = {
-                        'Content-Length': str(chunk_size),
+                        'Content-Length': str(len(data)),
                         'Content-Range': 'bytes {}-{}/{}'.format(
-                            chunk_start, chunk_end, info.size)
+                            chunk.start, chunk.end, info.size)
                     }
-                    data = f.read(chunk_size)
+                    # 限速或记录性能时分块发送
+                    body = request_body(data, telemetry.enabled)
 
                     resp = None
                     retry_cnt = 1
+                    throttled_cnt = 1
+                    attempts = 0
+                    backoff_time = 0
                     while resp is None:
                         try:
-                            resp = upload_session.put(info.upload_url,
-                                                      headers=headers,
-                                                      data=data)
-                            if resp.status_code >= 500:
+                            with throttle.slot():
+                                attempts += 1
+                                put_start = time.perf_counter()
+                                resp = drive_api.put_upload_range(
+                                    info.upload_url, headers, body)
+                            if resp.status_code in THROTTLE_STATUS:
+                                # 被限流，暂停该账号的所有请求，等待后重试
+                                delay = drive_api.backoff_throttled(
+                                    resp, throttled_cnt, throttle)
+                                color_print.y('请求被限流(%d)，%ds后重试' % (
+                                    resp.status_code, delay))
+                                resp = None
+                                throttled_cnt += 1
+                                backoff_time += delay
+                                continue
+                            elif resp.status_code == 507:
+                                # 存储空间不足，重试没有意义
+                                raise Exception(
+                                    str(resp.json().get('error')))
+                            elif resp.status_code == 404:
+                                # 上传会话已过期
+                                raise drive_api.SessionExpired(
+                                    str(resp.json().get('error')))
+                            elif resp.status_code >= 500:
                                 # OneDrive服务器错误，稍后继续尝试
                                 raise requests.exceptions.RequestException(
                                     resp.text)
@@ -250,126 +937,374 @@ def upload_large_file(access_token: str, info: UploadInfo):
                             color_print.y('第%d次重试，%ds后重试' % (retry_cnt, delay))
                             time.sleep(delay)
                             retry_cnt += 1
+                            backoff_time += delay
+
+                    throttle.on_success()
+                    put_time = time.perf_counter() - put_start
+                    # 分片发送完成，hash已计算到分片末尾
+                    hasher = chunk.hasher
+                    reader.chunk_size = info.chunk_size = sizer.update(
+                        len(data), put_time, retry_cnt - 1)
+                    record_chunk(info, chunk, body, resp, put_start, put_time,
+                                 attempts, retry_cnt - 1, throttled_cnt - 1,
+                                 backoff_time)
 
+                    resp_json = resp.json()
                     spend_time = time.time() - start
-                    info.finished = chunk_end + 1
-                    info.speed = int(chunk_size / spend_time)
+                    info.finished = chunk.end + 1
+                    info.quick_xor_state = '%x' % hasher.state
+                    info.speed = int(len(data) / spend_time)
                     info.spend_time += spend_time
-                    write_upload_info(info_cache_path, info)
+                    info.uploaded += len(data)
+                    info.expiration = resp_json.get('expirationDateTime',
+                                                    info.expiration)
+                    if session_expires_in(info) \
+                            < app_config.UPLOAD_SESSION_EXPIRY_MARGIN:
+                        # 会话即将过期，发送最小的分片使会话随进度尽快延长
+                        reader.chunk_size = CHUNK_UNIT
+                    # 多个分片的进度合并后再写入
+                    checkpoints.save(key, dataclasses.asdict(info))
+
+                    transfer.update(info.finished, info.uploaded)
 
-                    out_lines[3] = table_data(info)
-
-                    resp_json = resp.json()
                     if 'id' in resp_json.keys():
-                        # 上传完成，删除上传信息缓存
-                        os.remove(info_cache_path)
-                        out_lines.append(
-                            color_print.gs('上传成功. 文件: %s' % info.filename))
-                        return
+                        complete_upload(info, resp_json, hasher)
+                        # 上传完成，删除断点续传信息
+                        checkpoints.delete(key)
+                        return info
 
-                    if stop_flag:
+                    if stop_event.is_set():
                         # 停止上传
-                        out_lines.append(
-                            color_print.ys('上传停止. 文件: %s' % info.filename))
-                        return
+                        info.status = 'stopped'
+                        checkpoints.save(key, dataclasses.asdict(info),
+                                         sync=True)
+                        return info
+
+                    # 下一个分片的计时包含等待预读的时间
+                    start = time.time()
+
+            # 所有分片都已发送，但服务器没有返回文件信息
+            raise Exception(str(resp_json.get('error')))
+        except drive_api.SessionExpired as e:
+            if not resumed and info.uploaded == 0:
+                # 刚创建的会话不存在，重新上传没有意义
+                checkpoints.delete(key)
+                raise Exception(str(e))
+            # 保留断点续传信息，在新的会话中重新上传
+            reset_session(info)
+            checkpoints.save(key, dataclasses.asdict(info), sync=True)
+            expired = True
         except Exception as e:
-            os.remove(info_cache_path)
+            checkpoints.delete(key)
             raise e
 
+    if expired:
+        color_print.y('上传会话已过期，重新上传. 文件: %s' % info.local_file_path)
+        uploaded = info.uploaded
+        info = upload_large_file(access_token, info,
+                                 None if handle_sigint else stop_event,
+                                 throttle, checkpoints)
+        info.uploaded += uploaded
+    return info
 
-def read_upload_info(file: str, encoding: str = 'utf8'):
-    with open(file, 'r', encoding=encoding) as f:
-        return UploadInfo(**json.loads(f.read()))
 
+def record_file(info: UploadInfo, mode: str, upload_time: float,
+                status: str = '', error: str = ''):
+    """
+    记录一个文件的性能数据
+    :param mode: 上传方式：small, session, batch
+    :param upload_time: 上传的用时（秒）
+    """
+    telemetry.record('file',
+                     file=info.local_file_path,
+                     remote=info.onedrive_dir_path + info.filename,
+                     mode=mode,
+                     size=info.size,
+                     status=status or info.status,
+                     error=error or info.error,
+                     bytes=info.uploaded,
+                     upload_time=upload_time)
+
+
+def record_chunk(info: UploadInfo, chunk, body, resp: requests.Response,
+                 put_start: float, put_time: float, attempts: int,
+                 retries: int, throttled: int, backoff_time: float):
+    """
+    记录一个分片的性能数据
+    :param chunk: ChunkReader读取的分片
+    :param body: 分片的请求体，为TimedBody时可以得到请求体发送完成的时间
+    :param put_start: 成功的那次请求开始的时间（perf_counter）
+    """
+    if not telemetry.enabled:
+        return
+    fields = {}
+    if isinstance(body, TimedBody) and body.sent_at is not None:
+        # resp.elapsed为发送请求到收到响应头的时间
+        fields['send_time'] = body.sent_at - put_start
+        fields['ttfb_time'] = max(
+            put_start + resp.elapsed.total_seconds() - body.sent_at, 0)
+    telemetry.record('chunk',
+                     file=info.local_file_path,
+                     start=chunk.start,
+                     end=chunk.end,
+                     status=resp.status_code,
+                     bytes=len(chunk.data) * attempts,
+                     read_time=chunk.read_time,
+                     hash_time=chunk.hash_time,
+                     put_time=put_time,
+                     retries=retries,
+                     throttled=throttled,
+                     backoff_time=backoff_time,
+                     **fields)
+
+
+def restore_checkpoint(info: UploadInfo, checkpoints: CheckpointStore,
+                       key: str) -> Tuple[UploadInfo, QuickXorHash]:
+    """
+    读取上次未完成的上传，本地文件没有变化时将info更新为上次保存的上传信息，继续使用上次的上传会话
+    :return: (上传信息，即info, 计算到info.finished的QuickXorHash)
+    """
+    hasher = None
+    cached = checkpoints.get(key)
+    if cached is not None:
+        # 已存在断点续传信息，说明上次上传未完成
+        cached = UploadInfo(**cached)
+        hasher = resume_hasher(cached, info.size)
+        if hasher is not None and \
+                cached.onedrive_account.get('home_account_id') \
+                != info.onedrive_account.get('home_account_id'):
+            # 上传会话属于其他账号，例如分散上传时文件被转移到其他账号
+            hasher = None
+            color_print.y('上次的上传会话属于其他账号，重新上传. 文件: %s' %
+                          info.local_file_path)
+            discard_session(cached)
+        elif hasher is not None:
+            # 更新调用者的上传信息而不是换成新的对象，例如重复的文件根据它判断
+            # 被复制的文件是否已上传完成
+            for field in dataclasses.fields(UploadInfo):
+                setattr(info, field.name, getattr(cached, field.name))
+        else:
+            # 已上传的部分与本地文件不一致或无法校验，放弃上次的上传会话
+            color_print.y('本地文件已变化，重新上传. 文件: %s' % info.local_file_path)
+            discard_session(cached)
+    if hasher is None:
+        hasher = QuickXorHash()
+        # 首次保存上传信息
+        checkpoints.save(key, dataclasses.asdict(info), sync=True)
+    info.uploaded = 0
+    return info, hasher
 
-def write_upload_info(file: str, info: UploadInfo, encoding: str = 'utf8'):
-    with open(file, 'w', encoding=encoding) as f:
-        f.write(json.dumps(dataclasses.asdict(info), indent=2, sort_keys=True))
 
+def resume_session(info: UploadInfo, resp_json: dict, hasher: QuickXorHash) \
+        -> Tuple[QuickXorHash, List[Tuple[int, int]]]:
+    """
+    根据上传会话的nextExpectedRanges得到服务器缺少的字节范围，并设置已上传的字节数
+    :param resp_json: 创建或查询上传会话的响应
+    :param hasher: 计算到上次保存的进度的QuickXorHash
+    :return: (计算到info.finished的QuickXorHash, 需要上传的字节范围)
+    """
+    if 'nextExpectedRanges' not in resp_json.keys():
+        # upload_url失效
+        raise Exception(str(resp_json.get('error')))
+
+    info.status = 'running'
+    info.expiration = resp_json.get('expirationDateTime', info.expiration)
+    ranges = parse_ranges(resp_json['nextExpectedRanges'], info.size)
+    # 第一个缺少的字节之前的部分服务器都已收到，之后的部分在上传时跳过
+    info.finished = ranges[0][0] if ranges else info.size
+    if hasher.length > info.finished:
+        hasher = QuickXorHash()
+    # 服务器已接收的部分可能多于上次保存的进度
+    hasher = quick_xor_hash_file(info.local_file_path, info.finished, hasher)
+    info.quick_xor_state = '%x' % hasher.state
+    return hasher, ranges
+
+
+def reset_session(info: UploadInfo) -> QuickXorHash:
+    """
+    放弃已失效的上传会话，在新的会话中从头上传
+    :return: 重新开始计算的QuickXorHash
+    """
+    info.upload_url = ''
+    info.expiration = ''
+    info.precreated = False
+    info.finished = 0
+    info.quick_xor_state = ''
+    return QuickXorHash()
 
-def strip_and_replace(p: str, d: bool = False):
-    r = p.strip().replace('\\', '/')
-    if d and not p.endswith('/'):
-        r += '/'
-    return r
 
+def discard_session(info: UploadInfo):
+    """
+    删除不再使用的上传会话，服务器释放已上传的部分。删除失败时不影响上传，
+    会话过期后服务器也会删除
+    """
+    if not info.upload_url:
+        return
+    try:
+        drive_api.delete_upload_session(
+            info.upload_url,
+            get_controller(info.onedrive_account.get('home_account_id', ''),
+                           app_config.THROTTLE_MAX_INFLIGHT))
+    except Exception as e:
+        color_print.y('删除上传会话失败. 文件: %s, %s' % (info.local_file_path, e))
 
-def utc_datetime_str():
-    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def session_expires_in(info: UploadInfo) -> float:
+    """
+    :return: 上传会话距离过期的秒数，不知道过期时间时为inf
+    """
+    try:
+        # 例如 2015-01-29T09:21:55.523Z，只精确到秒
+        expiration = calendar.timegm(time.strptime(info.expiration[:19],
+                                                   '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return math.inf
+    return expiration - time.time()
 
 
-def cid_hash_file(path: str):
+def complete_upload(info: UploadInfo, item: dict, hasher: QuickXorHash):
     """
-    计算文件名为cid的hash值，算法来源：https://github.com/iambus/xunlei-lixian
-    :param path: 需要计算的本地文件路径
-    :return: 所给路径对应文件的cid值
+    最后一个分片上传完成，校验hash并记录文件信息
+    :param item: 最后一个分片的响应，即上传完成的driveItem
     """
+    if hasher.length < info.size:
+        # 最后发送的分片之后的部分服务器已经收到，也需要计算hash
+        hasher = quick_xor_hash_file(info.local_file_path, info.size, hasher)
+    info.quick_xor_hash = hasher.base64()
+    error = check_quick_xor_hash(info, item)
+    if error:
+        raise Exception(error)
+    info.status = 'finished'
+    info.finish_time = utc_datetime_str()
+    info.item_id = item['id']
+    info.e_tag = item.get('eTag', '')
+
+
+def checkpoint_key(info: UploadInfo) -> str:
+    # 同一文件可能同时上传到不同位置，key同时包含目标路径
     h = hashlib.sha1()
-    size = os.path.getsize(path)
-    with open(path, 'rb') as stream:
-        if size < 0xF000:
-            h.update(stream.read())
-        else:
-            h.update(stream.read(0x5000))
-            stream.seek(size // 3)
-            h.update(stream.read(0x5000))
-            stream.seek(size - 0x5000)
-            h.update(stream.read(0x5000))
+    h.update(info.cid_hash.encode('utf8'))
+    h.update(info.onedrive_dir_path.encode('utf8'))
+    h.update(info.filename.encode('utf8'))
     return h.hexdigest()
 
 
-def table_header_and_divider(filename: str):
-    len_f_header = max(min(MAX_TITLE_LEN, len(filename)), 8)
-    header = ' filename%s ' % (' ' * (len_f_header - 8)) \
-             + '|  size   |   per   |  speed  |   eta   '
-    divider = '%s' % ('-' * (len_f_header + 2)) \
-              + '+---------+---------+---------+---------'
-    return header, divider
-
-
-def table_data(info: UploadInfo):
-    len_f_title = max(min(MAX_TITLE_LEN, len(info.filename)), 8)
-    name = info.filename
-    if len(name) > MAX_TITLE_LEN:
-        name = name[:MAX_TITLE_LEN - 3] + '...'
-    siz = human_size(info.size)
-    per = '%.1f%%' % (info.finished / info.size * 100)
-    spe = '%s/s' % human_size(info.speed)
-    eta = human_sec(
-        (info.size - info.finished) // info.speed) if info.speed > 0 else '---'
-    eta = eta if info.finished != info.size else '0s'
-    data = ' {}{} | {}{} | {}{} | {}{} | {}{} '.format(
-        name, ' ' * (len_f_title - len(name)),
-              ' ' * (7 - len(siz)), siz,
-              ' ' * (7 - len(per)), per,
-              ' ' * (7 - len(spe)), spe,
-              ' ' * (7 - len(eta)), eta
+def resume_hasher(cached: UploadInfo,
+                  size: int) -> Optional[QuickXorHash]:
+    """
+    重新计算本地文件已上传部分的QuickXorHash，并与上次保存的状态比较
+    :param cached: 上次保存的上传信息
+    :param size: 本地文件当前的大小
+    :return: 一致时返回计算到cached.finished的QuickXorHash，否则返回None
+    """
+    if cached.size != size:
+        return None
+    if cached.finished == 0:
+        return QuickXorHash()
+    if not cached.quick_xor_state:
+        return None
+    hasher = quick_xor_hash_file(cached.local_file_path, cached.finished)
+    if hasher.length != cached.finished \
+            or hasher.state != int(cached.quick_xor_state, 16):
+        return None
+    return hasher
+
+
+def check_quick_xor_hash(info: UploadInfo, item: dict) -> str:
+    """
+    比较本地计算的QuickXorHash与上传完成后返回的driveItem中的hash
+    :return: 不一致时返回错误信息，一致或接口没有返回hash时返回空字符串
+    """
+    remote = item.get('file', {}).get('hashes', {}).get('quickXorHash')
+    if not remote or not info.quick_xor_hash or remote == info.quick_xor_hash:
+        return ''
+    return '上传后的文件hash不一致: 本地 %s, OneDrive %s' % (info.quick_xor_hash,
+                                                 remote)
+
+
+def import_upload_info_files(checkpoints: CheckpointStore):
+    """
+    将旧版本保存在 .cache/upload-info-*.json 中的断点续传信息导入checkpoints。
+    旧版本没有保存已上传部分的hash，已有进度的大文件续传时无法校验，会重新上传
+    """
+    for file in glob.glob(os.path.join(app_config.CACHE_DIR,
+                                       'upload-info-*.json')):
+        try:
+            with open(file, 'r', encoding='utf8') as f:
+                info = UploadInfo(**json.loads(f.read()))
+            # 旧版本的文件名只由cid计算，按与读取时相同的key保存
+            checkpoints.save(checkpoint_key(info), dataclasses.asdict(info),
+                             sync=True)
+        except (ValueError, TypeError) as e:
+            # 写入时中断，文件不完整
+            color_print.y('忽略无法读取的上传信息: %s, %s' % (file, e))
+        os.remove(file)
+
+
+def create_upload_info(local_file_path: str,
+                       onedrive_dir_path: str,
+                       account: dict,
+                       conflict_behavior: str = 'rename',
+                       stat: Optional[os.stat_result] = None,
+                       cid_hash: str = ''):
+    stat = stat or os.stat(local_file_path)
+    return UploadInfo(
+        filename=os.path.split(local_file_path)[1],
+        size=stat.st_size,
+        local_file_path=local_file_path,
+        cid_hash=cid_hash or cid_hash_file(local_file_path, stat.st_size),
+        onedrive_dir_path=onedrive_dir_path,
+        onedrive_account=account,
+        create_time=utc_datetime_str(),
+        mtime_ns=stat.st_mtime_ns,
+        conflict_behavior=conflict_behavior
     )
-    return data
-
-
-def human_size(n: int) -> str:
-    x = 1024
-    if n < x:
-        return '%dB' % n
-    if n < 1000 * x:
-        return '%dK' % (n // x)
-    x *= 1024
-    if n < 1000 * x:
-        return '%.1fM' % (n / x)
-    x *= 1024
-    if n < 1000 * x:
-        return '%.2fG' % (n / x)
-
-
-def human_sec(s: int) -> str:
-    x = 60
-    if s < x:
-        return '%ds' % s
-    if s < 60 * x:
-        return '%dm%ds' % (s // x, s % x)
-    x *= 60
-    if s < 24 * x:
-        return '%dh%dm' % (s // x, (s % x) // 60)
-    x *= 24
-    return '>%dd' % (s // x)
+
+
+def remote_dir_path(onedrive_dir_path: str, rel_dir: str) -> str:
+    """
+    :param rel_dir: 相对于上传的本地目录的目录路径，以/分隔，本地目录本身为空字符串
+    :return: 对应的OneDrive目录路径，以/结尾
+    """
+    return onedrive_dir_path + rel_dir + '/' if rel_dir else onedrive_dir_path
+
+
+def format_onedrive_dir_path(onedrive_dir_path: str):
+    onedrive_dir_path = strip_and_replace(onedrive_dir_path, True)
+    if not onedrive_dir_path.startswith('/'):
+        onedrive_dir_path = '/' + onedrive_dir_path
+    return onedrive_dir_path
+
+
+@contextlib.contextmanager
+def sigint_stop(stop_event: threading.Event):
+    """
+    接收到CTRL-C信号时设置stop_event，再次输入CTRL-C强制停止。
+    只有主线程可以设置信号处理，在其他线程中（例如守护进程）只能由调用者设置stop_event
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield stop_event
+        return
+    original_sigint_handler = signal.getsignal(signal.SIGINT)
+
+    def sigint_handler(signum, frame):
+        signal.signal(signal.SIGINT, original_sigint_handler)
+        stop_event.set()
+        color_print.y('接收到CTRL-C信号，正在停止上传并保存信息。再次输入CTRL-C强制停止')
+
+    signal.signal(signal.SIGINT, sigint_handler)
+    try:
+        yield stop_event
+    finally:
+        signal.signal(signal.SIGINT, original_sigint_handler)
+
+
+def strip_and_replace(p: str, d: bool = False):
+    r = p.strip().replace('\\', '/')
+    if d and not p.endswith('/'):
+        r += '/'
+    return r
+
+
+def utc_datetime_str():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
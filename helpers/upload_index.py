@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import threading
+from typing import Optional
+
+import app_config
+
+
+class UploadIndex:
+    """
+    已上传文件的本地索引，保存在SQLite数据库中。
+    再次上传同一目录时，跳过大小和修改时间未变化的文件；只有修改时间变化时，
+    比较整个文件的QuickXorHash，内容相同时跳过
+    """
+
+    def __init__(self, db_path: str = app_config.UPLOAD_INDEX_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        # 以(账号, 本地路径, OneDrive路径)为主键，查询时直接使用主键索引。
+        # content_hash为上传时计算的整个文件的QuickXorHash，不知道时为空字符串
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS uploads (
+                account TEXT NOT NULL,
+                local_path TEXT NOT NULL,
+                remote_path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                e_tag TEXT NOT NULL,
+                upload_time TEXT NOT NULL,
+                PRIMARY KEY (account, local_path, remote_path)
+            ) WITHOUT ROWID''')
+        self._conn.commit()
+
+    def get(self,
+            account: str,
+            local_path: str,
+            remote_path: str) -> Optional[dict]:
+        with self._lock:
+            cur = self._conn.execute(
+                'SELECT size, mtime_ns, content_hash, item_id, e_tag '
+                'FROM uploads '
+                'WHERE account = ? AND local_path = ? AND remote_path = ?',
+                (account, local_path, remote_path))
+            row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip(('size', 'mtime_ns', 'content_hash', 'item_id',
+                         'e_tag'), row))
+
+    def record(self, info):
+        """
+        记录上传完成的文件
+        :param info: 上传完成的UploadInfo
+        """
+        self.record_many([info])
+
+    def record_many(self, infos: list):
+        rows = [(info.onedrive_account['home_account_id'],
+                 info.local_file_path,
+                 info.onedrive_dir_path + info.filename,
+                 info.size,
+                 info.mtime_ns,
+                 info.quick_xor_hash,
+                 info.item_id,
+                 info.e_tag,
+                 info.finish_time) for info in infos]
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO uploads VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+
+    def update_mtime(self,
+                     account: str,
+                     local_path: str,
+                     remote_path: str,
+                     mtime_ns: int):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE uploads SET mtime_ns = ? '
+                'WHERE account = ? AND local_path = ? AND remote_path = ?',
+                (mtime_ns, account, local_path, remote_path))
+            self._conn.commit()
+
+    def clear(self, account: str, local_dir_path: str):
+        """
+        删除本地目录下所有文件的记录
+        """
+        prefix = local_dir_path.rstrip('/') + '/'
+        with self._lock:
+            # 使用范围查询代替LIKE，可以利用主键索引
+            self._conn.execute(
+                'DELETE FROM uploads WHERE account = ? '
+                'AND local_path >= ? AND local_path < ?',
+                (account, prefix, prefix[:-1] + chr(ord('/') + 1)))
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM uploads').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_config
+from bench.mock_graph import Faults, MockGraphServer
+from bench.runner import StaticAuth
+from graph import drive_api
+from helpers.checkpoint_store import CheckpointStore
+from helpers.remote_tree import RemoteTree
+from helpers.session_prefetch import precreate_session
+from helpers.upload_helper import (UploadHelper, checkpoint_key,
+                                   create_upload_info)
+from helpers.upload_index import UploadIndex
+from utils.chunk_reader import CHUNK_UNIT
+from utils.quick_xor_hash import quick_xor_hash_file
+
+
+@pytest.fixture
+def mock_graph(tmp_path, monkeypatch):
+    """
+    本地的模拟Graph服务器，drive_api的请求都发送到这里
+    """
+    server = MockGraphServer(Faults()).start()
+    monkeypatch.setattr(drive_api, 'GRAPH_URL', server.graph_url)
+    monkeypatch.setattr(drive_api, 'BASE_URL', server.graph_url + '/me/drive')
+    monkeypatch.setattr(app_config, 'CACHE_DIR', str(tmp_path / 'cache'))
+    os.makedirs(app_config.CACHE_DIR)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_helper(tmp_path):
+    """
+    :return: 创建UploadHelper的函数，同一个测试中的UploadHelper共用索引和断点续传信息
+    """
+    upload_index = UploadIndex(str(tmp_path / 'upload-index.db'))
+    remote_tree = RemoteTree(str(tmp_path / 'remote-tree.db'))
+    checkpoints = CheckpointStore(str(tmp_path / 'checkpoints.db'))
+
+    def make(engine: str = 'thread', auth=None) -> UploadHelper:
+        return UploadHelper(auth or StaticAuth(), upload_index, 'rename',
+                            remote_tree, checkpoints, engine)
+
+    yield make
+    checkpoints.close()
+    remote_tree.close()
+    upload_index.close()
+
+
+
+@pytest.fixture
+def interrupt_upload():
+    """
+    :return: 模拟上次上传被中断的函数：创建上传会话并上传第一个分片，保存断点续传信息
+    """
+
+    def interrupt(helper: UploadHelper, path: str,
+                  onedrive_dir_path: str) -> dict:
+        info = create_upload_info(path, onedrive_dir_path, StaticAuth.account)
+        assert precreate_session(helper, info)
+        key = checkpoint_key(info)
+        cached = helper.checkpoints.get(key)
+        with open(path, 'rb') as f:
+            data = f.read(CHUNK_UNIT)
+        drive_api.put_upload_range(
+            cached['upload_url'],
+            {'Content-Range': 'bytes 0-%d/%d' % (CHUNK_UNIT - 1, info.size)},
+            data)
+        hasher = quick_xor_hash_file(path, CHUNK_UNIT)
+        cached.update(precreated=False, status='stopped', finished=CHUNK_UNIT,
+                      quick_xor_state='%x' % hasher.state)
+        helper.checkpoints.save(key, cached, sync=True)
+        return cached
+
+    return interrupt
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import os
+
+import pytest
+
+from graph.batch import (MAX_BATCH_PAYLOAD, MAX_BATCH_SIZE, BatchSplitter,
+                         batch_body, create_folder_request,
+                         put_content_request, send_batch, split_batches)
+from utils.buffer_pool import BufferPool, FileSlice, JoinedBody
+
+
+def test_splitter_limits_request_count():
+    batches = split_batches(list(range(MAX_BATCH_SIZE * 2 + 1)))
+    assert [len(b) for b in batches] == [MAX_BATCH_SIZE, MAX_BATCH_SIZE, 1]
+
+
+def test_splitter_limits_payload():
+    size = MAX_BATCH_PAYLOAD // 3
+    batches = split_batches([size] * 7, lambda x: x)
+    assert [len(b) for b in batches] == [3, 3, 1]
+    # 单个超过上限的请求单独成为一组
+    assert split_batches([MAX_BATCH_PAYLOAD + 1, 1], lambda x: x) == \
+        [[MAX_BATCH_PAYLOAD + 1], [1]]
+
+
+def test_splitter_returns_full_batch_when_adding():
+    splitter = BatchSplitter()
+    full = [splitter.add(i) for i in range(MAX_BATCH_SIZE + 1)]
+    assert full[:MAX_BATCH_SIZE] == [None] * MAX_BATCH_SIZE
+    assert full[MAX_BATCH_SIZE] == list(range(MAX_BATCH_SIZE))
+    assert splitter.flush() == [MAX_BATCH_SIZE]
+    assert splitter.flush() is None
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 999, 1000, 1001, 4097])
+def test_joined_body_streams_base64(tmp_path, size):
+    data = os.urandom(size)
+    path = tmp_path / 'f'
+    path.write_bytes(data)
+    # 缓冲区不是3的倍数，编码时需要跨块
+    pool = BufferPool(block_size=1000, blocks=1)
+    body = JoinedBody([b'<', FileSlice(str(path), 0, size, pool), b'>'],
+                      encode_base64=True)
+    expected = b'<' + base64.b64encode(data) + b'>'
+    assert len(body) == len(expected)
+    assert b''.join(bytes(b) for b in body) == expected
+    # 重试时重新读取
+    assert b''.join(bytes(b) for b in body.blocks(7)) == expected
+    assert pool.peak == 1
+
+
+def test_batch_body_embeds_file_content(tmp_path):
+    files = [os.urandom(n) for n in (10, 5000)]
+    reqs = [create_folder_request('/a/b')]
+    for i, data in enumerate(files):
+        path = tmp_path / ('%d.bin' % i)
+        path.write_bytes(data)
+        reqs.append(put_content_request('/a/%d.bin' % i,
+                                        FileSlice(str(path), 0, len(data))))
+
+    body = batch_body(reqs)
+    raw = b''.join(bytes(b) for b in body)
+    assert len(body) == len(raw)
+    requests = json.loads(raw)['requests']
+    assert requests[0]['body']['name'] == 'b'
+    for r, data in zip(requests[1:], files):
+        assert base64.b64decode(r['body']) == data
+        assert r['headers']['Content-Type'] == 'application/octet-stream'
+
+
+def test_upload_dir_with_batch(mock_graph, make_helper, tmp_path):
+    src = tmp_path / 'src'
+    files = {}
+    for i in range(30):
+        path = src / ('d%d' % (i % 3)) / ('f%d.txt' % i)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        files['d%d/f%d.txt' % (i % 3, i)] = os.urandom(i * 1000 + 1)
+        path.write_bytes(files['d%d/f%d.txt' % (i % 3, i)])
+
+    results = make_helper().upload_dir(str(src), '/dst', workers=2,
+                                       batch=True)
+
+    assert all(i.status == 'finished' for i in results)
+    drive = mock_graph.drive_for('Bearer bench')
+    for rel, data in files.items():
+        assert drive.resolve('/dst/src/' + rel).data == data
+    # 小文件通过$batch上传，请求数远少于文件数
+    assert mock_graph.stats()['requests'] < len(files)
+
+
+def test_send_batch_does_not_retry_insufficient_storage(mock_graph):
+    drive = mock_graph.drive_for('Bearer bench')
+    drive.quota = 0
+    reqs = [put_content_request('/a.txt', b'x'),
+            create_folder_request('/d')]
+
+    send_batch('bench', reqs)
+
+    assert [r.status for r in reqs] == [507, 201]
+    assert mock_graph.stats()['requests'] == 1
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+
+from utils.buffer_pool import BufferPool
+
+
+def test_acquire_timeout():
+    pool = BufferPool(block_size=16, blocks=1)
+    buf = pool.acquire()
+    assert pool.acquire(timeout=0.05) is None
+    pool.release(buf)
+    assert pool.acquire(timeout=0.05) is buf
+
+
+def test_acquire_waits_for_release():
+    pool = BufferPool(block_size=16, blocks=1)
+    buf = pool.acquire()
+    timer = threading.Timer(0.05, pool.release, (buf,))
+    timer.start()
+    assert pool.acquire(timeout=5) is buf
+    timer.join()
+
+
+def test_async_waiters_get_released_buffers():
+    pool = BufferPool(block_size=16, blocks=1)
+
+    async def main():
+        buf = await pool.acquire_async()
+        waiters = [asyncio.ensure_future(pool.acquire_async())
+                   for _ in range(3)]
+        await asyncio.sleep(0.01)
+        # 等待时不轮询，协程都挂起在Future上
+        assert not any(w.done() for w in waiters)
+        waiters[0].cancel()
+        # 从其他线程归还，交给第一个没有取消的协程
+        threading.Thread(target=pool.release, args=(buf,)).start()
+        assert await asyncio.wait_for(waiters[1], 5) is buf
+        pool.release(buf)
+        assert await asyncio.wait_for(waiters[2], 5) is buf
+        pool.release(buf)
+
+    asyncio.run(main())
+    assert pool.acquire(timeout=0) is not None
+
+
+def test_configure_raises_to_min_blocks():
+    pool = BufferPool(block_size=16, blocks=1)
+    pool.configure(32, 2, min_blocks=8)
+    assert (pool.block_size, pool.blocks, pool.capacity) == (32, 8, 256)
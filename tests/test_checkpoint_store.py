@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import dataclasses
+import json
+import os
+import time
+
+import pytest
+
+import app_config
+from bench.runner import StaticAuth
+from helpers.checkpoint_store import CheckpointStore
+from helpers.upload_helper import (checkpoint_key, create_upload_info,
+                                   import_upload_info_files)
+
+
+@pytest.fixture
+def store(tmp_path):
+    # 不自动写入，由测试控制何时flush
+    store = CheckpointStore(str(tmp_path / 'checkpoints.db'),
+                            flush_interval=3600)
+    yield store
+    store.close()
+
+
+def make_info(path, finished=0) -> dict:
+    return {'local_file_path': path, 'onedrive_dir_path': '/dst/',
+            'filename': os.path.basename(path), 'size': 100,
+            'finished': finished, 'status': 'running'}
+
+
+def rows(store: CheckpointStore) -> list:
+    with store._db_lock:
+        return store._conn.execute(
+            'SELECT key, finished FROM checkpoints ORDER BY key').fetchall()
+
+
+def test_updates_are_coalesced_until_flush(store):
+    for finished in range(0, 100, 10):
+        store.save('a', make_info('/a', finished))
+    assert rows(store) == []
+    # 未写入的进度也可以读取
+    assert store.get('a')['finished'] == 90
+    store.flush()
+    assert rows(store) == [('a', 90)]
+
+
+def test_sync_save_and_delete_are_written_immediately(store):
+    store.save('a', make_info('/a'), sync=True)
+    store.save('b', make_info('/b'), sync=True)
+    assert rows(store) == [('a', 0), ('b', 0)]
+    store.save('a', make_info('/a', 50))
+    store.delete('b')
+    assert rows(store) == [('a', 50)]
+    assert store.get('b') is None
+
+
+def test_resumable_is_ordered_by_update_time(store):
+    store.save('b', make_info('/b'))
+    time.sleep(0.01)
+    store.save('a', make_info('/a'))
+    assert [i['local_file_path'] for i in store.resumable()] == ['/b', '/a']
+
+
+def test_resumable_order_survives_reopen(tmp_path):
+    path = str(tmp_path / 'checkpoints.db')
+    store = CheckpointStore(path, flush_interval=3600)
+    for name in ('c', 'a', 'b'):
+        store.save(name, make_info('/' + name))
+        time.sleep(0.01)
+    # 更新进度后排到最后
+    store.save('c', make_info('/c', 10))
+    store.close()
+    store = CheckpointStore(path, flush_interval=3600)
+    assert [i['local_file_path'] for i in store.resumable()] == \
+        ['/a', '/b', '/c']
+    store.close()
+
+
+def test_progress_survives_reopen(tmp_path):
+    path = str(tmp_path / 'checkpoints.db')
+    store = CheckpointStore(path, flush_interval=3600)
+    store.save('a', make_info('/a', 30))
+    store.close()
+    store = CheckpointStore(path, flush_interval=3600)
+    assert store.get('a')['finished'] == 30
+    store.close()
+
+
+def test_import_legacy_files_by_checkpoint_key(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_config, 'CACHE_DIR', str(tmp_path))
+    local = tmp_path / 'big.bin'
+    local.write_bytes(b'x' * 100)
+    info = create_upload_info(str(local), '/dst/', StaticAuth.account)
+    # 旧版本按cid命名
+    legacy = tmp_path / ('upload-info-%s.json' % info.cid_hash)
+    legacy.write_text(json.dumps(dataclasses.asdict(info)), encoding='utf8')
+
+    import_upload_info_files(store)
+
+    assert not legacy.exists()
+    assert store.get(checkpoint_key(info))['local_file_path'] == str(local)
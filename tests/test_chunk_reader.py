@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+
+import pytest
+
+from utils import buffer_pool, chunk_reader
+from utils.chunk_reader import (CHUNK_UNIT, MAX_CHUNK_SIZE,
+                                AdaptiveChunkSize, ChunkReader,
+                                align_chunk_size, fragment_end, next_chunk,
+                                parse_ranges)
+from utils.quick_xor_hash import QuickXorHash
+
+
+@pytest.mark.parametrize('expected, size, ranges', [
+    (['0-'], 1000, [(0, 999)]),
+    (['100-199', '500-'], 1000, [(100, 199), (500, 999)]),
+    # 乱序、重叠和相邻的范围合并
+    (['500-599', '0-99', '50-149', '150-199'], 1000,
+     [(0, 199), (500, 599)]),
+    # 超出文件大小的部分截断，文件之外的范围丢弃
+    (['900-2000', '1000-'], 1000, [(900, 999)]),
+    ([], 1000, []),
+])
+def test_parse_ranges(expected, size, ranges):
+    assert parse_ranges(expected, size) == ranges
+
+
+@pytest.mark.parametrize('start, end, chunk_size, stop', [
+    (0, 10 * CHUNK_UNIT, 2 * CHUNK_UNIT, 2 * CHUNK_UNIT),
+    # 开始位置没有对齐时缩短到下一个320KiB边界
+    (100, 10 * CHUNK_UNIT, 2 * CHUNK_UNIT, 2 * CHUNK_UNIT),
+    (CHUNK_UNIT + 100, 10 * CHUNK_UNIT, CHUNK_UNIT, 2 * CHUNK_UNIT),
+    # 范围的最后一个分片在范围末尾结束
+    (0, CHUNK_UNIT + 7, 2 * CHUNK_UNIT, CHUNK_UNIT + 7),
+    (CHUNK_UNIT, CHUNK_UNIT + 7, 2 * CHUNK_UNIT, CHUNK_UNIT + 7),
+])
+def test_fragment_end(start, end, chunk_size, stop):
+    assert fragment_end(start, end, chunk_size) == stop
+
+
+def test_reader_uploads_only_missing_ranges(tmp_path):
+    size = 5 * CHUNK_UNIT + 1234
+    data = os.urandom(size)
+    path = tmp_path / 'f.bin'
+    path.write_bytes(data)
+    ranges = parse_ranges(['0-%d' % (CHUNK_UNIT + 99),
+                           '%d-' % (3 * CHUNK_UNIT + 10)], size)
+    hasher = QuickXorHash()
+    with ChunkReader(str(path), ranges, 2 * CHUNK_UNIT, 1, hasher) as reader:
+        chunks = list(reader)
+
+    assert [(c.start, c.end) for c in chunks] == [
+        (0, CHUNK_UNIT + 99),
+        (3 * CHUNK_UNIT + 10, 5 * CHUNK_UNIT - 1),
+        (5 * CHUNK_UNIT, size - 1),
+    ]
+    for c in chunks:
+        assert b''.join(bytes(b) for b in c.data) == data[c.start:c.end + 1]
+        # 范围之间服务器已有的部分也计算了hash
+        assert c.hasher.length == c.end + 1
+        assert c.hasher.base64() == \
+            QuickXorHash(data[:c.end + 1]).base64()
+
+
+
+@pytest.fixture
+def disk_reads(monkeypatch) -> list:
+    """
+    :return: 从磁盘读取的字节数，每次读取一项
+    """
+    reads = []
+
+    def counting_read_into(f, view):
+        n = read_into(f, view)
+        reads.append(n)
+        return n
+
+    read_into = buffer_pool.read_into
+    monkeypatch.setattr(buffer_pool, 'read_into', counting_read_into)
+    monkeypatch.setattr(chunk_reader, 'read_into', counting_read_into)
+    return reads
+
+
+def test_sent_chunks_are_read_from_disk_once(tmp_path, disk_reads):
+    size = 3 * CHUNK_UNIT + 1234
+    data = os.urandom(size)
+    path = tmp_path / 'f.bin'
+    path.write_bytes(data)
+    sent = []
+    with ChunkReader(str(path), [(0, size - 1)], CHUNK_UNIT, 2,
+                     QuickXorHash()) as reader:
+        for c in reader:
+            sent.append(b''.join(bytes(b) for b in c.data.blocks(4096)))
+            assert c.hasher.base64() == \
+                QuickXorHash(data[:c.end + 1]).base64()
+    assert b''.join(sent) == data
+    assert sum(disk_reads) == size
+
+
+def test_retry_reads_the_chunk_again(tmp_path):
+    data = os.urandom(2 * CHUNK_UNIT)
+    path = tmp_path / 'f.bin'
+    path.write_bytes(data)
+    with ChunkReader(str(path), [(0, len(data) - 1)], CHUNK_UNIT, 1,
+                     QuickXorHash()) as reader:
+        c = next(reader)
+        blocks = c.data.blocks()
+        next(blocks)
+        # 发送中断
+        blocks.close()
+        assert b''.join(bytes(b) for b in c.data) == data[:CHUNK_UNIT]
+        assert c.hasher.base64() == QuickXorHash(data[:CHUNK_UNIT]).base64()
+        c = next(reader)
+        assert b''.join(bytes(b) for b in c.data) == data[CHUNK_UNIT:]
+        assert c.hasher.base64() == QuickXorHash(data).base64()
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_hashing_slice_hashes_while_sending(tmp_path, disk_reads, use_async):
+    size = 2 * CHUNK_UNIT + 100
+    data = os.urandom(size)
+    path = tmp_path / 'f.bin'
+    path.write_bytes(data)
+
+    def send(body) -> bytes:
+        if not use_async:
+            return b''.join(bytes(b) for b in body.blocks(4096))
+
+        async def collect():
+            return b''.join([b async for b in body.ablocks(4096)])
+        return asyncio.run(collect())
+
+    hasher = QuickXorHash()
+    with open(path, 'rb') as f:
+        # 开头的100字节服务器已有，只计算hash
+        c = next_chunk(f, [(100, size - 1)], CHUNK_UNIT, hasher)
+        assert (c.start, c.end) == (100, CHUNK_UNIT - 1)
+        assert hasher.length == 100
+        first = send(c.data)
+        # 重试时不重复计算hash
+        assert send(c.data) == first == data[100:CHUNK_UNIT]
+        assert c.hasher.base64() == QuickXorHash(data[:CHUNK_UNIT]).base64()
+        c = next_chunk(f, [(100, size - 1)], CHUNK_UNIT, hasher)
+        assert send(c.data) == data[CHUNK_UNIT:2 * CHUNK_UNIT]
+    assert hasher.base64() == QuickXorHash(data[:2 * CHUNK_UNIT]).base64()
+    assert sum(disk_reads) == 100 + (CHUNK_UNIT - 100) * 2 + CHUNK_UNIT
+
+
+def test_reader_rejects_hasher_not_at_start(tmp_path):
+    path = tmp_path / 'f.bin'
+    path.write_bytes(b'\0' * 100)
+    with pytest.raises(ValueError):
+        ChunkReader(str(path), [(10, 99)], CHUNK_UNIT, 1, QuickXorHash())
+
+
+def test_align_chunk_size():
+    assert align_chunk_size(0) == CHUNK_UNIT
+    assert align_chunk_size(3 * CHUNK_UNIT - 1) == 2 * CHUNK_UNIT
+    assert align_chunk_size(10 ** 10) == MAX_CHUNK_SIZE
+
+
+def test_adaptive_chunk_size_follows_throughput():
+    size = AdaptiveChunkSize(10 * CHUNK_UNIT, target_time=10)
+    assert size.update(10 * CHUNK_UNIT, 10) == 10 * CHUNK_UNIT
+    # 每次最多变为原来的2倍或1/2
+    assert size.update(10 * CHUNK_UNIT, 1) == 20 * CHUNK_UNIT
+    assert size.update(20 * CHUNK_UNIT, 100) == 10 * CHUNK_UNIT
+    assert size.update(10 * CHUNK_UNIT, 8) == 12 * CHUNK_UNIT
+    for _ in range(20):
+        size.update(size.chunk_size, 0.001)
+    assert size.chunk_size == MAX_CHUNK_SIZE
+
+
+def test_adaptive_chunk_size_shrinks_on_retry():
+    size = AdaptiveChunkSize(16 * CHUNK_UNIT)
+    # 重试时不论用时多少，每次重试减半
+    assert size.update(16 * CHUNK_UNIT, 0.1, retries=1) == 8 * CHUNK_UNIT
+    assert size.update(8 * CHUNK_UNIT, 0.1, retries=2) == 2 * CHUNK_UNIT
+    assert size.update(2 * CHUNK_UNIT, 0.1, retries=5) == CHUNK_UNIT
+
+
+def test_fixed_chunk_size():
+    size = AdaptiveChunkSize(10 * CHUNK_UNIT, adaptive=False)
+    assert size.update(10 * CHUNK_UNIT, 0.1) == 10 * CHUNK_UNIT
+    assert size.update(10 * CHUNK_UNIT, 100, retries=3) == 10 * CHUNK_UNIT
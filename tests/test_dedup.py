@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+SIZE = 6 * 1024 * 1024
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_duplicate_of_resumed_file_is_copied(mock_graph, make_helper,
+                                             interrupt_upload, tmp_path,
+                                             engine):
+    if engine == 'async':
+        pytest.importorskip('aiohttp')
+    data = os.urandom(SIZE)
+    src = tmp_path / 'src'
+    src.mkdir()
+    for name in ('a.bin', 'b.bin'):
+        (src / name).write_bytes(data)
+    helper = make_helper(engine)
+    interrupt_upload(helper, str(src / 'a.bin'), '/dst/src/')
+    received = mock_graph.stats()['bytes_received']
+
+    results = helper.upload_dir(str(src), '/dst', workers=2)
+
+    statuses = {os.path.basename(i.local_file_path): i.status
+                for i in results}
+    assert statuses == {'a.bin': 'finished', 'b.bin': 'finished'}
+    copied = [i for i in results if i.copied_from]
+    assert [os.path.basename(i.local_file_path) for i in copied] == ['b.bin']
+    # 续传时只发送上次缺少的部分，重复的文件没有上传
+    stats = mock_graph.stats()
+    assert stats['bytes_received'] - received < SIZE
+    assert stats['bytes_resent'] == 0
+    drive = mock_graph.drive_for('Bearer bench')
+    for name in ('a.bin', 'b.bin'):
+        assert drive.resolve('/dst/src/' + name).data == data
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from bench.runner import StaticAuth
+from helpers import upload_daemon
+from helpers.checkpoint_store import CheckpointStore
+from helpers.job_queue import RESUMABLE_STATUS, JobQueue
+from helpers.remote_tree import RemoteTree
+from helpers.upload_helper import checkpoint_key, create_upload_info
+from helpers.upload_index import UploadIndex
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'jobs.db'))
+    yield jobs
+    jobs.close()
+
+
+def test_take_in_submit_order(jobs):
+    a = jobs.submit('file', '/a', '/dst')
+    b = jobs.submit('dir', '/b', '/dst', {'workers': 2})
+    job = jobs.take()
+    assert (job['id'], job['status']) == (a, 'running')
+    assert jobs.get(a)['status'] == 'running'
+    job = jobs.take()
+    assert (job['id'], job['options']) == (b, {'workers': 2})
+    assert jobs.take() is None
+
+
+def test_update_only_from_expected_status(jobs):
+    job_id = jobs.submit('file', '/a', '/dst')
+    jobs.take()
+    # 上传中的任务不能直接恢复
+    assert not jobs.update(job_id, 'queued', expect=RESUMABLE_STATUS)
+    assert jobs.update(job_id, 'paused')
+    assert jobs.update(job_id, 'queued', expect=RESUMABLE_STATUS)
+    assert jobs.take()['id'] == job_id
+    assert jobs.update(job_id, 'finished', {'finished': 1})
+    assert jobs.get(job_id)['result'] == {'finished': 1}
+    assert not jobs.update(job_id, 'queued', expect=RESUMABLE_STATUS)
+    assert [j['id'] for j in jobs.list('finished')] == [job_id]
+
+
+def test_running_jobs_are_requeued_on_restart(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    jobs = JobQueue(path)
+    a = jobs.submit('file', '/a', '/dst')
+    b = jobs.submit('file', '/b', '/dst')
+    jobs.take()
+    jobs.update(b, 'paused')
+    jobs.close()
+    jobs = JobQueue(path)
+    assert jobs.get(a)['status'] == 'queued'
+    assert jobs.get(b)['status'] == 'paused'
+    jobs.close()
+
+
+def test_watched_files(jobs):
+    assert jobs.watched('/w/a') is None
+    jobs.submit_watched('/w/a', '/dst/w', {}, 10, 123)
+    assert jobs.watched('/w/a') == (10, 123)
+    assert jobs.take()['local_path'] == '/w/a'
+
+
+@pytest.fixture
+def daemon(tmp_path, jobs, monkeypatch):
+    monkeypatch.setattr(upload_daemon, 'UploadIndex',
+                        lambda: UploadIndex(str(tmp_path / 'index.db')))
+    monkeypatch.setattr(upload_daemon, 'RemoteTree',
+                        lambda: RemoteTree(str(tmp_path / 'tree.db')))
+    checkpoints = CheckpointStore(str(tmp_path / 'checkpoints.db'))
+    daemon = upload_daemon.UploadDaemon(
+        StaticAuth(), str(tmp_path / 'daemon.sock'), jobs,
+        checkpoints=checkpoints)
+    yield daemon
+    daemon.tokens.close()
+    daemon.upload_index.close()
+    daemon.remote_tree.close()
+    checkpoints.close()
+
+
+def test_pause_resume_and_cancel_queued_job(daemon, tmp_path):
+    r = daemon.handle({'op': 'submit', 'kind': 'dir',
+                       'local_path': str(tmp_path), 'one_dir': '/dst'})
+    job_id = r['job']['id']
+    assert r['job']['status'] == 'queued'
+    assert daemon.handle({'op': 'pause', 'id': job_id})['job']['status'] \
+        == 'paused'
+    assert daemon.handle({'op': 'resume', 'id': job_id})['job']['status'] \
+        == 'queued'
+    assert daemon.handle({'op': 'cancel', 'id': job_id})['job']['status'] \
+        == 'cancelled'
+    with pytest.raises(ValueError):
+        daemon.handle({'op': 'pause', 'id': job_id})
+    assert daemon.handle({'op': 'resume', 'id': job_id})['job']['status'] \
+        == 'queued'
+
+
+def test_job_cancelled_before_upload_starts(daemon, tmp_path):
+    job_id = daemon.jobs.submit('dir', str(tmp_path), '/dst')
+    job = daemon.jobs.take()
+    daemon.handle({'op': 'cancel', 'id': job_id})
+    daemon._run_job(job)
+    assert daemon.jobs.get(job_id)['status'] == 'cancelled'
+
+
+def test_cancel_deletes_upload_sessions(daemon, mock_graph, make_helper,
+                                        interrupt_upload, tmp_path):
+    path = tmp_path / 'big.bin'
+    path.write_bytes(b'\1' * 3 * 1024 * 1024)
+    cached = interrupt_upload(make_helper(), str(path), '/dst/')
+    key = checkpoint_key(create_upload_info(str(path), '/dst/',
+                                            StaticAuth.account))
+    daemon.checkpoints.save(key, cached, sync=True)
+    drive = mock_graph.drive_for('Bearer bench')
+    assert len(drive.sessions) == 1
+
+    job_id = daemon.jobs.submit('file', str(path), '/dst')
+
+    def upload(helper, job):
+        # 上传过程中收到取消请求，当前分片完成后停止
+        daemon.handle({'op': 'cancel', 'id': job_id})
+        info = create_upload_info(str(path), '/dst/', StaticAuth.account)
+        info.status = 'stopped'
+        return [info]
+
+    daemon._upload = upload
+    daemon._run_job(daemon.jobs.take())
+
+    job = daemon.jobs.get(job_id)
+    assert job['status'] == 'cancelled'
+    assert job['result']['stopped'] == 1
+    assert daemon.checkpoints.get(key) is None
+    assert not drive.sessions
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import tarfile
+import types
+
+import pytest
+
+import app_config
+from bench.runner import StaticAuth
+from helpers.pack import SegmentWriter, read_member
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip'])
+def test_segments_record_member_offsets(tmp_path, compression):
+    files = {}
+    for i, size in enumerate([0, 1, 511, 512, 513, 70000]):
+        path = tmp_path / 'src' / ('f%d' % i)
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(os.urandom(size))
+        files['f%d' % i] = path
+
+    writer = SegmentWriter(str(tmp_path / 'spill'), 'pack', 4096,
+                           compression, max_segments=10)
+    segments = []
+    for name, path in files.items():
+        segment = writer.add(types.SimpleNamespace(
+            local_file_path=str(path)), name)
+        if segment is not None:
+            segments.append(segment)
+    segments.append(writer.close())
+    segments = [s for s in segments if s is not None]
+    # 超过分段大小上限后开始新的分段
+    assert len(segments) > 1
+
+    members = 0
+    for segment in segments:
+        with tarfile.open(segment.path) as tar:
+            assert tar.getnames() == [m.arcname for m in segment.members]
+        for m in segment.members:
+            data = files[m.arcname].read_bytes()
+            assert m.length == len(data)
+            assert m.sha256 == hashlib.sha256(data).hexdigest()
+            assert read_member(segment.path, m.offset, m.length,
+                               compression) == data
+            members += 1
+        writer.release(segment)
+        assert not os.path.exists(segment.path)
+    assert members == len(files)
+
+
+def test_packed_upload_indexes_member_files_only(mock_graph, make_helper,
+                                                 tmp_path, monkeypatch):
+    monkeypatch.setattr(app_config, 'UPLOAD_PACK_SPILL_DIR',
+                        str(tmp_path / 'spill'))
+    src = tmp_path / 'src'
+    src.mkdir()
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        (src / name).write_bytes(os.urandom(1000))
+    helper = make_helper()
+
+    results = helper.upload_dir_packed(str(src), '/dst', workers=2)
+
+    assert sorted(i.status for i in results) == ['finished'] * 3
+    # 分段和索引是临时文件，只有原来的文件记录在上传索引中
+    assert helper.upload_index.count() == 3
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        assert helper.upload_index.get(StaticAuth.account['home_account_id'],
+                                       str(src / name),
+                                       '/dst/src/' + name)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import time
+
+from utils.progress import (Progress, Transfer, display_width, fit,
+                            slowest_transfers, table_data)
+
+
+def test_progress_counts():
+    p = Progress()
+    for _ in p.planned(range(3)):
+        pass
+    with p.transfer('a', 100, finished=40) as t:
+        t.update(70, 30)
+        s = p.snapshot()
+        assert (s.planned_files, s.started_files, s.queued_files) == (3, 1, 2)
+        assert (s.done_files, s.sent, len(s.active)) == (0, 30, 1)
+        t.update(100, 60)
+    # $batch请求中没有全部上传成功时不计入完成的文件
+    with p.transfer('$batch', 10, files=2) as t:
+        t.update(5, 5)
+    s = p.snapshot()
+    assert (s.started_files, s.done_files, s.sent) == (3, 1, 65)
+    assert s.active == []
+
+
+def test_slowest_transfers_skip_just_started():
+    now = time.time()
+    slow, fast, new = (Transfer(n, 100, 0, 1) for n in ('slow', 'fast',
+                                                         'new'))
+    slow.start = fast.start = now - 10
+    slow.sent, fast.sent = 10, 1000
+    new.start = now
+    assert [t.name for t in slowest_transfers([new, fast, slow], now, 2)] \
+        == ['slow', 'fast']
+
+
+def test_wide_names_fit_table():
+    name = '中文文件名' * 10
+    assert display_width(name) == 100
+    assert display_width(fit(name, 11)) == 10
+    row = table_data(name, 100, 50, 10, 20)
+    assert display_width(row.split('|')[0]) == 22
+    assert '50.0%' in row
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import base64
+import os
+
+import pytest
+
+from utils.quick_xor_hash import QuickXorHash, quick_xor_hash_file
+
+
+def reference(data: bytes) -> str:
+    """
+    按算法说明逐字节计算：第i个字节循环左移 (i * 11) % 160 位后异或，最后与长度异或
+    """
+    state = 0
+    for i, b in enumerate(data):
+        shift = i * 11 % 160
+        v = b << shift
+        state ^= (v & ((1 << 160) - 1)) | (v >> 160)
+    result = bytearray(state.to_bytes(20, 'little'))
+    for i, b in enumerate(len(data).to_bytes(8, 'little')):
+        result[12 + i] ^= b
+    return base64.b64encode(bytes(result)).decode('ascii')
+
+
+def test_empty():
+    assert QuickXorHash().base64() == 'AAAAAAAAAAAAAAAAAAAAAAAAAAA='
+
+
+@pytest.mark.parametrize('size', [1, 159, 160, 161, 1000, 4099])
+def test_matches_reference(size):
+    data = os.urandom(size)
+    assert QuickXorHash(data).base64() == reference(data)
+
+
+@pytest.mark.parametrize('sizes', [[1, 1, 1], [159, 2, 320], [7, 1000, 13],
+                                   [160, 160, 161]])
+def test_chunked_equals_whole(sizes):
+    data = os.urandom(sum(sizes))
+    hasher = QuickXorHash()
+    pos = 0
+    for n in sizes:
+        hasher.update(memoryview(data)[pos:pos + n])
+        pos += n
+    assert hasher.length == len(data)
+    assert hasher.base64() == QuickXorHash(data).base64()
+
+
+def test_resume_from_saved_state(tmp_path):
+    data = os.urandom(100000)
+    path = tmp_path / 'f'
+    path.write_bytes(data)
+    part = quick_xor_hash_file(str(path), 30000)
+    resumed = QuickXorHash(state=part.state, length=part.length)
+    assert quick_xor_hash_file(str(path), hasher=resumed).base64() == \
+        QuickXorHash(data).base64()
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from helpers.remote_tree import RemoteTree
+
+
+def test_delta_after_moving_folder(mock_graph, tmp_path):
+    drive = mock_graph.drive_for('Bearer bench')
+    with drive.lock:
+        sub = drive.resolve('/r/a/sub', create_parents=True)
+        drive.put_file(sub, 'old.txt', b'old', 'fail')
+    tree = RemoteTree(str(tmp_path / 'tree.db'))
+    try:
+        tree.sync('bench', 'bench', '/r')
+        assert tree.get('bench', '/r/a/sub/old.txt') is not None
+
+        # 在服务器上将/r/a重命名为/r/b，再在没有变化的子文件夹中添加文件
+        with drive.lock:
+            a = drive.resolve('/r/a')
+            del drive.tree[a.parent_id]['a']
+            a.name = 'b'
+            drive.tree[a.parent_id]['b'] = a.id
+            drive._touch(a)
+            drive.put_file(sub, 'new.txt', b'new', 'fail')
+        tree.sync('bench', 'bench', '/r')
+
+        assert tree.get('bench', '/r/a') is None
+        assert tree.get('bench', '/r/a/sub/old.txt') is None
+        assert tree.get('bench', '/r/b/sub')['item_id'] == sub.id
+        assert tree.get('bench', '/r/b/sub/old.txt') is not None
+        assert tree.get('bench', '/r/b/sub/new.txt') is not None
+        assert tree.get('bench', '/r/a/sub/new.txt') is None
+    finally:
+        tree.close()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from helpers.upload_helper import UploadInfo, checkpoint_key, resume_hasher
+from utils.chunk_reader import CHUNK_UNIT
+from utils.quick_xor_hash import quick_xor_hash_file
+
+SIZE = 6 * 1024 * 1024
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_resume_sends_only_missing_bytes(mock_graph, make_helper,
+                                         interrupt_upload, tmp_path, engine):
+    if engine == 'async':
+        pytest.importorskip('aiohttp')
+    data = os.urandom(SIZE)
+    path = tmp_path / 'big.bin'
+    path.write_bytes(data)
+    helper = make_helper(engine)
+    cached = interrupt_upload(helper, str(path), '/dst/')
+
+    info = helper.upload_file(str(path), '/dst')
+
+    assert info.status == 'finished'
+    assert info.upload_url == cached['upload_url']
+    assert mock_graph.stats()['bytes_resent'] == 0
+    assert mock_graph.drive_for('Bearer bench').resolve(
+        '/dst/big.bin').data == data
+    assert helper.checkpoints.get(checkpoint_key(info)) is None
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_changed_file_deletes_old_session(mock_graph, make_helper,
+                                          interrupt_upload, tmp_path, engine):
+    if engine == 'async':
+        pytest.importorskip('aiohttp')
+    path = tmp_path / 'big.bin'
+    path.write_bytes(os.urandom(SIZE))
+    helper = make_helper(engine)
+    cached = interrupt_upload(helper, str(path), '/dst/')
+    # 修改已上传的部分，大小和cid取样的位置不变
+    data = bytearray(path.read_bytes())
+    data[CHUNK_UNIT // 2] ^= 1
+    path.write_bytes(data)
+
+    info = helper.upload_file(str(path), '/dst')
+
+    assert info.status == 'finished'
+    assert info.upload_url != cached['upload_url']
+    drive = mock_graph.drive_for('Bearer bench')
+    assert drive.resolve('/dst/big.bin').data == data
+    # 上次的会话已删除，没有遗留在服务器上
+    assert not drive.sessions
+
+
+def test_resume_hasher_verifies_uploaded_part(tmp_path):
+    path = tmp_path / 'big.bin'
+    path.write_bytes(os.urandom(2 * CHUNK_UNIT))
+    info = UploadInfo('big.bin', 2 * CHUNK_UNIT, str(path), '', '/', {}, '',
+                      finished=CHUNK_UNIT)
+    # 旧版本的断点续传信息没有hash状态，无法校验
+    assert resume_hasher(info, info.size) is None
+
+    hasher = resume_hasher(UploadInfo('big.bin', 2 * CHUNK_UNIT, str(path),
+                                      '', '/', {}, ''), info.size)
+    assert hasher.length == 0
+    info.quick_xor_state = '%x' % quick_xor_hash_file(str(path),
+                                                      CHUNK_UNIT).state
+    assert resume_hasher(info, info.size).length == CHUNK_UNIT
+    assert resume_hasher(info, info.size + 1) is None
+    info.quick_xor_state = '%x' % (int(info.quick_xor_state, 16) ^ 1)
+    assert resume_hasher(info, info.size) is None
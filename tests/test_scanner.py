@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from helpers.scanner import DirectoryScanner, ScanOptions, cid_hash_file
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'root'
+    for rel, size in [('a.txt', 10), ('b.log', 20), ('d/c.txt', 0x10000),
+                      ('d/e/f.txt', 30), ('skip/g.txt', 40), ('empty', 0)]:
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(size))
+    return str(root).replace('\\', '/')
+
+
+def scan(root: str, **options) -> dict:
+    scanner = DirectoryScanner(root, ScanOptions(**options),
+                               lambda path, rel_dir, stat: True)
+    return {os.path.relpath(e.path, root).replace('\\', '/'): e
+            for _, entries in scanner for e in entries}
+
+
+@pytest.mark.parametrize('hash_threads', [0, 4])
+def test_scan_computes_cid(tree, hash_threads):
+    entries = scan(tree, hash_threads=hash_threads, walkers=3)
+    assert sorted(entries) == ['a.txt', 'b.log', 'd/c.txt', 'd/e/f.txt',
+                               'skip/g.txt']
+    for rel, e in entries.items():
+        assert e.cid_hash == cid_hash_file(e.path)
+        assert e.rel_dir == os.path.dirname(rel)
+
+
+def test_scan_filters(tree):
+    assert sorted(scan(tree, exclude=['skip', '*.log'])) == \
+        ['a.txt', 'd/c.txt', 'd/e/f.txt']
+    assert sorted(scan(tree, include=['*.txt'], max_depth=1)) == \
+        ['a.txt', 'd/c.txt', 'skip/g.txt']
+
+
+def test_select_skips_files_without_hashing(tree):
+    scanner = DirectoryScanner(tree, ScanOptions(),
+                               lambda path, rel_dir, stat: rel_dir == 'd')
+    entries = [e for _, entries in scanner for e in entries]
+    assert [os.path.basename(e.path) for e in entries] == ['c.txt']
+    assert scanner.hashed == 1
+    # 包括空文件
+    assert scanner.skipped == 5
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+import types
+
+import pytest
+
+from bench.runner import StaticAuth
+from helpers.session_prefetch import SessionPrefetcher, precreate_session
+from helpers.upload_helper import checkpoint_key, create_upload_info
+
+
+def files(*sizes):
+    return [types.SimpleNamespace(name='f%d' % i, size=s)
+            for i, s in enumerate(sizes)]
+
+
+def test_prefetch_keeps_order_and_limits_concurrency():
+    lock = threading.Lock()
+    creating = []
+    peak = []
+
+    def create(info):
+        with lock:
+            creating.append(info.name)
+            peak.append(len(creating))
+        time.sleep(0.01)
+        with lock:
+            creating.remove(info.name)
+        return True
+
+    infos = files(10, 100, 100, 1, 100, 100, 100)
+    prefetcher = SessionPrefetcher(2, 50, create, lambda info: None)
+    assert list(prefetcher.prefetch(infos)) == infos
+    # 只为大文件创建会话，同时最多depth个
+    assert len(peak) == 5
+    assert max(peak) <= 2
+
+
+def test_close_cancels_unused_sessions():
+    cancelled = []
+    prefetcher = SessionPrefetcher(
+        4, 50, lambda info: info.name != 'f2', cancelled.append)
+    infos = files(100, 100, 100, 100)
+    for _ in prefetcher.prefetch(infos):
+        pass
+    prefetcher.close()
+    # 创建了会话的文件都交给cancel，由它跳过已经使用的会话
+    assert sorted(i.name for i in cancelled) == ['f0', 'f1', 'f3']
+
+
+def test_stop_event_prevents_creating():
+    stop_event = threading.Event()
+    stop_event.set()
+    created = []
+    prefetcher = SessionPrefetcher(2, 0, created.append, lambda info: None,
+                                   stop_event)
+    infos = files(100, 100)
+    assert list(prefetcher.prefetch(infos)) == infos
+    assert created == []
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_expired_precreated_session_is_deleted(mock_graph, make_helper,
+                                               tmp_path, engine):
+    if engine == 'async':
+        pytest.importorskip('aiohttp')
+    data = os.urandom(5 * 1024 * 1024)
+    path = tmp_path / 'big.bin'
+    path.write_bytes(data)
+    helper = make_helper(engine)
+    info = create_upload_info(str(path), '/dst/', StaticAuth.account)
+    assert precreate_session(helper, info)
+    key = checkpoint_key(info)
+    cached = helper.checkpoints.get(key)
+    # 排队太久，本地记录的过期时间已过，服务器上的会话仍然存在
+    cached['expiration'] = '2000-01-01T00:00:00Z'
+    helper.checkpoints.save(key, cached, sync=True)
+    drive = mock_graph.drive_for('Bearer bench')
+    assert len(drive.sessions) == 1
+
+    result = helper.upload_file(str(path), '/dst')
+
+    assert result.status == 'finished'
+    assert result.upload_url != cached['upload_url']
+    assert drive.resolve('/dst/big.bin').data == data
+    assert not drive.sessions
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import os
+import types
+
+from bench.runner import StaticAuth
+from helpers.shard_scheduler import ShardScheduler, is_quota_error
+
+ACCOUNTS = [{'username': '%s@localhost' % a, 'home_account_id': a}
+            for a in 'abc']
+
+
+def task(size: int, account: str = 'a') -> list:
+    return [types.SimpleNamespace(
+        size=size, onedrive_account={'home_account_id': account})]
+
+
+def make_scheduler(remaining=None, paused=None):
+    moves = []
+    scheduler = ShardScheduler(
+        ACCOUNTS, remaining or {a['home_account_id']: 1000 for a in ACCOUNTS},
+        lambda a: (paused or {}).get(a, 0),
+        lambda t, account: moves.append((t, account['home_account_id'])),
+        steal_after=5)
+    return scheduler, moves
+
+
+def test_assign_balances_by_size():
+    scheduler, moves = make_scheduler()
+    tasks = [task(s) for s in (500, 400, 300, 200, 100)]
+    assert scheduler.assign(tasks) == []
+    # 从大到小分配给已分配字节数最少的账号
+    assert scheduler.load == {'a': 500, 'b': 500, 'c': 500}
+    assert scheduler.remaining == {'a': 500, 'b': 500, 'c': 500}
+    # 原来属于a的任务分配给其他账号时调用retarget
+    assert sorted((t[0].size, a) for t, a in moves) == \
+        [(100, 'b'), (200, 'c'), (300, 'c'), (400, 'b')]
+
+
+def test_assign_rejects_tasks_no_account_can_hold():
+    scheduler, _ = make_scheduler({'a': 100, 'b': 50, 'c': 0})
+    big = task(200)
+    assert scheduler.assign([big, task(80)]) == [big]
+    assert scheduler.assign([task(60)], exclude=['b']) != []
+
+
+def test_next_prefers_unthrottled_account_with_most_queued():
+    scheduler, _ = make_scheduler(paused={'a': 1})
+    scheduler.add('a', task(900, 'a'))
+    scheduler.add('b', task(100, 'b'))
+    scheduler.add('b', task(200, 'b'))
+    account_id, t = scheduler.next()
+    assert account_id == 'b' and t[0].size == 100
+    scheduler.done()
+
+
+def test_idle_account_steals_from_throttled_account():
+    scheduler, moves = make_scheduler(paused={'a': 30})
+    first, last = task(100), task(200)
+    pinned = task(300)
+    scheduler.add('a', pinned)
+    scheduler._push('a', first, True)
+    scheduler._push('a', last, True)
+
+    account_id, t = scheduler.next()
+
+    # 从队尾取出可以转移的任务，交给空闲且分配字节数最少的账号
+    assert t is last
+    assert account_id in ('b', 'c')
+    assert moves == [(last, account_id)]
+    assert scheduler.moved == 1
+    assert scheduler.load['a'] == 400 and scheduler.load[account_id] == 200
+    # 只能上传到a的任务不会被转移
+    assert [q[0] for q in scheduler.queues['a']] == [pinned, first]
+
+
+def test_no_steal_when_pause_is_short():
+    scheduler, moves = make_scheduler(paused={'a': 2})
+    scheduler._push('a', task(100), True)
+    account_id, _ = scheduler.next()
+    assert account_id == 'a'
+    assert moves == []
+
+
+def test_quota_exceeded_moves_queued_and_failed_tasks():
+    scheduler, moves = make_scheduler()
+    pinned, queued, failed = task(100), task(200), task(300)
+    scheduler.add('a', pinned)
+    scheduler._push('a', queued, True)
+
+    assert scheduler.quota_exceeded('a', [failed]) == []
+
+    assert 'a' in scheduler.full
+    assert scheduler.remaining['a'] == 0
+    assert sorted(a for _, a in moves) == ['b', 'c']
+    assert {id(t) for t, _ in moves} == {id(queued), id(failed)}
+    assert [q[0] for q in scheduler.queues['a']] == [pinned]
+    assert scheduler.moved == 2
+    # 空间不足的账号不再分配任务
+    scheduler.assign([task(10)])
+    assert not any(t[0].size == 10 for t, _ in scheduler.queues['a'])
+
+
+def test_is_quota_error():
+    assert is_quota_error("{'code': 'quotaLimitReached'}")
+    assert is_quota_error('status 507')
+    assert not is_quota_error('status 500')
+
+
+class TwoAccountAuth(StaticAuth):
+
+    def get_accounts(self, username=None):
+        return [a for a in ACCOUNTS[:2]
+                if username is None or a['username'] == username]
+
+    def acquire_token_silent_with_error(self, scopes, account,
+                                        force_refresh=False):
+        return {'access_token': account['home_account_id'],
+                'expires_in': 3600}
+
+
+def test_files_moved_after_quota_error_land_in_prepared_folders(
+        mock_graph, make_helper, tmp_path):
+    src = tmp_path / 'src'
+    files = {}
+    for i in range(6):
+        rel = 'd%d/e/f%d.bin' % (i % 2, i)
+        files[rel] = os.urandom(100 * 1024 + i)
+        (src / rel).parent.mkdir(parents=True, exist_ok=True)
+        (src / rel).write_bytes(files[rel])
+    drive_a = mock_graph.drive_for('Bearer a')
+    # 账号a报告的剩余空间足够，但实际上传时空间不足
+    drive_a.quota = 0
+    drive_a.drive_json = lambda: {'id': 'a', 'quota': {
+        'total': 1 << 40, 'used': 0, 'remaining': 1 << 40,
+        'state': 'normal'}}
+    helper = make_helper(auth=TwoAccountAuth())
+
+    results = helper.upload_dir_sharded(
+        str(src), '/dst', [a['username'] for a in ACCOUNTS[:2]], workers=2)
+
+    assert sorted(i.status for i in results) == ['finished'] * len(files)
+    assert all(i.onedrive_account['home_account_id'] == 'b'
+               for i in results)
+    drive_b = mock_graph.drive_for('Bearer b')
+    for rel, data in files.items():
+        assert drive_b.resolve('/dst/src/' + rel).data == data
+    # 新账号的文件夹已记录到目录树缓存中，上传时使用父目录的id
+    for d in ('/dst/src/d0/e', '/dst/src/d1/e'):
+        assert helper.remote_tree.get('b', d) is not None
+    assert all(i.parent_id for i in results)
+    assert all(helper.upload_index.get('b', i.local_file_path,
+                                       i.onedrive_dir_path + i.filename)
+               for i in results)
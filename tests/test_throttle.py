@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import email.utils
+import threading
+import time
+
+import pytest
+import requests
+
+from graph import drive_api
+from graph.async_drive_api import AsyncThrottle
+from graph.throttle import ThrottleController, retry_after
+
+
+def test_throttle_halves_limit_and_pauses():
+    throttle = ThrottleController(8)
+    throttle.on_throttle(0.2)
+    assert int(throttle.limit) == 4
+    assert throttle.paused_for() > 0
+    start = time.time()
+    with throttle.slot():
+        assert time.time() - start >= 0.15
+    throttle.on_throttle(0)
+    throttle.on_throttle(0)
+    throttle.on_throttle(0)
+    assert throttle.limit == 1.0
+
+
+def test_success_increases_limit_up_to_max():
+    throttle = ThrottleController(4)
+    throttle.limit = 1.0
+    for _ in range(100):
+        throttle.on_success()
+    assert throttle.limit == 4
+
+
+def test_acquire_waits_for_free_slot():
+    throttle = ThrottleController(1)
+    throttle.acquire()
+    acquired = threading.Event()
+
+    def worker():
+        with throttle.slot():
+            acquired.set()
+
+    t = threading.Thread(target=worker)
+    t.start()
+    assert not acquired.wait(0.1)
+    throttle.release()
+    assert acquired.wait(1)
+    t.join()
+    assert throttle.inflight == 0
+
+
+def test_retry_after():
+    assert retry_after({'Retry-After': '3'}, 10) == 3
+    assert retry_after({}, 10) == 10
+    assert retry_after({'Retry-After': 'soon'}, 10) == 10
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < retry_after({'Retry-After': date}, 10) <= 30
+
+
+def test_request_retry_releases_slot_while_backing_off(monkeypatch):
+    throttle = ThrottleController(1)
+    calls = []
+    inflight_when_sleeping = []
+
+    def request(method, url, **kwargs):
+        calls.append(throttle.inflight)
+        if len(calls) == 1:
+            raise requests.exceptions.ConnectionError('reset')
+        resp = requests.Response()
+        resp.status_code = 200
+        return resp
+
+    monkeypatch.setattr(drive_api.transport, 'request', request)
+    monkeypatch.setattr(drive_api.time, 'sleep',
+                        lambda s: inflight_when_sleeping.append(
+                            throttle.inflight))
+
+    resp = drive_api.request_retry('GET', 'http://localhost/x', throttle)
+
+    assert resp.status_code == 200
+    # 发送时占用并发数，等待重试时已归还
+    assert calls == [1, 1]
+    assert inflight_when_sleeping == [0]
+    assert throttle.inflight == 0
+
+
+def test_transport_configure_keeps_sessions_in_use(mock_graph):
+    transport = drive_api.Transport(2)
+    url = mock_graph.graph_url + '/me/drive/root'
+    session = transport.session(url)
+    resp = transport.request('GET', url, stream=True)
+    old_adapter = session.get_adapter(url)
+
+    transport.configure(8)
+
+    # 正在使用的Session没有被关闭，之后的请求使用更大的连接池
+    assert transport.session(url) is session
+    assert old_adapter.poolmanager.pools
+    assert session.get_adapter(url)._pool_maxsize == 8
+    resp.content
+    resp.close()
+    transport.configure(4)
+    assert transport.pool_size == 8
+    assert transport.request('GET', url).status_code == resp.status_code
+
+
+def test_async_throttle_shares_controller_slots():
+    throttle = ThrottleController(1)
+    async_throttle = AsyncThrottle(throttle)
+    # 阻塞上传占用了唯一的并发数
+    throttle.acquire()
+    timer = threading.Timer(0.1, throttle.release)
+
+    async def request():
+        timer.start()
+        start = time.time()
+        async with async_throttle.slot():
+            waited = time.time() - start
+            assert throttle.inflight == 1
+            assert not throttle.try_acquire()
+        return waited
+
+    assert asyncio.run(request()) >= 0.05
+    timer.join()
+    assert throttle.inflight == 0
+
+    # 账号被限流时等到暂停结束
+    throttle.on_throttle(0.2)
+    assert asyncio.run(request_after_pause(async_throttle)) >= 0.15
+
+
+async def request_after_pause(async_throttle: AsyncThrottle) -> float:
+    start = time.time()
+    async with async_throttle.slot():
+        return time.time() - start
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import os
+
+SIZE = 1024 * 1024
+
+
+def names(results) -> list:
+    return sorted(os.path.basename(i.local_file_path) for i in results)
+
+
+def flip_middle_byte(path):
+    # 不在cid读取的三段内
+    with open(path, 'r+b') as f:
+        f.seek(SIZE // 2)
+        b = f.read(1)
+        f.seek(SIZE // 2)
+        f.write(bytes([b[0] ^ 0xff]))
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_edit_with_same_size_is_uploaded_again(mock_graph, make_helper,
+                                               tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    for name in ('a.bin', 'b.bin'):
+        (src / name).write_bytes(os.urandom(SIZE))
+    helper = make_helper()
+    assert names(helper.upload_dir(str(src), '/dst')) == ['a.bin', 'b.bin']
+
+    flip_middle_byte(src / 'a.bin')
+    # 只修改了修改时间，内容没有变化
+    st = os.stat(src / 'b.bin')
+    os.utime(src / 'b.bin', ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    results = helper.upload_dir(str(src), '/dst')
+
+    assert names(results) == ['a.bin']
+    assert results[0].status == 'finished'
+    drive = mock_graph.drive_for('Bearer bench')
+    assert drive.resolve('/dst/src/a.bin').data == \
+        (src / 'a.bin').read_bytes()
+    assert helper.upload_dir(str(src), '/dst') == []
+
+
+def test_rebuild_index_compares_content(mock_graph, make_helper, tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    for name in ('a.bin', 'b.bin'):
+        (src / name).write_bytes(os.urandom(SIZE))
+    helper = make_helper()
+    helper.upload_dir(str(src), '/dst')
+
+    # 索引丢失后本地文件被修改，大小不变
+    helper.upload_index.clear('bench', str(src))
+    flip_middle_byte(src / 'a.bin')
+    helper.rebuild_index(str(src), '/dst')
+    assert helper.upload_index.count() == 1
+
+    # 只有内容不同的文件重新上传
+    results = helper.upload_dir(str(src), '/dst')
+    assert names(results) == ['a.bin']
+    assert results[0].status == 'finished'
@@ -1,24 +1,159 @@
 # -*- coding: utf-8 -*-
 import argparse
 import os
+import sys
 
 import app_config
-from graph.auth import MSALAuth, OAuthSettings
-from helpers.upload_helper import UploadHelper
+from helpers import daemon_client
+from utils import color_print
 
 
 def create_msal_auth():
+    # 提交到守护进程时不需要导入MSAL和上传相关的模块
+    from graph.auth import MSALAuth, OAuthSettings
     return MSALAuth(
         OAuthSettings(app_id=os.getenv('APP_ID'),
                       app_secret=os.getenv('APP_SECRET'),
                       redirect=os.getenv('REDIRECT_URL')),
-        serialized_token_file=app_config.SERIALIZED_TOKEN)
+        serialized_token_file=app_config.SERIALIZED_TOKEN,
+        metadata_cache_file=app_config.AUTHORITY_METADATA_CACHE,
+        metadata_ttl=app_config.AUTHORITY_METADATA_TTL)
+
+
+def create_upload_helper(args):
+    from helpers.remote_tree import RemoteTree
+    from helpers.scanner import ScanOptions
+    from helpers.upload_helper import UploadHelper
+    from helpers.upload_index import UploadIndex
+    upload_index = None if args.no_index else UploadIndex()
+    remote_tree = None if args.no_remote_tree else RemoteTree()
+    scan_options = ScanOptions(args.include or [], args.exclude or [],
+                               args.max_depth)
+    return UploadHelper(create_msal_auth(), upload_index, args.conflict,
+                        remote_tree, engine=args.engine,
+                        scan_options=scan_options)
 
 
 def operations(args):
-    if args.file:
-        UploadHelper(create_msal_auth()).upload_file(
+    if args.daemon:
+        submit(args)
+        return
+    from utils.bandwidth import limiter
+    from utils.buffer_pool import BUFFERS_PER_UPLOAD, buffer_pool
+    from utils.profiler import SamplingProfiler
+    from utils.progress import Dashboard, progress
+    from utils.telemetry import telemetry
+    buffer_pool.configure(app_config.UPLOAD_BUFFER_SIZE * 1024,
+                          app_config.UPLOAD_BUFFER_COUNT,
+                          args.workers * (BUFFERS_PER_UPLOAD
+                                          + app_config.UPLOAD_READ_AHEAD))
+    try:
+        limiter.configure(args.limit_rate, app_config.BANDWIDTH_CONTROL_FILE)
+    except ValueError as e:
+        parser.error('invalid --limit-rate: %s' % e)
+    telemetry.configure(args.telemetry, args.prometheus,
+                        app_config.TELEMETRY_PROM_INTERVAL)
+    profiler = None
+    if args.profile:
+        profiler = SamplingProfiler(args.profile,
+                                    app_config.PROFILE_INTERVAL).start()
+    try:
+        with Dashboard(progress, args.progress,
+                       app_config.PROGRESS_REFRESH_INTERVAL,
+                       app_config.PROGRESS_LOG_INTERVAL,
+                       app_config.PROGRESS_TOP):
+            upload(args)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        telemetry.close()
+
+
+def upload(args):
+    if args.rebuild_index:
+        if not args.dir:
+            parser.error('--rebuild-index requires -d/--dir')
+        create_upload_helper(args).rebuild_index(
+            args.dir, args.one_dir, args.user)
+    elif args.shard is not None:
+        if not args.dir:
+            parser.error('--shard requires -d/--dir')
+        if args.pack:
+            parser.error('--pack can not be used with --shard')
+        create_upload_helper(args).upload_dir_sharded(
+            args.dir, args.one_dir, args.shard, args.workers,
+            not args.no_batch)
+    elif args.pack and not args.dir:
+        parser.error('--pack requires -d/--dir')
+    elif args.pack:
+        create_upload_helper(args).upload_dir_packed(
+            args.dir, args.one_dir, args.user, args.workers,
+            not args.no_batch, not args.no_dedup, args.pack)
+    elif args.file:
+        create_upload_helper(args).upload_file(
             args.file, args.one_dir, args.user)
+    elif args.dir:
+        create_upload_helper(args).upload_dir(
+            args.dir, args.one_dir, args.user, args.workers,
+            not args.no_batch, not args.no_dedup)
+
+
+def submit(args):
+    """
+    将上传任务提交到守护进程
+    """
+    if args.rebuild_index:
+        parser.error('--rebuild-index can not be used with --daemon')
+    if args.shard is not None and not args.dir:
+        parser.error('--shard requires -d/--dir')
+    if args.pack and (not args.dir or args.shard is not None):
+        parser.error('--pack requires -d/--dir and can not be used with '
+                     '--shard')
+    options = {
+        'user': args.user,
+        'shard': args.shard,
+        'workers': args.workers,
+        'engine': args.engine,
+        'batch': not args.no_batch,
+        'dedup': not args.no_dedup,
+        'pack': args.pack,
+        'include': args.include or [],
+        'exclude': args.exclude or [],
+        'max_depth': args.max_depth,
+        'conflict': args.conflict,
+        'no_index': args.no_index,
+        'no_remote_tree': args.no_remote_tree,
+    }
+    job = daemon_client.request(
+        'submit', kind='file' if args.file else 'dir',
+        local_path=os.path.abspath(args.file or args.dir),
+        one_dir=args.one_dir, options=options)['job']
+    color_print.b('已提交任务%d' % job['id'])
+    if not args.wait:
+        return
+    job = daemon_client.wait_job(job['id'])
+    result = job['result']
+    if job['status'] == 'finished':
+        color_print.g('任务%d完成, 上传%d个文件' % (job['id'],
+                                            result.get('finished', 0)))
+        return
+    color_print.r('任务%d: %s %s' % (job['id'], job['status'], job['error']))
+    sys.exit(1)
+
+
+class ListResumable(argparse.Action):
+    """
+    输出未完成的上传后退出，不需要其他参数
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from helpers.checkpoint_store import default_store
+        from helpers.upload_helper import (import_upload_info_files,
+                                           print_resumable)
+        checkpoints = default_store()
+        import_upload_info_files(checkpoints)
+        print_resumable(checkpoints)
+        parser.exit()
 
 
 parser = argparse.ArgumentParser(description='Onedrive file upload tool')
@@ -26,13 +161,103 @@ parser = argparse.ArgumentParser(description='Onedrive file upload tool')
 group = parser.add_mutually_exclusive_group(required=True)
 
 group.add_argument('-f', '--file', help='file to be uploaded')
-# group.add_argument('-d', '--dir', help='directory to be uploaded')
+group.add_argument('-d', '--dir', help='directory to be uploaded')
 
 parser.add_argument('-o', '--one_dir', required=True,
                     help='upload to this directory')
 parser.add_argument('-u', '--user',
                     help='specify Onedrive user, default the first one')
+parser.add_argument('--shard', nargs='*', metavar='USER',
+                    help='spread the files of the directory across these '
+                         'Onedrive users by size, all users if none is given')
+parser.add_argument('-w', '--workers', type=int,
+                    default=app_config.UPLOAD_WORKERS,
+                    help='number of files uploaded at the same time when '
+                         'uploading a directory, default %d'
+                         % app_config.UPLOAD_WORKERS)
+parser.add_argument('--engine', choices=['blocking', 'async'],
+                    default=app_config.UPLOAD_ENGINE,
+                    help='blocking uses a thread per file, async uploads many '
+                         'files in one thread with asyncio and requires '
+                         'aiohttp, default %s' % app_config.UPLOAD_ENGINE)
+parser.add_argument('--limit-rate', metavar='PROFILE',
+                    default=app_config.BANDWIDTH_LIMIT,
+                    help='upload bandwidth in MB/s shared by all files, '
+                         'optionally per time of day, e.g. '
+                         '"08:00-20:00=2,10". It can be changed while '
+                         'uploading by writing a new profile to '
+                         'BANDWIDTH_CONTROL_FILE of app_config.py')
+parser.add_argument('--no-batch', action='store_true',
+                    help='do not use $batch requests for folders and small '
+                         'files when uploading a directory')
+parser.add_argument('--no-dedup', action='store_true',
+                    help='upload files with identical content separately '
+                         'instead of uploading once and copying on the '
+                         'server')
+parser.add_argument('--pack', nargs='?', choices=['none', 'gzip', 'zstd'],
+                    const=app_config.UPLOAD_PACK_COMPRESSION,
+                    metavar='COMPRESSION',
+                    help='pack the small files of the directory into tar '
+                         'segments with an index instead of uploading them '
+                         'one by one, COMPRESSION is none, gzip or zstd, '
+                         'default %s' % app_config.UPLOAD_PACK_COMPRESSION)
+parser.add_argument('--include', action='append', metavar='GLOB',
+                    help='when uploading a directory, only upload files '
+                         'whose name or relative path matches GLOB, can be '
+                         'given several times')
+parser.add_argument('--exclude', action='append', metavar='GLOB',
+                    help='when uploading a directory, skip files and '
+                         'directories whose name or relative path matches '
+                         'GLOB, can be given several times')
+parser.add_argument('--max-depth', type=int, default=-1, metavar='N',
+                    help='when uploading a directory, only descend N levels '
+                         'of subdirectories, 0 uploads only the files '
+                         'directly in it, default no limit')
+parser.add_argument('--conflict', choices=['rename', 'replace', 'fail'],
+                    default=app_config.UPLOAD_CONFLICT_BEHAVIOR,
+                    help='what to do when a file with the same name already '
+                         'exists, default %s'
+                         % app_config.UPLOAD_CONFLICT_BEHAVIOR)
+parser.add_argument('--no-index', action='store_true',
+                    help='upload all files, even if they have been uploaded '
+                         'and not changed')
+parser.add_argument('--no-remote-tree', action='store_true',
+                    help='do not sync and use the local cache of the Onedrive '
+                         'directory tree when uploading a directory')
+parser.add_argument('--rebuild-index', action='store_true',
+                    help='rebuild the upload index of the directory from the '
+                         'files already in Onedrive, then exit')
+parser.add_argument('--list-resumable', action=ListResumable, nargs=0,
+                    help='list the unfinished uploads that can be resumed, '
+                         'then exit')
+parser.add_argument('--progress', choices=['auto', 'plain', 'none'],
+                    default=app_config.PROGRESS_MODE,
+                    help='auto shows a dashboard refreshed in the background '
+                         'on a terminal and prints a plain summary line '
+                         'periodically otherwise, plain always prints summary '
+                         'lines, default %s' % app_config.PROGRESS_MODE)
+parser.add_argument('--telemetry', metavar='FILE',
+                    default=app_config.TELEMETRY_JSONL,
+                    help='append per chunk, file and request timings to this '
+                         'JSON lines file')
+parser.add_argument('--prometheus', metavar='FILE',
+                    default=app_config.TELEMETRY_PROM,
+                    help='write upload metrics to this Prometheus textfile '
+                         'collector file')
+parser.add_argument('--profile', metavar='FILE',
+                    help='sample the call stacks of all threads during the '
+                         'upload and write them to this file in collapsed '
+                         'stack format')
+parser.add_argument('--daemon', action='store_true',
+                    help='submit the upload as a job to the running upload '
+                         'daemon (see daemon.py) instead of uploading in '
+                         'this process')
+parser.add_argument('--wait', action='store_true',
+                    help='with --daemon, wait until the job is done, exit '
+                         'with 1 if it failed')
 parser.set_defaults(func=operations)
 
-cmd_args = parser.parse_args()
-cmd_args.func(cmd_args)
+# 导入本模块时（例如测试）不解析命令行参数
+if __name__ == '__main__':
+    cmd_args = parser.parse_args()
+    cmd_args.func(cmd_args)
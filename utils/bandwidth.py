@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from utils import color_print
+from utils.buffer_pool import FileSlice, iter_blocks
+from utils.telemetry import TimedBody
+
+MB = 1024 * 1024
+# 有带宽限制时，请求体每次发送的字节数。越小各文件之间越公平，但调度开销越大
+SLICE_SIZE = 256 * 1024
+
+
+def parse_profile(spec: str) -> List[Tuple[Optional[Tuple[int, int]], float]]:
+    """
+    解析带宽限制，例如 "20"，或按时间段 "08:00-20:00=20,0"。
+    每一项为 [HH:MM-HH:MM=]MB/s，0表示不限制，没有时间段的一项用于其余时间，
+    时间段可以跨过午夜，例如 "22:00-06:00=0"
+    :return: [((开始分钟, 结束分钟)或None, 字节/秒)]
+    """
+    profile = []
+    for item in spec.replace(' ', '').split(','):
+        if not item:
+            continue
+        span = None
+        if '=' in item:
+            times, item = item.split('=', 1)
+            start, end = times.split('-')
+            span = (parse_minute(start), parse_minute(end))
+        rate = float(item)
+        if rate < 0:
+            raise ValueError('negative rate: %s' % item)
+        profile.append((span, rate * MB))
+    return profile
+
+
+def parse_minute(s: str) -> int:
+    hour, minute = s.split(':')
+    if not (0 <= int(hour) <= 24 and 0 <= int(minute) < 60):
+        raise ValueError('invalid time: %s' % s)
+    return int(hour) * 60 + int(minute)
+
+
+class BandwidthLimiter:
+    """
+    进程内所有上传共用的带宽限制（令牌桶）。
+    请求体分为SLICE_SIZE大小的小块，每块发送前按先来先到预约发送时间，
+    同时上传的文件轮流发送，平均分配带宽；空闲时最多积累burst_time秒的额度。
+    限制可以在上传过程中修改，正在上传的文件从下一块开始使用新的限制
+    """
+
+    def __init__(self, burst_time: float = 0.5):
+        """
+        :param burst_time: 空闲后允许立即发送的时长（秒）
+        """
+        self.burst_time = burst_time
+        self.spec = ''
+        self.control_file = ''
+        self._profile: List[Tuple[Optional[Tuple[int, int]], float]] = []
+        self._lock = threading.Lock()
+        # 下一块可以开始发送的时间（monotonic）
+        self._next = 0.0
+        self._control_mtime = None
+        self._control_checked = 0.0
+
+    def configure(self, spec: str = '', control_file: str = ''):
+        """
+        :param spec: 带宽限制，格式见parse_profile，为空时不限制
+        :param control_file: 上传过程中修改限制的文件，内容格式与spec相同，每秒检查一次
+        """
+        profile = parse_profile(spec)
+        with self._lock:
+            self.spec = spec
+            self._profile = profile
+            # 只使用启动后写入的内容，上次运行留下的文件不覆盖spec
+            self.control_file = control_file
+            self._control_mtime = self._control_file_mtime()
+            self._control_checked = time.monotonic()
+
+    def _control_file_mtime(self) -> Optional[int]:
+        if not self.control_file:
+            return None
+        try:
+            return os.stat(self.control_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _check_control_file(self):
+        now = time.monotonic()
+        if not self.control_file or now - self._control_checked < 1:
+            return
+        self._control_checked = now
+        mtime = self._control_file_mtime()
+        if mtime is None or mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+        try:
+            with open(self.control_file, 'r', encoding='utf8') as f:
+                spec = f.read().strip()
+            profile = parse_profile(spec)
+        except (OSError, ValueError) as e:
+            color_print.y('忽略无效的带宽限制: %s, %s' % (self.control_file, e))
+            return
+        self.spec = spec
+        self._profile = profile
+        color_print.b('带宽限制已修改为: %s' % (spec or '不限制'))
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._profile or self.control_file)
+
+    def rate(self, now: Optional[datetime.datetime] = None) -> float:
+        """
+        :param now: 本地时间，默认为当前时间
+        :return: 当前的带宽限制（字节/秒），0表示不限制
+        """
+        with self._lock:
+            self._check_control_file()
+            profile = self._profile
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        default = 0.0
+        for span, rate in profile:
+            if span is None:
+                default = rate
+                continue
+            start, end = span
+            if start <= minute < end or \
+                    (start > end and (minute >= start or minute < end)):
+                return rate
+        return default
+
+    def reserve(self, n: int) -> float:
+        """
+        预约发送n个字节
+        :return: 需要等待的秒数
+        """
+        rate = self.rate()
+        if rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now - self.burst_time)
+            self._next = start + n / rate
+        return max(start - now, 0)
+
+    def consume(self, n: int):
+        delay = self.reserve(n)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def consume_async(self, n: int):
+        delay = self.reserve(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+limiter = BandwidthLimiter()
+
+
+class LimitedBody(TimedBody):
+    """
+    按带宽限制分块发送的请求体，每块发送前等待令牌
+    """
+
+    def __init__(self, data, bandwidth: BandwidthLimiter = limiter,
+                 block_size: int = SLICE_SIZE):
+        super().__init__(data, block_size)
+        self.bandwidth = bandwidth
+
+    def __iter__(self):
+        for block in super().__iter__():
+            self.bandwidth.consume(len(block))
+            yield block
+
+    def __aiter__(self):
+        return self.aiter()
+
+    async def aiter(self):
+        """
+        asyncio上传使用的异步迭代，每次请求（包括重试）重新从头发送
+        """
+        self.sent_at = None
+        if isinstance(self.data, FileSlice):
+            blocks = self.data.ablocks(self.block_size)
+        else:
+            blocks = (bytes(b) for b in iter_blocks(self.data,
+                                                     self.block_size))
+        async for block in blocks:
+            await self.bandwidth.consume_async(len(block))
+            yield block
+        self.sent_at = time.perf_counter()
+
+
+def request_body(data, timed: bool = False):
+    """
+    :param data: 请求体
+    :param timed: 是否需要记录请求体发送完成的时间
+    :return: 有带宽限制时为LimitedBody，需要计时时为TimedBody，否则为data本身
+    """
+    if limiter.enabled:
+        return LimitedBody(data)
+    if timed:
+        return TimedBody(data)
+    return data
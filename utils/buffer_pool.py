@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import base64
+import collections
+import contextlib
+import threading
+import time
+from typing import Deque, List, Optional
+
+from utils import color_print
+
+# 等待缓冲区超过此时间（秒）时输出提示
+WAIT_WARNING = 30
+# 除预读的缓冲区外，每个上传同时占用的缓冲区数量：正在读取的和重试时发送的各一个
+BUFFERS_PER_UPLOAD = 2
+
+
+class BufferPool:
+    """
+    进程内所有上传共用的固定大小缓冲区。发送请求体和计算hash时，文件分块读取到缓冲区中，
+    不在内存中保存整个分片；缓冲区用完时等待其他请求归还，
+    读取文件占用的内存不超过 块大小 * 块数量，与分片大小和同时上传的文件数量无关。
+    每个同时进行的上传在读取时至少占用一个缓冲区，缓冲区数量少于同时上传的文件数量时
+    上传会轮流等待缓冲区，见configure的min_blocks
+    """
+
+    def __init__(self, block_size: int = 256 * 1024, blocks: int = 64):
+        self.block_size = block_size
+        self.blocks = blocks
+        self._cond = threading.Condition()
+        self._free: List[bytearray] = []
+        # 已分配的缓冲区数量，按需分配，最多blocks个
+        self._allocated = 0
+        self.peak = 0
+        # 等待缓冲区的asyncio Future，归还时直接交给最早等待的一个
+        self._async_waiters: Deque[asyncio.Future] = collections.deque()
+
+    def configure(self, block_size: int, blocks: int, min_blocks: int = 1):
+        """
+        :param block_size: 每个缓冲区的字节数
+        :param blocks: 缓冲区数量
+        :param min_blocks: 缓冲区数量的下限，例如 同时上传的文件数 * 每个上传占用的缓冲区数，
+            blocks较小时增加到此数量，避免上传大部分时间在等待缓冲区
+        """
+        if blocks < min_blocks:
+            color_print.y('缓冲区数量%d少于同时上传需要的%d个，增加到%d' % (
+                blocks, min_blocks, min_blocks))
+        with self._cond:
+            self.block_size = block_size
+            self.blocks = max(blocks, min_blocks, 1)
+            # 大小不同的缓冲区在归还时丢弃
+            self._allocated -= len(self._free)
+            self._free = []
+            self._wake()
+            self._cond.notify_all()
+
+    @property
+    def capacity(self) -> int:
+        """
+        :return: 所有缓冲区的总字节数
+        """
+        return self.block_size * self.blocks
+
+    def _try_acquire(self) -> Optional[bytearray]:
+        if self._free:
+            return self._free.pop()
+        if self._allocated < self.blocks:
+            self._allocated += 1
+            self.peak = max(self.peak, self._allocated)
+            return bytearray(self.block_size)
+        return None
+
+    def acquire(self, timeout: Optional[float] = None) -> Optional[bytearray]:
+        """
+        :param timeout: 最长等待时间（秒），为None时一直等待
+        :return: 缓冲区，超时时为None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = 0.0
+        with self._cond:
+            while True:
+                buf = self._try_acquire()
+                if buf is not None:
+                    return buf
+                wait = WAIT_WARNING if deadline is None \
+                    else deadline - time.monotonic()
+                if wait <= 0:
+                    return None
+                if not self._cond.wait(min(wait, WAIT_WARNING)):
+                    waited += min(wait, WAIT_WARNING)
+                    if deadline is None:
+                        color_print.y(
+                            '已等待缓冲区%ds，%d个缓冲区都在使用中，'
+                            '可以增加UPLOAD_BUFFER_COUNT' % (waited,
+                                                             self.blocks))
+
+    async def acquire_async(self) -> bytearray:
+        """
+        与acquire相同，等待时不阻塞事件循环
+        """
+        with self._cond:
+            buf = self._try_acquire()
+            if buf is not None:
+                return buf
+            future = asyncio.get_running_loop().create_future()
+            self._async_waiters.append(future)
+        return await future
+
+    def release(self, buf: bytearray):
+        with self._cond:
+            if len(buf) == self.block_size \
+                    and self._allocated <= self.blocks:
+                self._free.append(buf)
+            else:
+                self._allocated -= 1
+            self._wake()
+
+    def _wake(self):
+        """
+        有空闲的缓冲区时交给等待的协程，否则唤醒等待的线程。调用时持有_cond
+        """
+        while self._async_waiters:
+            buf = self._try_acquire()
+            if buf is None:
+                return
+            future = self._async_waiters.popleft()
+            try:
+                future.get_loop().call_soon_threadsafe(self._hand_off,
+                                                       future, buf)
+            except RuntimeError:
+                # 事件循环已关闭
+                self._free.append(buf)
+        self._cond.notify()
+
+    def _hand_off(self, future: asyncio.Future, buf: bytearray):
+        if future.done():
+            # 等待的协程已取消
+            self.release(buf)
+        else:
+            future.set_result(buf)
+
+    @contextlib.contextmanager
+    def buffer(self):
+        buf = self.acquire()
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+
+buffer_pool = BufferPool()
+
+
+class FileSlice:
+    """
+    文件的一段，作为请求体时分块读取到缓冲池的缓冲区中发送。
+    每次迭代（包括重试）重新从磁盘读取，可以同步或异步迭代
+    """
+
+    def __init__(self, path: str, offset: int, length: int,
+                 pool: BufferPool = buffer_pool):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.pool = pool
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.blocks()
+
+    def blocks(self, max_size: int = 0):
+        """
+        :param max_size: 每块的最大字节数，为0时为缓冲区大小
+        :return: 依次得到文件内容的memoryview，只在取得下一块之前有效
+        """
+        with self.pool.buffer() as buf, open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            view = memoryview(buf)
+            step = min(max_size or len(buf), len(buf))
+            left = self.length
+            while left > 0:
+                n = read_into(f, view[:min(left, len(buf))])
+                left -= n
+                for i in range(0, n, step):
+                    yield view[i:min(i + step, n)]
+
+    def __aiter__(self):
+        return self.ablocks()
+
+    async def ablocks(self, max_size: int = 0):
+        """
+        与blocks相同，在线程池中读取磁盘，得到的每块为bytes
+        """
+        loop = asyncio.get_running_loop()
+        buf = await self.pool.acquire_async()
+        f = None
+        try:
+            f = await loop.run_in_executor(None, open, self.path, 'rb')
+            f.seek(self.offset)
+            view = memoryview(buf)
+            step = min(max_size or len(buf), len(buf))
+            left = self.length
+            while left > 0:
+                n = await loop.run_in_executor(
+                    None, read_into, f, view[:min(left, len(buf))])
+                left -= n
+                for i in range(0, n, step):
+                    yield bytes(view[i:min(i + step, n)])
+        finally:
+            if f is not None:
+                f.close()
+            self.pool.release(buf)
+
+
+class JoinedBody:
+    """
+    由bytes和FileSlice依次拼接成的请求体，FileSlice的部分在发送时才分块读取，
+    例如$batch的JSON请求体中以base64编码的文件内容。可以重复迭代（重试）
+    """
+
+    def __init__(self, parts: list, encode_base64: bool = False):
+        """
+        :param parts: bytes或FileSlice
+        :param encode_base64: FileSlice的内容是否以base64编码发送
+        """
+        self.parts = parts
+        self.encode_base64 = encode_base64
+
+    def __len__(self):
+        return sum(4 * ((len(p) + 2) // 3)
+                   if self.encode_base64 and isinstance(p, FileSlice)
+                   else len(p) for p in self.parts)
+
+    def __iter__(self):
+        return self.blocks()
+
+    def blocks(self, max_size: int = 0):
+        """
+        :param max_size: 每块的最大字节数（base64编码前），为0时为缓冲区大小
+        """
+        for part in self.parts:
+            if not isinstance(part, FileSlice):
+                yield from iter_blocks(part, max_size or len(part) or 1)
+            elif not self.encode_base64:
+                yield from part.blocks(max_size)
+            else:
+                # 每次编码3的倍数个字节，余下的与下一块一起编码
+                rest = b''
+                for block in part.blocks(max_size):
+                    data = rest + block
+                    n = len(data) // 3 * 3
+                    if n:
+                        yield base64.b64encode(data[:n])
+                    rest = data[n:]
+                if rest:
+                    yield base64.b64encode(rest)
+
+
+def read_into(f, view: memoryview) -> int:
+    """
+    读满view
+    :return: 读取的字节数
+    :raise EOFError: 文件在读取过程中变短
+    """
+    n = 0
+    while n < len(view):
+        r = f.readinto(view[n:])
+        if not r:
+            raise EOFError('%s is shorter than expected' % f.name)
+        n += r
+    return n
+
+
+def iter_blocks(data, block_size: int):
+    """
+    将请求体分块
+    :param data: bytes, FileSlice或JoinedBody
+    """
+    if isinstance(data, (FileSlice, JoinedBody)):
+        yield from data.blocks(block_size)
+        return
+    view = memoryview(data)
+    for i in range(0, len(view), block_size):
+        yield view[i:i + block_size]
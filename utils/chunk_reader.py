@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import queue
+import threading
+import time
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+from utils.buffer_pool import BufferPool, FileSlice, buffer_pool, read_into
+from utils.quick_xor_hash import QuickXorHash
+
+# 分片大小必须为320KiB的整数倍（文件的最后一个分片除外），且小于60MiB
+CHUNK_UNIT = 320 * 1024
+MAX_CHUNK_SIZE = CHUNK_UNIT * 191
+
+
+class HashingSlice(FileSlice):
+    """
+    分片的请求体，发送时从磁盘分块读取，同时继续计算文件的hash，每个字节只读取一次。
+    重试时重新读取，只计算还没有计算过的部分
+    """
+
+    def __init__(self, path: str, offset: int, length: int,
+                 hasher: Optional[QuickXorHash] = None,
+                 pool: BufferPool = buffer_pool):
+        """
+        :param hasher: 已计算到offset的QuickXorHash，为None时不计算
+        """
+        super().__init__(path, offset, length, pool)
+        self.hasher = hasher
+        # 读取磁盘和计算hash的用时（秒）
+        self.read_time = 0.0
+        self.hash_time = 0.0
+
+    def _read(self, f, view: memoryview, pos: int) -> int:
+        """
+        从文件读取view，计算其中从hasher.length开始的部分的hash
+        :param pos: view在文件中的位置
+        """
+        read_start = time.perf_counter()
+        n = read_into(f, view)
+        hash_start = time.perf_counter()
+        skip = self.hasher.length - pos if self.hasher is not None else n
+        if 0 <= skip < n:
+            self.hasher.update(view[skip:n])
+        self.read_time += hash_start - read_start
+        self.hash_time += time.perf_counter() - hash_start
+        return n
+
+    def blocks(self, max_size: int = 0):
+        with self.pool.buffer() as buf, open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            view = memoryview(buf)
+            step = min(max_size or len(buf), len(buf))
+            pos = self.offset
+            left = self.length
+            while left > 0:
+                n = self._read(f, view[:min(left, len(buf))], pos)
+                pos += n
+                left -= n
+                for i in range(0, n, step):
+                    yield view[i:min(i + step, n)]
+
+    async def ablocks(self, max_size: int = 0):
+        loop = asyncio.get_running_loop()
+        buf = await self.pool.acquire_async()
+        f = None
+        try:
+            f = await loop.run_in_executor(None, open, self.path, 'rb')
+            f.seek(self.offset)
+            view = memoryview(buf)
+            step = min(max_size or len(buf), len(buf))
+            pos = self.offset
+            left = self.length
+            while left > 0:
+                n = await loop.run_in_executor(
+                    None, self._read, f, view[:min(left, len(buf))], pos)
+                pos += n
+                left -= n
+                for i in range(0, n, step):
+                    yield bytes(view[i:min(i + step, n)])
+        finally:
+            if f is not None:
+                f.close()
+            self.pool.release(buf)
+
+
+class StreamedSlice(FileSlice):
+    """
+    ChunkReader读取的分片的请求体。后台线程将分片读取到缓冲池的缓冲区中并计算hash，
+    第一次发送时直接发送这些缓冲区，不再读取磁盘；重试时从磁盘重新读取
+    """
+
+    def __init__(self, path: str, offset: int, length: int, depth: int,
+                 pool: BufferPool = buffer_pool):
+        """
+        :param depth: 后台线程最多提前读取的缓冲区数量
+        """
+        super().__init__(path, offset, length, pool)
+        # 计算到分片末尾的QuickXorHash副本，整个分片读取完成后才有值
+        self.hasher: Optional[QuickXorHash] = None
+        self.read_time = 0.0
+        self.hash_time = 0.0
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+        # (缓冲区, 字节数)
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._lock = threading.Lock()
+        # 已开始发送读取的缓冲区
+        self._taken = False
+        # 不再发送读取的缓冲区，后台线程读取后直接归还
+        self._abandoned = False
+
+    def feed(self, buf: bytearray, n: int,
+             stop_event: threading.Event) -> bool:
+        """
+        后台线程交给请求体一个读取并计算了hash的缓冲区，请求体发送后归还
+        :return: 是否成功，stop_event被设置时为False
+        """
+        while not self._abandoned:
+            if stop_event.is_set():
+                self.pool.release(buf)
+                return False
+            try:
+                self._queue.put((buf, n), timeout=0.1)
+            except queue.Full:
+                continue
+            with self._lock:
+                if self._abandoned:
+                    # 放入时已被放弃
+                    self._drain()
+            return True
+        self.pool.release(buf)
+        return True
+
+    def fail(self, e: Exception):
+        self.error = e
+        self.done.set()
+
+    def abandon(self):
+        """
+        不再发送后台线程读取的缓冲区，例如发送中断后重试，或者分片没有发送
+        """
+        with self._lock:
+            self._abandoned = True
+            self._drain()
+
+    def _drain(self):
+        while True:
+            try:
+                buf, _ = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self.pool.release(buf)
+
+    def _take(self) -> Tuple[bytearray, int]:
+        while True:
+            try:
+                return self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.done.is_set() and self._queue.empty():
+                    raise self.error or EOFError(
+                        'reading %s stopped' % self.path)
+
+    def blocks(self, max_size: int = 0):
+        with self._lock:
+            first = not self._taken and not self._abandoned
+            self._taken = True
+        if not first:
+            self.abandon()
+            yield from super().blocks(max_size)
+            # hasher由后台线程计算
+            self.done.wait()
+            if self.error is not None:
+                raise self.error
+            return
+        buf = None
+        left = self.length
+        try:
+            while left > 0:
+                item = self._take()
+                if buf is not None:
+                    self.pool.release(buf)
+                buf, n = item
+                view = memoryview(buf)
+                step = min(max_size or n, n)
+                for i in range(0, n, step):
+                    yield view[i:min(i + step, n)]
+                left -= n
+        finally:
+            if buf is not None:
+                self.pool.release(buf)
+            if left > 0:
+                self.abandon()
+
+
+class Chunk(NamedTuple):
+    start: int
+    end: int
+    # 发送时才读取或由后台线程读取到缓冲区中，不在内存中保存整个分片
+    data: Union[HashingSlice, StreamedSlice]
+
+    @property
+    def hasher(self) -> Optional[QuickXorHash]:
+        """
+        计算到end的QuickXorHash，没有指定hasher时为None。分片发送完成后才有值
+        """
+        return self.data.hasher
+
+    @property
+    def read_time(self) -> float:
+        return self.data.read_time
+
+    @property
+    def hash_time(self) -> float:
+        return self.data.hash_time
+
+
+class ChunkReader:
+    """
+    在后台线程中提前读取文件分片到缓冲池的缓冲区中并计算hash，迭代得到Chunk，
+    分片的请求体直接发送这些缓冲区，磁盘读取与网络上传同时进行，每个字节只读取一次。
+    只读取服务器缺少的字节范围，范围之间服务器已有的部分只计算hash
+    """
+
+    def __init__(self,
+                 path: str,
+                 ranges: List[Tuple[int, int]],
+                 chunk_size: int,
+                 read_ahead: int = 2,
+                 hasher: Optional[QuickXorHash] = None):
+        """
+        :param path: 本地文件路径
+        :param ranges: 需要上传的字节范围 [(开始, 结束)]，包含结束位置，按顺序排列
+        :param chunk_size: 分片大小
+        :param read_ahead: 提前读取的缓冲区数量，至少为1
+        :param hasher: 已计算到第一个范围开始位置的QuickXorHash，读取的同时继续计算
+        """
+        start = ranges[0][0] if ranges else 0
+        if hasher is not None and hasher.length != start:
+            raise ValueError('hasher length %d != start %d' % (hasher.length,
+                                                               start))
+        self.path = path
+        self.ranges = ranges
+        self.chunk_size = chunk_size
+        self.read_ahead = max(read_ahead, 1)
+        self.hasher = hasher
+        # 迭代得到的上一个分片，取下一个分片时不再发送它读取的缓冲区
+        self._current: Optional[Chunk] = None
+        self._queue = queue.Queue(maxsize=1)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        body = None
+        try:
+            with open(self.path, 'rb') as f:
+                pos = self.ranges[0][0] if self.ranges else 0
+                f.seek(pos)
+                for start, end in self.ranges:
+                    if end < pos:
+                        continue
+                    read_time = hash_time = 0.0
+                    if start > pos:
+                        # 服务器已有的部分只计算hash
+                        if self.hasher is not None:
+                            read_time, hash_time = hash_to(f, start,
+                                                           self.hasher)
+                        f.seek(start)
+                        pos = start
+                    while pos <= end:
+                        # 分片大小可能在上传过程中被调整
+                        stop = fragment_end(pos, end + 1, self.chunk_size)
+                        body = StreamedSlice(self.path, pos, stop - pos,
+                                             self.read_ahead)
+                        body.read_time, body.hash_time = read_time, hash_time
+                        read_time = hash_time = 0.0
+                        if not self._put(Chunk(pos, stop - 1, body)) \
+                                or not self._read(f, body):
+                            return
+                        body = None
+                        pos = stop
+        except Exception as e:
+            if body is not None:
+                body.fail(e)
+            # 读取出错，交给消费者处理
+            self._put(e)
+            return
+        finally:
+            if body is not None:
+                body.done.set()
+        self._put(None)
+
+    def _read(self, f, body: StreamedSlice) -> bool:
+        """
+        将分片读取到缓冲区中，计算hash后依次交给请求体
+        :return: 是否读取完成，停止时为False
+        """
+        left = body.length
+        while left > 0:
+            buf = body.pool.acquire(timeout=0.1)
+            if buf is None:
+                if self._stop_event.is_set():
+                    return False
+                continue
+            try:
+                read_start = time.perf_counter()
+                n = read_into(f, memoryview(buf)[:min(left, len(buf))])
+                hash_start = time.perf_counter()
+                if self.hasher is not None:
+                    self.hasher.update(memoryview(buf)[:n])
+            except BaseException:
+                body.pool.release(buf)
+                raise
+            body.read_time += hash_start - read_start
+            body.hash_time += time.perf_counter() - hash_start
+            left -= n
+            if left == 0:
+                # 在交出最后一个缓冲区之前设置，请求体发送完成时hasher已有值
+                body.hasher = self.hasher.copy() \
+                    if self.hasher is not None else None
+            if not body.feed(buf, n, self._stop_event):
+                return False
+        body.done.set()
+        return True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Chunk:
+        if self._current is not None:
+            # 上一个分片已发送或不再发送
+            self._current.data.abandon()
+            self._current = None
+        item = self._queue.get()
+        if item is None:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        self._current = item
+        return item
+
+    def close(self):
+        self._stop_event.set()
+        if self._current is not None:
+            self._current.data.abandon()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def parse_ranges(next_expected_ranges: List[str],
+                 size: int) -> List[Tuple[int, int]]:
+    """
+    将上传会话的nextExpectedRanges转换为字节范围
+    :param next_expected_ranges: 例如 ["0-327679", "655360-"]，没有结束位置时到文件末尾
+    :param size: 文件大小
+    :return: 按顺序排列、不重叠的范围 [(开始, 结束)]，包含结束位置
+    """
+    ranges = []
+    for r in next_expected_ranges:
+        start, _, end = r.partition('-')
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+        if start <= end:
+            ranges.append((start, end))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def fragment_end(start: int, end: int, chunk_size: int) -> int:
+    """
+    :param start: 分片的开始位置
+    :param end: 所在范围的结束位置（不包含）
+    :return: 分片的结束位置（不包含）。分片在320KiB的整数倍处结束，
+        开始位置没有对齐时缩短分片使下一个分片对齐；范围的最后一个分片在范围末尾结束
+    """
+    stop = start + chunk_size
+    aligned = stop // CHUNK_UNIT * CHUNK_UNIT
+    if start < aligned < stop:
+        stop = aligned
+    return min(stop, end)
+
+
+def next_chunk(f, ranges: List[Tuple[int, int]], chunk_size: int,
+               hasher: Optional[QuickXorHash] = None) -> Optional[Chunk]:
+    """
+    从文件的当前位置划分下一个需要上传的分片，当前位置不在范围内时跳到下一个范围，
+    跳过的部分（服务器已有）只计算hash。分片的内容在发送时读取，同时计算hash
+    :param f: 以二进制方式打开的文件，返回后位于分片的末尾
+    :param ranges: 需要上传的字节范围 [(开始, 结束)]，包含结束位置
+    :param hasher: 已计算到当前位置的QuickXorHash，分片发送完成后计算到分片末尾
+    :return: 分片，所有范围都已划分时为None
+    """
+    pos = f.tell()
+    for start, end in ranges:
+        if end < pos:
+            continue
+        read_time = hash_time = 0.0
+        if start > pos:
+            if hasher is not None:
+                read_time, hash_time = hash_to(f, start, hasher)
+            f.seek(start)
+            pos = start
+        stop = fragment_end(pos, end + 1, chunk_size)
+        body = HashingSlice(f.name, pos, stop - pos, hasher)
+        body.read_time, body.hash_time = read_time, hash_time
+        f.seek(stop)
+        return Chunk(pos, stop - 1, body)
+    return None
+
+
+def hash_to(f, stop: int, hasher: QuickXorHash) -> Tuple[float, float]:
+    """
+    从文件的当前位置读取到stop，继续计算hash
+    :return: (读取磁盘的用时, 计算hash的用时)
+    """
+    read_time = hash_time = 0.0
+    with buffer_pool.buffer() as buf:
+        view = memoryview(buf)
+        left = stop - f.tell()
+        while left > 0:
+            read_start = time.perf_counter()
+            n = read_into(f, view[:min(left, len(buf))])
+            hash_start = time.perf_counter()
+            hasher.update(view[:n])
+            read_time += hash_start - read_start
+            hash_time += time.perf_counter() - hash_start
+            left -= n
+    return read_time, hash_time
+
+
+class AdaptiveChunkSize:
+    """
+    根据每个分片的上传速度调整分片大小，使上传一个分片的时间接近target_time
+    """
+
+    def __init__(self,
+                 chunk_size: int,
+                 target_time: float = 10,
+                 adaptive: bool = True):
+        """
+        :param chunk_size: 初始分片大小
+        :param target_time: 上传一个分片的目标时间（秒）
+        :param adaptive: 为False时分片大小固定不变
+        """
+        self.target_time = target_time
+        self.adaptive = adaptive
+        self.chunk_size = align_chunk_size(chunk_size)
+
+    def update(self, sent: int, put_time: float, retries: int = 0) -> int:
+        """
+        :param sent: 分片的字节数
+        :param put_time: 分片上传成功的那次请求的用时（秒）
+        :param retries: 分片的重试次数
+        :return: 新的分片大小
+        """
+        if not self.adaptive:
+            return self.chunk_size
+
+        if retries > 0:
+            # 出现重试，分片减半，降低再次出错时重传的代价
+            self.chunk_size = align_chunk_size(self.chunk_size >> retries)
+        elif put_time > 0:
+            ideal = sent / put_time * self.target_time
+            # 每次最多变为原来的2倍或1/2，避免抖动
+            ideal = min(max(ideal, self.chunk_size / 2), self.chunk_size * 2)
+            self.chunk_size = align_chunk_size(int(ideal))
+        return self.chunk_size
+
+
+def align_chunk_size(chunk_size: int) -> int:
+    """
+    向下取整为320KiB的整数倍，并限制在 [320KiB, MAX_CHUNK_SIZE] 内
+    """
+    chunk_size = chunk_size // CHUNK_UNIT * CHUNK_UNIT
+    return min(max(chunk_size, CHUNK_UNIT), MAX_CHUNK_SIZE)
@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
+import sys
+
+
+def _color(code: int, s: str) -> str:
+    # 输出到文件或管道时（例如nohup）不使用颜色控制字符
+    if not sys.stdout.isatty():
+        return s
+    return "\033[%dm%s\033[0m" % (code, s)
+
+
 def rs(s: str) -> str:
-    return "\033[31m%s\033[0m" % s
+    return _color(31, s)
 
 
 def gs(s: str) -> str:
-    return "\033[32m%s\033[0m" % s
+    return _color(32, s)
 
 
 def ys(s: str) -> str:
-    return "\033[33m%s\033[0m" % s
+    return _color(33, s)
 
 
 def bs(s: str) -> str:
-    return "\033[34m%s\033[0m" % s
+    return _color(34, s)
 
 
 def r(s: str):
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import socket
+import socketserver
+import threading
+from typing import Callable, Union
+
+# 每个连接发送一行JSON请求，返回一行JSON响应
+MAX_REQUEST_SIZE = 1024 * 1024
+
+Address = Union[str, tuple]
+
+
+def control_address(socket_path: str, port: int) -> Address:
+    """
+    支持Unix domain socket时使用socket_path，否则（Windows）使用本机的TCP端口
+    """
+    if hasattr(socket, 'AF_UNIX'):
+        return socket_path
+    return '127.0.0.1', port
+
+
+def send_request(address: Address, request: dict,
+                 timeout: float = 30) -> dict:
+    """
+    :return: 守护进程的响应
+    :raise ConnectionError: 守护进程没有运行
+    """
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise ConnectionError('the upload daemon is not running: %s' % e)
+        sock.sendall(json.dumps(request).encode('utf8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('the upload daemon closed the connection')
+    return json.loads(line)
+
+
+class ControlServer:
+    """
+    在后台线程中接收控制请求，每个连接使用一个线程调用handler
+    """
+
+    def __init__(self, address: Address, handler: Callable[[dict], dict]):
+        """
+        :param address: Unix domain socket路径或(host, port)
+        :param handler: 处理请求，返回响应；抛出的异常作为错误返回给客户端
+        """
+        self.address = address
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline(MAX_REQUEST_SIZE)
+                try:
+                    resp = handler(json.loads(line))
+                except Exception as e:
+                    resp = {'ok': False, 'error': str(e)}
+                self.wfile.write(json.dumps(resp, ensure_ascii=False)
+                                 .encode('utf8') + b'\n')
+
+        if isinstance(address, tuple):
+            base = socketserver.ThreadingTCPServer
+        else:
+            base = socketserver.ThreadingUnixStreamServer
+            remove_stale_socket(address)
+
+        class Server(base):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server(address, Handler)
+        if not isinstance(address, tuple):
+            # 只有当前用户可以提交任务
+            os.chmod(address, 0o600)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if not isinstance(self.address, tuple):
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+
+
+def remove_stale_socket(path: str):
+    """
+    删除上次异常退出时留下的socket文件，已有守护进程在运行时抛出异常
+    """
+    if not os.path.exists(path):
+        return
+    try:
+        send_request(path, {'op': 'ping'}, timeout=5)
+    except (ConnectionError, OSError):
+        os.remove(path)
+        return
+    raise Exception('the upload daemon is already running: %s' % path)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import collections
+import os
+import sys
+import threading
+
+
+class SamplingProfiler:
+    """
+    采样分析器：后台线程每隔interval秒记录所有线程的调用栈，
+    结束时按火焰图工具（flamegraph.pl、speedscope）使用的折叠格式写入文件，
+    每行为 "线程;函数;函数... 次数"。对上传速度的影响远小于cProfile
+    """
+
+    def __init__(self, output: str, interval: float = 0.005):
+        """
+        :param output: 输出文件路径
+        :param interval: 采样间隔（秒）
+        """
+        self.output = output
+        self.interval = interval
+        self.samples = 0
+        self._stacks = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        with open(self.output, 'w', encoding='utf8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
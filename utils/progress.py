@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+import collections
+import contextlib
+import io
+import shutil
+import sys
+import threading
+import time
+import unicodedata
+from typing import Iterable, Iterator, List, NamedTuple, Optional
+
+# 进度表格中文件名的最大宽度
+MAX_TITLE_LEN = 78
+# 计算当前速度的时间窗口（秒）
+RATE_WINDOW = 5
+# 开始上传超过此时间（秒）的文件才参与最慢排序，刚开始的文件速度还不准确
+SLOW_MIN_TIME = 2
+
+
+class Transfer:
+    """
+    一个正在上传的文件（或$batch请求）的进度。只由上传它的线程写入，渲染线程只读取，
+    每个字段的赋值在Python中是原子的，上传时更新进度不加锁
+    """
+    __slots__ = ('name', 'size', 'files', 'start', 'finished', 'sent',
+                 'completed')
+
+    def __init__(self, name: str, size: int, finished: int, files: int):
+        self.name = name
+        self.size = size
+        self.files = files
+        self.start = time.time()
+        # 服务器已有的字节数，续传时从上次的进度开始
+        self.finished = finished
+        # 本次运行发送的字节数
+        self.sent = 0
+        # 上传成功的文件数，结束时计入汇总
+        self.completed = 0
+
+    def update(self, finished: int, sent: int):
+        """
+        :param finished: 服务器已有的字节数
+        :param sent: 本次运行发送的字节数
+        """
+        self.sent = sent
+        self.finished = finished
+        if finished >= self.size:
+            self.completed = self.files
+
+    def speed(self, now: float) -> int:
+        elapsed = now - self.start
+        return int(self.sent / elapsed) if elapsed > 0 else 0
+
+
+class ProgressSnapshot(NamedTuple):
+    # 计划上传的文件数，上传目录时随扫描增加
+    planned_files: int
+    started_files: int
+    done_files: int
+    # 本次运行发送的字节数，包括正在上传的文件
+    sent: int
+    active: List[Transfer]
+
+    @property
+    def queued_files(self) -> int:
+        return max(self.planned_files - self.started_files, 0)
+
+
+class Progress:
+    """
+    所有上传的进度计数，由上传线程更新，渲染线程定期读取。
+    上传过程中只写入各自的Transfer，只有文件开始和结束时加锁
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = {}
+        self._planned_files = 0
+        self._started_files = 0
+        self._done_files = 0
+        self._done_sent = 0
+
+    def plan(self, files: int):
+        """
+        记录排队等待上传的文件
+        """
+        with self._lock:
+            self._planned_files += files
+
+    def planned(self, items: Iterable) -> Iterator:
+        """
+        迭代时将每一项记为一个排队的文件
+        """
+        for item in items:
+            self.plan(1)
+            yield item
+
+    @contextlib.contextmanager
+    def transfer(self, name: str, size: int, finished: int = 0,
+                 files: int = 1) -> Iterator[Transfer]:
+        """
+        上传一个文件期间显示它的进度
+        :param name: 显示的名称
+        :param size: 大小
+        :param finished: 服务器已有的字节数
+        :param files: 包含的文件数，例如$batch请求
+        """
+        t = Transfer(name, size, finished, files)
+        with self._lock:
+            self._active[id(t)] = t
+            self._started_files += files
+        try:
+            yield t
+        finally:
+            with self._lock:
+                del self._active[id(t)]
+                self._done_files += t.completed
+                self._done_sent += t.sent
+
+    def snapshot(self) -> ProgressSnapshot:
+        with self._lock:
+            active = list(self._active.values())
+            return ProgressSnapshot(
+                self._planned_files, self._started_files, self._done_files,
+                self._done_sent + sum(t.sent for t in active), active)
+
+
+class _LineBuffer(io.TextIOBase):
+    """
+    显示仪表盘期间代替sys.stdout，其他线程输出的完整行由渲染线程输出在仪表盘上方
+    """
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._pending = ''
+        self._lines: List[str] = []
+
+    def write(self, s: str) -> int:
+        with self._lock:
+            self._pending += s
+            if '\n' in self._pending:
+                lines, self._pending = self._pending.rsplit('\n', 1)
+                self._lines.append(lines + '\n')
+        return len(s)
+
+    def take(self, partial: bool = False) -> str:
+        """
+        :param partial: 是否包括没有换行的内容
+        """
+        with self._lock:
+            text = ''.join(self._lines)
+            self._lines = []
+            if partial:
+                text += self._pending
+                self._pending = ''
+            return text
+
+    def isatty(self) -> bool:
+        return self.stream.isatty()
+
+    def fileno(self) -> int:
+        return self.stream.fileno()
+
+    @property
+    def encoding(self):
+        return self.stream.encoding
+
+
+class Dashboard:
+    """
+    在单独的线程中以固定的频率显示所有上传的汇总进度：文件数、上传量、当前和平均速度、
+    上传中和排队的文件数，以及最慢的几个上传。标准输出不是终端时（例如nohup）
+    改为定期输出一行不含控制字符的汇总
+    """
+
+    def __init__(self,
+                 progress: Progress,
+                 mode: str = 'auto',
+                 interval: float = 0.5,
+                 log_interval: float = 30,
+                 top: int = 5,
+                 stream=None):
+        """
+        :param progress: 读取的进度
+        :param mode: auto（终端中显示仪表盘，否则定期输出汇总行）, plain（总是输出汇总行）, none
+        :param interval: 仪表盘的刷新间隔（秒）
+        :param log_interval: 输出汇总行的间隔（秒）
+        :param top: 显示最慢的上传数量
+        :param stream: 输出位置，默认为sys.stdout
+        """
+        self.progress = progress
+        self.stream = stream or sys.stdout
+        self.mode = mode
+        if mode == 'auto':
+            self.mode = 'tty' if self.stream.isatty() else 'plain'
+        self.interval = interval if self.mode == 'tty' else log_interval
+        self.top = top
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._buffer: Optional[_LineBuffer] = None
+        self._start = 0.0
+        # 上次显示的仪表盘行数，刷新时先清除
+        self._drawn = 0
+        # (时间, 发送的字节数)，计算当前速度
+        self._samples = collections.deque()
+
+    def start(self) -> 'Dashboard':
+        if self.mode == 'none':
+            return self
+        self._start = time.time()
+        if self.mode == 'tty' and sys.stdout is self.stream:
+            self._buffer = _LineBuffer(self.stream)
+            sys.stdout = self._buffer
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        # 最后显示一次，保留在屏幕上
+        self._render(final=True)
+        if self._buffer is not None:
+            sys.stdout = self.stream
+            self._buffer = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self._render()
+            except Exception:
+                # 显示出错不影响上传
+                pass
+
+    def _render(self, final: bool = False):
+        s = self.progress.snapshot()
+        now = time.time()
+        samples = self._samples
+        samples.append((now, s.sent))
+        while len(samples) > 2 and now - samples[1][0] >= RATE_WINDOW:
+            samples.popleft()
+        t0, sent0 = samples[0]
+        rate = int((s.sent - sent0) / (now - t0)) if now > t0 else 0
+        elapsed = now - self._start
+        average = int(s.sent / elapsed) if elapsed > 0 else 0
+
+        if self.mode == 'plain':
+            self.stream.write('[进度] %s\n' % ', '.join(
+                summary_fields(s, rate, average, elapsed)))
+            self.stream.flush()
+            return
+
+        width = shutil.get_terminal_size((80, 24)).columns - 1
+        lines = [fit(' ' + ' | '.join(summary_fields(s, rate, average,
+                                                       elapsed)), width)]
+        slowest = [] if final else slowest_transfers(s.active, now, self.top)
+        if slowest:
+            title_len = max(min(MAX_TITLE_LEN, width - 43,
+                                max(display_width(t.name) for t in slowest)),
+                            8)
+            lines += [fit(line, width)
+                      for line in table_header_and_divider(title_len)]
+            lines += [fit(table_data(t.name, t.size, t.finished,
+                                     t.speed(now), title_len), width)
+                      for t in slowest]
+
+        out = ''
+        if self._drawn > 0:
+            # 回到上次仪表盘的开头并清除到屏幕末尾
+            out += '\r\033[%dA\033[J' % self._drawn
+        if self._buffer is not None:
+            out += self._buffer.take(final)
+        out += '\n'.join(lines) + '\n'
+        self._drawn = len(lines)
+        self.stream.write(out)
+        self.stream.flush()
+
+
+def summary_fields(s: ProgressSnapshot, rate: int, average: int,
+                   elapsed: float) -> List[str]:
+    return ['完成 %d/%d个文件' % (s.done_files,
+                               max(s.planned_files, s.started_files)),
+            '已上传 %s, %s/s (平均 %s/s)' % (human_size(s.sent),
+                                        human_size(rate),
+                                        human_size(average)),
+            '上传中 %d, 排队 %d' % (len(s.active), s.queued_files),
+            '用时 %s' % human_sec(int(elapsed))]
+
+
+def slowest_transfers(active: List[Transfer], now: float,
+                      top: int) -> List[Transfer]:
+    """
+    :return: 速度最慢的top个上传，刚开始的上传排在最后
+    """
+    return sorted(active, key=lambda t: (now - t.start < SLOW_MIN_TIME,
+                                         t.speed(now)))[:top]
+
+
+def display_width(s: str) -> int:
+    """
+    :return: 在终端中占用的列数，中文等宽字符占2列
+    """
+    return sum(2 if unicodedata.east_asian_width(c) in 'WF' else 1
+               for c in s)
+
+
+def fit(s: str, width: int) -> str:
+    """
+    截断为不超过width列，避免终端自动换行后清除的行数不对
+    """
+    if display_width(s) <= width:
+        return s
+    n = 0
+    for i, c in enumerate(s):
+        n += 2 if unicodedata.east_asian_width(c) in 'WF' else 1
+        if n > width:
+            return s[:i]
+    return s
+
+
+def table_header_and_divider(title_len: int):
+    header = ' filename%s ' % (' ' * (title_len - 8)) \
+             + '|  size   |   per   |  speed  |   eta   '
+    divider = '%s' % ('-' * (title_len + 2)) \
+              + '+---------+---------+---------+---------'
+    return header, divider
+
+
+def table_data(name: str, size: int, finished: int, speed: int,
+               title_len: int):
+    if display_width(name) > title_len:
+        name = fit(name, title_len - 3) + '...'
+    siz = human_size(size)
+    per = '%.1f%%' % (finished / size * 100 if size > 0 else 100)
+    spe = '%s/s' % human_size(speed)
+    eta = human_sec((size - finished) // speed) if speed > 0 else '---'
+    eta = eta if finished < size else '0s'
+    data = ' {}{} | {}{} | {}{} | {}{} | {}{} '.format(
+        name, ' ' * (title_len - display_width(name)),
+              ' ' * (7 - len(siz)), siz,
+              ' ' * (7 - len(per)), per,
+              ' ' * (7 - len(spe)), spe,
+              ' ' * (7 - len(eta)), eta
+    )
+    return data
+
+
+def human_size(n: int) -> str:
+    x = 1024
+    if n < x:
+        return '%dB' % n
+    if n < 1000 * x:
+        return '%dK' % (n // x)
+    x *= 1024
+    if n < 1000 * x:
+        return '%.1fM' % (n / x)
+    x *= 1024
+    if n < 1000 * x:
+        return '%.2fG' % (n / x)
+    x *= 1024
+    return '%.2fT' % (n / x)
+
+
+def human_sec(s: int) -> str:
+    x = 60
+    if s < x:
+        return '%ds' % s
+    if s < 60 * x:
+        return '%dm%ds' % (s // x, s % x)
+    x *= 60
+    if s < 24 * x:
+        return '%dh%dm' % (s // x, (s % x) // 60)
+    x *= 24
+    return '>%dd' % (s // x)
+
+
+progress = Progress()
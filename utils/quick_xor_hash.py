@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import base64
+from typing import Optional
+
+from utils.buffer_pool import buffer_pool
+
+# 算法说明：https://docs.microsoft.com/onedrive/developer/code-snippets/quickxorhash
+WIDTH_IN_BITS = 160
+SHIFT = 11
+MASK = (1 << WIDTH_IN_BITS) - 1
+# 第i个字节左移 (i * 11) % 160 位，相隔160个字节的位移相同
+BLOCK = WIDTH_IN_BITS
+BLOCK_BITS = BLOCK * 8
+
+
+class QuickXorHash:
+    """
+    OneDrive使用的QuickXorHash，可以分多次update
+    每个字节循环左移 (位置 * 11) % 160 位后异或到160位的状态中，因此位置对160取余相同的字节
+    可以先异或在一起。异或使用Python大整数运算，每次update只需要在C中遍历数据几次
+    """
+
+    def __init__(self, data: bytes = b'', state: int = 0, length: int = 0):
+        """
+        :param data: 初始数据
+        :param state: 继续计算时的状态
+        :param length: 继续计算时已计算的字节数
+        """
+        self.state = state
+        self.length = length
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        n = len(data)
+        if n == 0:
+            return
+        folded = fold(data)
+        # 这段数据的第一个字节的位移
+        shift = self.length * SHIFT % WIDTH_IN_BITS
+        state = self.state
+        for k, b in enumerate(folded):
+            if b:
+                pos = (shift + k * SHIFT) % WIDTH_IN_BITS
+                v = b << pos
+                state ^= (v & MASK) | (v >> WIDTH_IN_BITS)
+        self.state = state
+        self.length += n
+
+    def copy(self) -> 'QuickXorHash':
+        return QuickXorHash(state=self.state, length=self.length)
+
+    def digest(self) -> bytes:
+        result = bytearray(self.state.to_bytes(WIDTH_IN_BITS // 8, 'little'))
+        # 最后8个字节与数据长度异或
+        for i, b in enumerate(self.length.to_bytes(8, 'little')):
+            result[WIDTH_IN_BITS // 8 - 8 + i] ^= b
+        return bytes(result)
+
+    def base64(self) -> str:
+        return base64.b64encode(self.digest()).decode('ascii')
+
+
+def fold(data) -> bytes:
+    """
+    将位置对160取余相同的字节异或在一起
+    :return: 最多160个字节
+    """
+    n = len(data)
+    if n <= BLOCK:
+        return bytes(data)
+    blocks = (n + BLOCK - 1) // BLOCK
+    half = (blocks + 1) // 2
+    # 第一次折半直接从数据的两半转换，避免对整个大整数做移位
+    mv = memoryview(data)
+    x = (int.from_bytes(mv[:half * BLOCK], 'little')
+         ^ int.from_bytes(mv[half * BLOCK:], 'little'))
+    blocks = half
+    # 每次将高半部分异或到低半部分
+    while blocks > 1:
+        half = (blocks + 1) // 2
+        bits = half * BLOCK_BITS
+        x = (x & ((1 << bits) - 1)) ^ (x >> bits)
+        blocks = half
+    return x.to_bytes(BLOCK, 'little')
+
+
+def quick_xor_hash_file(path: str,
+                        end: int = -1,
+                        hasher: Optional[QuickXorHash] = None) -> QuickXorHash:
+    """
+    计算文件开头 end 个字节的QuickXorHash，使用缓冲池的缓冲区读取
+    :param path: 本地文件路径
+    :param end: 计算的字节数，-1表示整个文件
+    :param hasher: 从hasher已计算的位置继续计算，为None时从文件开头计算
+    """
+    h = hasher if hasher is not None else QuickXorHash()
+    with open(path, 'rb') as f, buffer_pool.buffer() as buf:
+        f.seek(h.length, 0)
+        view = memoryview(buf)
+        while end < 0 or h.length < end:
+            size = len(buf) if end < 0 else min(len(buf), end - h.length)
+            n = f.readinto(view[:size])
+            if not n:
+                break
+            h.update(view[:n])
+    return h
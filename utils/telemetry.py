@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from utils.buffer_pool import iter_blocks
+
+# 写入Prometheus指标的名称前缀
+METRIC_PREFIX = 'onedrive_upload'
+# 计为计数器的字段，其余以_time结尾的字段计为耗时
+COUNTER_FIELDS = ('bytes', 'retries', 'throttled', 'dirs', 'files', 'hashed')
+
+
+class Telemetry:
+    """
+    上传过程的性能记录。每个事件写为JSON文件的一行，并汇总为Prometheus textfile collector
+    可以读取的指标文件。没有配置输出文件时不记录任何内容
+    """
+
+    def __init__(self):
+        self.jsonl_path = ''
+        self.prom_path = ''
+        self.prom_interval = 15.0
+        self._file = None
+        self._lock = threading.Lock()
+        # 指标名称 -> 值
+        self._counters: Dict[str, float] = {}
+        self._last_flush = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.jsonl_path or self.prom_path)
+
+    def configure(self,
+                  jsonl_path: str = '',
+                  prom_path: str = '',
+                  prom_interval: float = 15):
+        """
+        :param jsonl_path: JSON lines文件路径，追加写入
+        :param prom_path: Prometheus指标文件路径，每隔prom_interval秒整体替换
+        :param prom_interval: 写入指标文件的间隔（秒）
+        """
+        self.close()
+        with self._lock:
+            self.jsonl_path = jsonl_path
+            self.prom_path = prom_path
+            self.prom_interval = prom_interval
+            if jsonl_path:
+                self._file = open(jsonl_path, 'a', encoding='utf8')
+
+    def record(self, kind: str, **fields):
+        """
+        记录一个事件
+        :param kind: 事件类型：chunk, file, request, token, scan
+        :param fields: 事件的字段，以_time结尾的为秒数
+        """
+        if not self.enabled:
+            return
+        fields['kind'] = kind
+        fields['ts'] = round(time.time(), 3)
+        line = json.dumps(fields, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+            self._count(kind, fields)
+            now = time.time()
+            if now - self._last_flush >= self.prom_interval:
+                self._flush()
+                self._last_flush = now
+
+    def _count(self, kind: str, fields: dict):
+        c = self._counters
+        name = '%s_%s_total' % (METRIC_PREFIX, kind)
+        c[name] = c.get(name, 0) + 1
+        for k, v in fields.items():
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                continue
+            if k in COUNTER_FIELDS:
+                name = '%s_%s_%s_total' % (METRIC_PREFIX, kind, k)
+                c[name] = c.get(name, 0) + v
+            elif k.endswith('_time'):
+                name = '%s_%s_%s_seconds' % (METRIC_PREFIX, kind, k[:-5])
+                c[name + '_sum'] = c.get(name + '_sum', 0) + v
+                c[name + '_count'] = c.get(name + '_count', 0) + 1
+
+    def _flush(self):
+        if self._file is not None:
+            self._file.flush()
+        if not self.prom_path:
+            return
+        lines = []
+        families = set()
+        for name in sorted(self._counters):
+            if name.endswith('_sum') or name.endswith('_count'):
+                family, metric_type = name.rsplit('_', 1)[0], 'summary'
+            else:
+                family, metric_type = name, 'counter'
+            if family not in families:
+                families.add(family)
+                lines.append('# TYPE %s %s' % (family, metric_type))
+            lines.append('%s %s' % (name, repr(float(self._counters[name]))))
+        # 先写入临时文件再替换，避免collector读到写了一半的文件
+        tmp = self.prom_path + '.tmp'
+        with open(tmp, 'w', encoding='utf8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.prom_path)
+
+    def metrics(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counters)
+
+    def close(self):
+        with self._lock:
+            if self.enabled:
+                self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+telemetry = Telemetry()
+
+
+class TimedBody:
+    """
+    分块发送的请求体，记录最后一块交给socket的时间，
+    用于区分发送请求体的时间和等待服务器响应的时间（time to first byte）
+    """
+
+    def __init__(self, data, block_size: int = 1024 * 1024):
+        self.data = data
+        self.block_size = block_size
+        self.sent_at: Optional[float] = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        self.sent_at = None
+        yield from iter_blocks(self.data, self.block_size)
+        self.sent_at = time.perf_counter()